@@ -1,9 +1,11 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import json
 import os
+import numpy as np
 from PIL import Image
-from utils import transform
+import torchvision.transforms.functional as FT
+from utils import transform, annotation_index, load_annotation_index
 
 
 class PascalVOCDataset(Dataset):
@@ -11,11 +13,14 @@ class PascalVOCDataset(Dataset):
     A PyTorch Dataset class to be used in a PyTorch DataLoader to create batches.
     """
 
-    def __init__(self, data_folder, split, keep_difficult=False):
+    def __init__(self, data_folder, split, keep_difficult=False, batch_augment=False, dims=(600, 600)):
         """
         :param data_folder: folder where data files are stored
         :param split: split, one of 'TRAIN' or 'TEST'
         :param keep_difficult: keep or discard objects that are considered difficult to detect?
+        :param batch_augment: leave augmentation to 'batch_transform' on whole batches, and only resize images here?
+        :param dims: (height, width) to resize images to, if batch_augment is True - larger than the SSD300 input, so that
+            zoomed-in crops are not upsampled from a few pixels
         """
         self.split = split.upper()
 
@@ -23,31 +28,60 @@ class PascalVOCDataset(Dataset):
 
         self.data_folder = data_folder
         self.keep_difficult = keep_difficult
+        self.batch_augment = batch_augment
+        self.dims = dims
 
-        # Read data files
-        with open(os.path.join(data_folder, self.split + '_images.json'), 'r') as j:
-            self.images = json.load(j)
-        with open(os.path.join(data_folder, self.split + '_objects.json'), 'r') as j:
-            self.objects = json.load(j)
+        # Memory-map the annotation index if there is one, so it's shared by all DataLoader workers, not copied
+        self.index = load_annotation_index(data_folder, self.split)
+        self.mapped = self.index is not None
 
-        assert len(self.images) == len(self.objects)
+        # Otherwise, read data files and pack them into the same arrays
+        if not self.mapped:
+            with open(os.path.join(data_folder, self.split + '_images.json'), 'r') as j:
+                images = json.load(j)
+            with open(os.path.join(data_folder, self.split + '_objects.json'), 'r') as j:
+                objects = json.load(j)
+
+            assert len(images) == len(objects)
+
+            self.index = annotation_index(images, objects)
+
+    def __getstate__(self):
+        # Memory-mapped arrays would be pickled as copies, so workers that don't fork re-open them instead
+        state = self.__dict__.copy()
+        if self.mapped:
+            state['index'] = None
+        return state
 
     def __getitem__(self, i):
+        if self.index is None:
+            self.index = load_annotation_index(self.data_folder, self.split)
+
         # Read image
-        image = Image.open(self.images[i], mode='r')
+        image = Image.open(self.index['images'][i].decode('utf-8'), mode='r')
         image = image.convert('RGB')
 
         # Read objects in this image (bounding boxes, labels, difficulties)
-        objects = self.objects[i]
-        boxes = torch.FloatTensor(objects['boxes'])  # (n_objects, 4)
-        labels = torch.LongTensor(objects['labels'])  # (n_objects)
-        difficulties = torch.ByteTensor(objects['difficulties'])  # (n_objects)
+        # These are copied out of the index, since the transformations modify them in place
+        start, end = self.index['offsets'][i], self.index['offsets'][i + 1]
+        boxes = torch.from_numpy(np.array(self.index['boxes'][start:end]))  # (n_objects, 4)
+        labels = torch.from_numpy(self.index['labels'][start:end].astype(np.int64))  # (n_objects)
+        difficulties = torch.from_numpy(np.array(self.index['difficulties'][start:end]))  # (n_objects)
 
         # Discard difficult objects, if desired
         if not self.keep_difficult:
-            boxes = boxes[1 - difficulties]
-            labels = labels[1 - difficulties]
-            difficulties = difficulties[1 - difficulties]
+            easy = difficulties == 0
+            boxes = boxes[easy]
+            labels = labels[easy]
+            difficulties = difficulties[easy]
+
+        # Only resize the image to a fixed size so it can be collated, and leave the rest to 'batch_transform'
+        if self.batch_augment:
+            old_dims = torch.FloatTensor([image.width, image.height, image.width, image.height]).unsqueeze(0)
+            original_size = torch.FloatTensor([image.height, image.width])  # for the aspect ratio of crops, in pixels
+            image = FT.pil_to_tensor(FT.resize(image, self.dims))  # (3, dims[0], dims[1]), uint8
+            boxes = boxes / old_dims  # fractional coordinates
+            return image, boxes, labels, difficulties, original_size
 
         # Apply transformations
         image, boxes, labels, difficulties = transform(image, boxes, labels, difficulties, split=self.split)
@@ -55,7 +89,9 @@ class PascalVOCDataset(Dataset):
         return image, boxes, labels, difficulties
 
     def __len__(self):
-        return len(self.images)
+        if self.index is None:
+            self.index = load_annotation_index(self.data_folder, self.split)
+        return len(self.index['offsets']) - 1
 
     def collate_fn(self, batch):
         """
@@ -66,7 +102,8 @@ class PascalVOCDataset(Dataset):
         Note: this need not be defined in this Class, can be standalone.
 
         :param batch: an iterable of N sets from __getitem__()
-        :return: a tensor of images, lists of varying-size tensors of bounding boxes, labels, and difficulties
+        :return: a tensor of images, lists of varying-size tensors of bounding boxes, labels, and difficulties, and with
+            batch_augment, a tensor of the original (height, width) of the images
         """
 
         images = list()
@@ -82,4 +119,87 @@ class PascalVOCDataset(Dataset):
 
         images = torch.stack(images, dim=0)
 
+        if self.batch_augment:
+            original_sizes = torch.stack([b[4] for b in batch], dim=0)  # (N, 2)
+            return images, boxes, labels, difficulties, original_sizes
+
         return images, boxes, labels, difficulties  # tensor (N, 3, 300, 300), 3 lists of N tensors each
+
+
+class ImagePathsDataset(Dataset):
+    """
+    A PyTorch Dataset of images to run inference on, so decoding and resizing can happen in DataLoader workers.
+    """
+
+    def __init__(self, image_paths, dims=(300, 300)):
+        """
+        :param image_paths: list of paths to image files
+        :param dims: (height, width) the images are resized to, (300, 300) for the SSD300
+        """
+        self.image_paths = list(image_paths)
+        self.dims = dims
+
+        # Mean and standard deviation of ImageNet data that our base VGG from torchvision was trained on
+        self.mean = [0.485, 0.456, 0.406]
+        self.std = [0.229, 0.224, 0.225]
+
+    def __getitem__(self, i):
+        # Read image
+        image = Image.open(self.image_paths[i], mode='r')
+        image = image.convert('RGB')
+
+        # Keep the original dimensions, to transform detected boxes back to them
+        original_dims = torch.FloatTensor([image.width, image.height, image.width, image.height])  # (4)
+
+        # Resize, convert to a Torch tensor, and normalize
+        image = FT.normalize(FT.to_tensor(FT.resize(image, self.dims)), mean=self.mean, std=self.std)  # (3, 300, 300)
+
+        return image, original_dims, i
+
+    def __len__(self):
+        return len(self.image_paths)
+
+
+class ResumableRandomSampler(Sampler):
+    """
+    A random sampler for a PyTorch DataLoader that can resume from the middle of an epoch.
+
+    Each epoch's order is a permutation seeded by the seed and the epoch number, so it can be drawn again after a
+    restart, and the samples already seen in that epoch skipped.
+    """
+
+    def __init__(self, data_source, seed=0):
+        """
+        :param data_source: dataset to sample from
+        :param seed: random seed, from which each epoch's order is derived
+        """
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """
+        Set the epoch to sample the order of, and where in it to start.
+
+        :param epoch: epoch number
+        :param start: number of samples of this epoch to skip, because they were seen before a restart
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.data_source), generator=generator).tolist()
+        return iter(order[self.start:])
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'start': self.start}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.set_epoch(state['epoch'], state['start'])
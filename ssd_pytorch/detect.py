@@ -1,18 +1,18 @@
 from torchvision import transforms
 from utils import *
+from datasets import ImagePathsDataset
+from model import load_checkpoint
 from PIL import Image, ImageDraw, ImageFont
-import sys
+from tqdm import tqdm
+import argparse
+import csv
+import glob
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# Load model checkpoint
+# Model checkpoint, loaded on first use (see load_model())
 checkpoint = 'checkpoint_ssd300.pth.tar'
-checkpoint = torch.load(checkpoint)
-start_epoch = checkpoint['epoch'] + 1
-print('\nLoaded checkpoint from epoch %d.\n' % start_epoch)
-model = checkpoint['model']
-model = model.to(device)
-model.eval()
+model = None
 
 # Transforms
 resize = transforms.Resize((300, 300))
@@ -20,6 +20,30 @@ to_tensor = transforms.ToTensor()
 normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                  std=[0.229, 0.224, 0.225])
 
+# File extensions picked up when a directory is given
+image_extensions = ('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp')
+
+
+def load_model(checkpoint_path=checkpoint):
+    """
+    Load a trained SSD300 from a checkpoint, and make it the model used for detection.
+
+    :param checkpoint_path: path to the checkpoint saved during training
+    :return: the model, in eval mode and on the default device
+    """
+    global model
+
+    checkpoint = load_checkpoint(checkpoint_path, map_location=device)
+    if checkpoint.get('iteration') is not None:
+        print('\nLoaded checkpoint from epoch %d, iteration %d.\n' % (checkpoint['epoch'], checkpoint['iteration']))
+    else:
+        print('\nLoaded checkpoint from epoch %d.\n' % (checkpoint['epoch'] + 1))
+    model = checkpoint['model']
+    model = model.to(device)
+    model.eval()
+
+    return model
+
 
 def detect(original_image, min_score, max_overlap, top_k, suppress=None):
     """
@@ -33,6 +57,9 @@ def detect(original_image, min_score, max_overlap, top_k, suppress=None):
     :return: annotated image, a PIL Image
     """
 
+    if model is None:
+        load_model()
+
     # Transform
     image = normalize(to_tensor(resize(original_image)))
 
@@ -110,29 +137,144 @@ def add_margin(pil_img, top, right, bottom, left, color):
     return result
     
 
+def find_images(sources):
+    """
+    Find the image files to run detection on.
+
+    :param sources: list of image files, directories, glob patterns, or .txt files listing one image path per line
+    :return: list of image paths
+    """
+    image_paths = list()
+    for source in sources:
+        if os.path.isdir(source):
+            image_paths.extend(sorted(os.path.join(source, f) for f in os.listdir(source)
+                                      if f.lower().endswith(image_extensions)))
+        elif glob.has_magic(source):
+            image_paths.extend(sorted(glob.glob(source, recursive=True)))
+        elif source.lower().endswith('.txt'):
+            with open(source) as f:
+                image_paths.extend(line.strip() for line in f if line.strip())
+        else:
+            image_paths.append(source)
+
+    return image_paths
+
+
+def detect_images(image_paths, min_score, max_overlap, top_k, batch_size=32, workers=4):
+    """
+    Detect objects in many images with a trained SSD300, in batches, without visualizing the results.
+
+    Images are decoded and resized in DataLoader workers, while the model runs on the batches they produce.
+
+    :param image_paths: list of image paths
+    :param min_score: minimum threshold for a detected box to be considered a match for a certain class
+    :param max_overlap: maximum overlap two boxes can have so that the one with the lower score is not suppressed via Non-Maximum Suppression (NMS)
+    :param top_k: if there are a lot of resulting detection across all classes, keep only the top 'k'
+    :param batch_size: number of images in each forward pass
+    :param workers: number of workers for loading images in the DataLoader
+    :return: generator of (image path, boxes in original image coordinates, label names, scores), one per image, in order
+    """
+    if model is None:
+        load_model()
+
+    dataset = ImagePathsDataset(image_paths)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers,
+                                         pin_memory=device.type == 'cuda')
+
+    with torch.no_grad():
+        for images, original_dims, indices in loader:
+            images = images.to(device, non_blocking=True)  # (N, 3, 300, 300)
+
+            # Forward prop.
+            predicted_locs, predicted_scores = model(images)
+
+            # Detect objects in SSD output
+            det_boxes, det_labels, det_scores = model.detect_objects(predicted_locs, predicted_scores,
+                                                                     min_score=min_score, max_overlap=max_overlap,
+                                                                     top_k=top_k)
+
+            for boxes, labels, scores, dims, i in zip(det_boxes, det_labels, det_scores, original_dims,
+                                                      indices.tolist()):
+                # Move detections to the CPU, and transform to original image dimensions
+                boxes = boxes.to('cpu') * dims.unsqueeze(0)
+                labels = labels.to('cpu')
+                scores = scores.to('cpu')
+
+                # Drop the 'background' placeholder that SSD300.detect_objects() returns when nothing is found
+                found = labels != 0
+                yield dataset.image_paths[i], boxes[found], [rev_label_map[l] for l in labels[found].tolist()], \
+                    scores[found]
+
+
+def save_detections(detections, output, output_format='jsonl'):
+    """
+    Write detections to a file.
+
+    'jsonl' writes one JSON object per image, with its boxes, labels and scores.
+    'csv' writes one row per detected object, with columns image, label, score, xmin, ymin, xmax, ymax.
+
+    :param detections: iterable of (image path, boxes, label names, scores), as produced by detect_images()
+    :param output: path of the file to write
+    :param output_format: one of 'jsonl' or 'csv'
+    :return: number of images and number of objects written
+    """
+    assert output_format in {'jsonl', 'csv'}
+
+    n_images = 0
+    n_objects = 0
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f) if output_format == 'csv' else None
+        if writer is not None:
+            writer.writerow(['image', 'label', 'score', 'xmin', 'ymin', 'xmax', 'ymax'])
+
+        for image_path, boxes, labels, scores in detections:
+            boxes = [[round(x, 2) for x in box] for box in boxes.tolist()]
+            scores = [round(x, 4) for x in scores.tolist()]
+
+            if writer is not None:
+                writer.writerows([image_path, l, s] + b for b, l, s in zip(boxes, labels, scores))
+            else:
+                f.write(json.dumps({'image': image_path, 'boxes': boxes, 'labels': labels, 'scores': scores}) + '\n')
+
+            n_images += 1
+            n_objects += len(labels)
+
+    return n_images, n_objects
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Detect Lego parts in images with a trained SSD300.')
+    parser.add_argument('sources', nargs='+',
+                        help='image files, directories, glob patterns, or .txt files listing image paths')
+    parser.add_argument('--checkpoint', default=checkpoint, help='model checkpoint')
+    parser.add_argument('--output', default='detections.jsonl', help='file to write detections to')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default=None,
+                        help='output format, inferred from the --output extension by default')
+    parser.add_argument('--batch-size', type=int, default=32, help='images per forward pass')
+    parser.add_argument('--workers', type=int, default=4, help='DataLoader workers for decoding images')
+    parser.add_argument('--min-score', type=float, default=0.2, help='minimum score of a detection')
+    parser.add_argument('--max-overlap', type=float, default=0.5, help='NMS overlap threshold')
+    parser.add_argument('--top-k', type=int, default=200, help='maximum detections per image')
+    parser.add_argument('--show', action='store_true', help='show annotated images instead of writing detections')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    print("Args: ", str(sys.argv[1]))
-    directory = sys.argv[1]
-    # check if directory
-
-    img_path = 'detection/' + str(sys.argv[1])
-    original_image = Image.open(img_path, mode='r')
-    original_image = original_image.convert('RGB')
-    original_image = add_margin(original_image, 50, 50, 50, 50, (255,255,255))
-    detect(original_image, min_score=0.2, max_overlap=0.5, top_k=200).show()
-
-"""
-    if os.path.isdir(directory):
-        path, dirs, files = next(os.walk(directory))
-        file_count = len(files)
-        for x in files:
-            original_image = Image.open(directory + '/' + x, mode='r')
+    args = parse_args()
+    image_paths = find_images(args.sources)
+    load_model(args.checkpoint)
+
+    if args.show:
+        for img_path in image_paths:
+            original_image = Image.open(img_path, mode='r')
             original_image = original_image.convert('RGB')
-            detect(original_image, min_score=0.2, max_overlap=0.5, top_k=200).show()
-    else: # detecting from file
-        original_image = Image.open(directory, mode='r')
-        original_image = original_image.convert('RGB')
-        new_image = detect(original_image, min_score=0.2, max_overlap=0.5, top_k=200)
-        image = Image.open(new_image)
-                
-"""
+            original_image = add_margin(original_image, 50, 50, 50, 50, (255, 255, 255))
+            detect(original_image, min_score=args.min_score, max_overlap=args.max_overlap, top_k=args.top_k).show()
+    else:
+        output_format = args.format or ('csv' if args.output.lower().endswith('.csv') else 'jsonl')
+        detections = detect_images(image_paths, min_score=args.min_score, max_overlap=args.max_overlap,
+                                   top_k=args.top_k, batch_size=args.batch_size, workers=args.workers)
+        n_images, n_objects = save_detections(tqdm(detections, total=len(image_paths), desc='Detecting'),
+                                              args.output, output_format=output_format)
+        print('\nDetected %d objects in %d images. Detections have been saved to %s.' % (
+            n_objects, n_images, os.path.abspath(args.output)))
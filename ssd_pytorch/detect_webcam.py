@@ -1,136 +1,378 @@
-from torchvision import transforms
 from utils import *
-from PIL import Image, ImageDraw, ImageFont
-import sys
+from detect import load_model, checkpoint
+import argparse
 import numpy as np
-from matplotlib.image import imread
+import queue
+import threading
 import time
-import cv2 
+import cv2
 
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# Load model checkpoint
-checkpoint = 'checkpoint_ssd300.pth.tar'
-checkpoint = torch.load(checkpoint)
-start_epoch = checkpoint['epoch'] + 1
-print('\nLoaded checkpoint from epoch %d.\n' % start_epoch)
-model = checkpoint['model']
-model = model.to(device)
-model.eval()
+# Mean and standard deviation of ImageNet data that our base VGG from torchvision was trained on
+mean = torch.FloatTensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+std = torch.FloatTensor([0.229, 0.224, 0.225]).view(3, 1, 1)
 
-# Transforms
-resize = transforms.Resize((300, 300))
-to_tensor = transforms.ToTensor()
-normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                 std=[0.229, 0.224, 0.225])
+# Colors of the label_color_map, as the (B, G, R) tuples OpenCV draws with
+label_color_bgr = {k: tuple(int(v[i:i + 2], 16) for i in (5, 3, 1)) for k, v in label_color_map.items()}
 
 
-def detect(original_image, min_score, max_overlap, top_k, suppress=None):
+class SyntheticSource(object):
+    """
+    A stand-in for cv2.VideoCapture that produces random frames at a fixed rate, to run the pipeline without a camera.
     """
-    Detect objects in an image with a trained SSD300, and visualize the results.
 
-    :param original_image: image, a PIL Image
-    :param min_score: minimum threshold for a detected box to be considered a match for a certain class
-    :param max_overlap: maximum overlap two boxes can have so that the one with the lower score is not suppressed via Non-Maximum Suppression (NMS)
-    :param top_k: if there are a lot of resulting detection across all classes, keep only the top 'k'
-    :param suppress: classes that you know for sure cannot be in the image or you do not want in the image, a list
-    :return: annotated image, a PIL Image
+    def __init__(self, n_frames=200, height=480, width=640, fps=30.):
+        """
+        :param n_frames: number of frames to produce before reporting the end of the stream
+        :param height: frame height
+        :param width: frame width
+        :param fps: rate at which frames are produced, like a camera would; None to produce them as fast as possible
+        """
+        self.n_frames = n_frames
+        self.shape = (height, width, 3)
+        self.interval = 1. / fps if fps else 0.
+        self.count = 0
+        self.next_time = time.time()
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        if self.count >= self.n_frames:
+            return False, None
+
+        # Wait for the next frame, as a camera would
+        time.sleep(max(0., self.next_time - time.time()))
+        self.next_time = max(self.next_time, time.time() - self.interval) + self.interval
+        self.count += 1
+
+        return True, np.random.randint(0, 256, self.shape, dtype=np.uint8)
+
+    def release(self):
+        pass
+
+
+def open_source(source):
     """
+    Open a frame source.
+
+    :param source: a camera index like '0', a path to a video file, or 'synthetic'
+    :return: a cv2.VideoCapture, or a SyntheticSource
+    """
+    if source == 'synthetic':
+        return SyntheticSource()
+
+    cap = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    assert cap.isOpened(), 'Failed to open %s' % source
+
+    return cap
 
-    # Transform
-    image = normalize(to_tensor(resize(original_image)))
 
-    # Move to default device
-    image = image.to(device)
+class StageMeter(object):
+    """
+    Keeps track of the throughput, latency, and dropped frames of a pipeline stage.
+    """
 
-    # Forward prop.
-    predicted_locs, predicted_scores = model(image.unsqueeze(0))
+    def __init__(self, name):
+        self.name = name
+        self.latency = AverageMeter()
+        self.dropped = 0
+        self.first_time = None
+        self.last_time = None
 
-    # Detect objects in SSD output
-    det_boxes, det_labels, det_scores = model.detect_objects(predicted_locs, predicted_scores, min_score=min_score,
-                                                             max_overlap=max_overlap, top_k=top_k)
+    def update(self, latency):
+        now = time.time()
+        if self.first_time is None:
+            self.first_time = now
+        self.last_time = now
+        self.latency.update(latency)
 
-    # Move detections to the CPU
-    det_boxes = det_boxes[0].to('cpu')
+    @property
+    def fps(self):
+        if self.latency.count < 2 or self.last_time == self.first_time:
+            return 0.
+        return (self.latency.count - 1) / (self.last_time - self.first_time)
 
-    # Transform to original image dimensions
-    original_dims = torch.FloatTensor(
-        [original_image.width, original_image.height, original_image.width, original_image.height]).unsqueeze(0)
-    det_boxes = det_boxes * original_dims
+    def __str__(self):
+        return '{0:<10} frames {1:5d}\tFPS {2:6.2f}\tLatency {3:.1f} ms ({4:.1f} ms)\tDropped {5:d}'.format(
+            self.name, self.latency.count, self.fps, self.latency.val * 1000, self.latency.avg * 1000, self.dropped)
 
-    # Decode class integer labels
-    det_labels = [rev_label_map[l] for l in det_labels[0].to('cpu').tolist()]
 
-    print("LABELS: ", det_labels)	
-    print("SCORES: ", det_scores)
+def put_latest(q, item, meter):
+    """
+    Put an item in a bounded queue, dropping the oldest queued item if the queue is full.
 
+    :param q: queue to put the item in
+    :param item: item to put
+    :param meter: StageMeter of the consuming stage, which counts the dropped items
+    """
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+                meter.dropped += 1
+            except queue.Empty:
+                pass
+
+
+def detect_frame(model, frame, min_score, max_overlap, top_k):
+    """
+    Detect objects in a video frame with a trained SSD300.
 
-    # If no objects found, the detected labels will be set to ['0.'], i.e. ['background'] in SSD300.detect_objects() in model.py
-    if det_labels == ['background']:
-        # Just return original image
-        return original_image
+    :param model: the SSD300
+    :param frame: frame, a (H, W, 3) BGR uint8 array as read by OpenCV
+    :param min_score: minimum threshold for a detected box to be considered a match for a certain class
+    :param max_overlap: maximum overlap two boxes can have so that the one with the lower score is not suppressed via Non-Maximum Suppression (NMS)
+    :param top_k: if there are a lot of resulting detection across all classes, keep only the top 'k'
+    :return: boxes in frame coordinates, label names, scores
+    """
+    # Transform - resize, convert BGR to RGB, and normalize
+    image = np.ascontiguousarray(cv2.resize(frame, (300, 300))[:, :, ::-1])
+    image = torch.from_numpy(image).permute(2, 0, 1).float().div_(255)  # (3, 300, 300)
+    image = ((image - mean) / std).to(device)
 
-    # Annotate
-    annotated_image = original_image
-    draw = ImageDraw.Draw(annotated_image)
-    font = ImageFont.truetype("./FreeSans.ttf", 15)
+    with torch.no_grad():
+        # Forward prop.
+        predicted_locs, predicted_scores = model(image.unsqueeze(0))
 
-    # Suppress specific classes, if needed
-    for i in range(det_boxes.size(0)):
-        if suppress is not None:
-            if det_labels[i] in suppress:
-                continue
+        # Detect objects in SSD output
+        det_boxes, det_labels, det_scores = model.detect_objects(predicted_locs, predicted_scores, min_score=min_score,
+                                                                 max_overlap=max_overlap, top_k=top_k)
 
-        # Boxes
-        box_location = det_boxes[i].tolist()
-        draw.rectangle(xy=box_location, outline=label_color_map[det_labels[i]])
-        draw.rectangle(xy=[l + 1. for l in box_location], outline=label_color_map[
-            det_labels[i]])  # a second rectangle at an offset of 1 pixel to increase line thickness
-        # draw.rectangle(xy=[l + 2. for l in box_location], outline=label_color_map[
-        #     det_labels[i]])  # a third rectangle at an offset of 1 pixel to increase line thickness
-        # draw.rectangle(xy=[l + 3. for l in box_location], outline=label_color_map[
-        #     det_labels[i]])  # a fourth rectangle at an offset of 1 pixel to increase line thickness
+    # Move detections to the CPU, and transform to frame dimensions
+    height, width = frame.shape[:2]
+    det_boxes = det_boxes[0].to('cpu') * torch.FloatTensor([width, height, width, height]).unsqueeze(0)
+    det_labels = det_labels[0].to('cpu')
+    det_scores = det_scores[0].to('cpu')
 
-        # Text
-        text_size = font.getsize(det_labels[i].upper())
-        text_location = [box_location[0] + 2., box_location[1] - text_size[1]]
-        textbox_location = [box_location[0], box_location[1] - text_size[1], box_location[0] + text_size[0] + 4.,
-                            box_location[1]]
-        draw.rectangle(xy=textbox_location, fill=label_color_map[det_labels[i]])
-        draw.text(xy=text_location, text=det_labels[i].upper(), fill='white',
-                  font=font)
-    del draw
+    # Drop the 'background' placeholder that SSD300.detect_objects() returns when nothing is found
+    found = det_labels != 0
 
-    return annotated_image
+    return det_boxes[found], [rev_label_map[l] for l in det_labels[found].tolist()], det_scores[found]
 
 
-# Load the webcam handler
-cap = cv2.VideoCapture(0)
-time.sleep(1) ### letting the camera autofocus
+def annotate_frame(frame, boxes, labels, suppress=None):
+    """
+    Draw detected boxes and their labels on a video frame, in place.
 
+    :param frame: frame, a (H, W, 3) BGR uint8 array
+    :param boxes: boxes in frame coordinates, a tensor of dimensions (n_objects, 4)
+    :param labels: label names, a list of length n_objects
+    :param suppress: classes that you know for sure cannot be in the image or you do not want in the image, a list
+    :return: the annotated frame
+    """
+    for box, label in zip(boxes.round().int().tolist(), labels):
+        if suppress is not None and label in suppress:
+            continue
 
-NUM_FRAMES = 200 # Number of frames to read from webcame, can change this
-for i in range(NUM_FRAMES):
+        color = label_color_bgr[label]
+        cv2.rectangle(frame, (box[0], box[1]), (box[2], box[3]), color, 2)
 
-    time.sleep(0.1)
-    ret, frame = cap.read()
-    PIL_image = Image.fromarray(np.uint8(frame))
+        # Text
+        (text_w, text_h), _ = cv2.getTextSize(label.upper(), cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+        cv2.rectangle(frame, (box[0], box[1] - text_h - 4), (box[0] + text_w + 4, box[1]), color, -1)
+        cv2.putText(frame, label.upper(), (box[0] + 2, box[1] - 2), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
 
-    image1 = detect(PIL_image, min_score=0.3, max_overlap=0.5, top_k=200)    
-    
-    cv2.imshow('input', np.array(image1))
+    return frame
 
-    c = cv2.waitKey(1)
-    if c == 27:
-        break
-        
 
-cap.release()
-cv2.destroyAllWindows()
+class DetectionPipeline(object):
+    """
+    Runs capture, inference and rendering concurrently, connected by bounded queues.
 
+    Frames are captured and run through the SSD300 on their own threads, while rendering stays on the calling thread,
+    since OpenCV windows must be driven from there. When inference falls behind, stale frames waiting in a queue are
+    dropped in favour of the newest one, so what is displayed lags the camera as little as possible.
+    """
 
-    
-    
-    
-    
+    def __init__(self, source, model, min_score=0.3, max_overlap=0.5, top_k=200, max_frames=None, queue_size=1,
+                 drop_frames=True, display=True, print_freq=50):
+        """
+        :param source: frame source with the cv2.VideoCapture read() interface
+        :param model: the SSD300
+        :param min_score: minimum threshold for a detected box to be considered a match for a certain class
+        :param max_overlap: maximum overlap two boxes can have so that the one with the lower score is not suppressed via NMS
+        :param top_k: if there are a lot of resulting detection across all classes, keep only the top 'k'
+        :param max_frames: stop after capturing this many frames; None to run until the source ends
+        :param queue_size: number of frames each queue can hold
+        :param drop_frames: drop stale frames when a stage falls behind; if False, every frame is processed
+        :param display: show annotated frames in a window
+        :param print_freq: print pipeline status every __ rendered frames
+        """
+        self.source = source
+        self.model = model
+        self.min_score = min_score
+        self.max_overlap = max_overlap
+        self.top_k = top_k
+        self.max_frames = max_frames
+        self.drop_frames = drop_frames
+        self.display = display
+        self.print_freq = print_freq
+
+        self.frames = queue.Queue(maxsize=queue_size)  # captured frames, waiting for inference
+        self.detections = queue.Queue(maxsize=queue_size)  # frames with detections, waiting for rendering
+        self.stopped = threading.Event()
+
+        self.capture_meter = StageMeter('capture')
+        self.inference_meter = StageMeter('inference')
+        self.render_meter = StageMeter('render')
+        self.total_meter = StageMeter('end-to-end')
+
+    def put(self, q, item, meter):
+        if self.drop_frames:
+            put_latest(q, item, meter)
+        else:
+            while not self.stopped.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+    def finish(self, q, end=None):
+        """
+        Mark the end of the stream in a queue, without dropping the frames still waiting in it.
+
+        :param q: the queue
+        :param end: None if the stream ended normally, or the exception that ended it, to be re-raised by the renderer
+        """
+        while True:
+            try:
+                q.put(end, timeout=0.1)
+                return
+            except queue.Full:
+                # Once the pipeline is stopped, nobody may be left to make room
+                if self.stopped.is_set():
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def capture(self):
+        """
+        Read frames from the source. A None marks the end of the stream, or an exception if reading failed.
+        """
+        n_frames = 0
+        end = None
+        try:
+            while not self.stopped.is_set() and (self.max_frames is None or n_frames < self.max_frames):
+                start = time.time()
+                ret, frame = self.source.read()
+                if not ret:
+                    break
+                n_frames += 1
+                self.capture_meter.update(time.time() - start)
+                self.put(self.frames, (start, frame), self.inference_meter)
+        except Exception as e:
+            end = e
+            self.stopped.set()
+        self.finish(self.frames, end)
+
+    def infer(self):
+        """
+        Detect objects in captured frames. Exceptions, from here or from capture, are passed on to the renderer.
+        """
+        end = None
+        try:
+            while True:
+                item = self.frames.get()
+                if item is None or isinstance(item, Exception):
+                    end = item
+                    break
+                captured_at, frame = item
+
+                start = time.time()
+                boxes, labels, scores = detect_frame(self.model, frame, min_score=self.min_score,
+                                                     max_overlap=self.max_overlap, top_k=self.top_k)
+                self.inference_meter.update(time.time() - start)
+                self.put(self.detections, (captured_at, frame, boxes, labels, scores), self.render_meter)
+        except Exception as e:
+            end = e
+            self.stopped.set()
+        self.finish(self.detections, end)
+
+    def render(self):
+        """
+        Draw detections on frames, and display them. Re-raises an exception that stopped capture or inference.
+        """
+        while True:
+            item = self.detections.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            captured_at, frame, boxes, labels, scores = item
+
+            start = time.time()
+            frame = annotate_frame(frame, boxes, labels)
+            if self.display:
+                cv2.imshow('input', frame)
+                if cv2.waitKey(1) == 27:  # ESC
+                    self.stopped.set()
+            now = time.time()
+            self.render_meter.update(now - start)
+            self.total_meter.update(now - captured_at)
+
+            if self.print_freq and self.render_meter.latency.count % self.print_freq == 0:
+                print(self.total_meter)
+
+    def run(self):
+        """
+        Run the pipeline until the source ends, max_frames are captured, or ESC is pressed.
+
+        :return: StageMeters of the capture, inference, render stages, and of the end-to-end latency
+        """
+        threads = [threading.Thread(target=self.capture, daemon=True),
+                   threading.Thread(target=self.infer, daemon=True)]
+        for t in threads:
+            t.start()
+        try:
+            self.render()
+        finally:
+            self.stopped.set()
+            for t in threads:
+                t.join()
+
+        return self.capture_meter, self.inference_meter, self.render_meter, self.total_meter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Detect Lego parts in a live video stream with a trained SSD300.')
+    parser.add_argument('--source', default='0', help="camera index, video file, or 'synthetic' for random frames")
+    parser.add_argument('--checkpoint', default=checkpoint, help='model checkpoint')
+    parser.add_argument('--frames', type=int, default=200, help='number of frames to read from the source')
+    parser.add_argument('--min-score', type=float, default=0.3, help='minimum score of a detection')
+    parser.add_argument('--max-overlap', type=float, default=0.5, help='NMS overlap threshold')
+    parser.add_argument('--top-k', type=int, default=200, help='maximum detections per frame')
+    parser.add_argument('--queue-size', type=int, default=1, help='frames each stage queue can hold')
+    parser.add_argument('--keep-all', action='store_true', help='process every frame instead of dropping stale ones')
+    parser.add_argument('--no-display', action='store_true', help='do not show annotated frames')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    model = load_model(args.checkpoint)
+
+    # Load the webcam handler
+    cap = open_source(args.source)
+    time.sleep(1)  ### letting the camera autofocus
+
+    pipeline = DetectionPipeline(cap, model, min_score=args.min_score, max_overlap=args.max_overlap, top_k=args.top_k,
+                                 max_frames=args.frames, queue_size=args.queue_size, drop_frames=not args.keep_all,
+                                 display=not args.no_display)
+    try:
+        meters = pipeline.run()
+    finally:
+        cap.release()
+        if not args.no_display:
+            cv2.destroyAllWindows()
+
+    print()
+    for meter in meters:
+        print(meter)
@@ -1,5 +1,7 @@
 from utils import *
 from datasets import PascalVOCDataset
+from metrics import calculate_mAP
+from model import load_checkpoint
 from tqdm import tqdm
 from pprint import PrettyPrinter
 
@@ -13,9 +15,10 @@ batch_size = 64
 workers = 4
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 checkpoint = './checkpoint_ssd300.pth.tar'
+metric = 'voc'  # 'voc' for the 11-point mAP at IoU 0.5, 'coco' for the 101-point mAP@[0.5:0.95]
 
 # Load model checkpoint that is to be evaluated
-checkpoint = torch.load(checkpoint)
+checkpoint = load_checkpoint(checkpoint, map_location=device)
 model = checkpoint['model']
 model = model.to(device)
 
@@ -47,7 +50,7 @@ def evaluate(test_loader, model):
     det_scores = list()
     true_boxes = list()
     true_labels = list()
-    true_difficulties = list()  # it is necessary to know which objects are 'difficult', see 'calculate_mAP' in utils.py
+    true_difficulties = list()  # it is necessary to know which objects are 'difficult', see 'calculate_mAP' in metrics.py
 
     with torch.no_grad():
         # Batches
@@ -76,7 +79,8 @@ def evaluate(test_loader, model):
             true_difficulties.extend(difficulties)
 
         # Calculate mAP
-        APs, mAP = calculate_mAP(det_boxes, det_labels, det_scores, true_boxes, true_labels, true_difficulties)
+        APs, mAP = calculate_mAP(det_boxes, det_labels, det_scores, true_boxes, true_labels, true_difficulties,
+                                 metric=metric)
 
     # Print AP for each class
     pp.pprint(APs)
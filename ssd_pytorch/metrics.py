@@ -0,0 +1,231 @@
+import numpy as np
+import torch
+from utils import label_map, rev_label_map
+
+# IoU thresholds and recall points for each supported metric
+# 'voc' is the 11-point interpolated AP at an IoU of 0.5, as in the PASCAL VOC 2007 devkit
+# 'coco' is the 101-point interpolated AP averaged over IoUs of 0.5:0.05:0.95, as in the COCO API
+metric_thresholds = {'voc': {'iou_thresholds': np.array([0.5], dtype=np.float32),
+                             'recall_thresholds': np.linspace(0, 1, 11, dtype=np.float32)},
+                     'coco': {'iou_thresholds': np.linspace(0.5, 0.95, 10, dtype=np.float32),
+                              'recall_thresholds': np.linspace(0, 1, 101, dtype=np.float32)}}
+
+
+def to_flat_arrays(tensors, dtype):
+    """
+    Concatenate a list of per-image tensors into a single NumPy array, and keep track of the image each row is from.
+
+    :param tensors: list of tensors, one tensor for each image
+    :param dtype: NumPy dtype of the concatenated array
+    :return: concatenated array, image index of each row
+    """
+    images = np.repeat(np.arange(len(tensors)), [t.size(0) for t in tensors])  # (n_rows)
+    flat = torch.cat([t.detach().to('cpu') for t in tensors], dim=0).numpy().astype(dtype, copy=False)  # (n_rows, ...)
+    return flat, images
+
+
+def find_jaccard_overlap_np(set_1, set_2):
+    """
+    Find the Jaccard Overlap (IoU) of every box combination between two sets of boxes that are in boundary coordinates.
+
+    This is the NumPy counterpart of 'find_jaccard_overlap' in utils.py, computed in the same (float32) precision.
+
+    :param set_1: set 1, an array of dimensions (n1, 4)
+    :param set_2: set 2, an array of dimensions (n2, 4)
+    :return: Jaccard Overlap of each of the boxes in set 1 with respect to each of the boxes in set 2, an array of dimensions (n1, n2)
+    """
+    intersection_w = np.minimum(set_1[:, None, 2], set_2[None, :, 2]) - np.maximum(set_1[:, None, 0], set_2[None, :, 0])
+    intersection_h = np.minimum(set_1[:, None, 3], set_2[None, :, 3]) - np.maximum(set_1[:, None, 1], set_2[None, :, 1])
+    intersection = np.clip(intersection_w, 0, None) * np.clip(intersection_h, 0, None)  # (n1, n2)
+
+    areas_set_1 = (set_1[:, 2] - set_1[:, 0]) * (set_1[:, 3] - set_1[:, 1])  # (n1)
+    areas_set_2 = (set_2[:, 2] - set_2[:, 0]) * (set_2[:, 3] - set_2[:, 1])  # (n2)
+    union = areas_set_1[:, None] + areas_set_2[None, :] - intersection  # (n1, n2)
+
+    return intersection / union  # (n1, n2)
+
+
+def match_detections(det_boxes, det_groups, det_ranks, true_boxes, true_groups, true_difficulties, metric):
+    """
+    Mark each detection as a true positive, a false positive, or ignored, for each IoU threshold of the metric.
+
+    Detections and ground truths are grouped by (image, class), so an IoU matrix is computed only once per group.
+
+    For the 'voc' metric, each detection is matched to the object it overlaps most, and only the highest scoring
+    detection of an object is a true positive. For the 'coco' metric, each detection is greedily matched to the
+    best still-unmatched object above the IoU threshold. In both cases, detections matched to 'difficult' objects are
+    ignored, i.e. they are neither true nor false positives.
+
+    :param det_boxes: detected boxes, an array of dimensions (n_detections, 4)
+    :param det_groups: (image, class) group of each detection, an array of dimensions (n_detections)
+    :param det_ranks: position of each detection in the order of decreasing scores, an array of dimensions (n_detections)
+    :param true_boxes: true object boxes, an array of dimensions (n_objects, 4)
+    :param true_groups: (image, class) group of each object, an array of dimensions (n_objects)
+    :param true_difficulties: difficulty of each object (0 or 1), an array of dimensions (n_objects)
+    :param metric: one of 'voc' or 'coco'
+    :return: true positive and ignored flags, boolean arrays of dimensions (n_iou_thresholds, n_detections)
+    """
+    iou_thresholds = metric_thresholds[metric]['iou_thresholds']
+    n_thresholds = iou_thresholds.shape[0]
+    n_detections = det_boxes.shape[0]
+
+    true_positives = np.zeros((n_thresholds, n_detections), dtype=bool)
+    ignored = np.zeros((n_thresholds, n_detections), dtype=bool)
+
+    # Sort detections by group, and by decreasing score within each group
+    det_order = np.lexsort((det_ranks, det_groups))  # (n_detections)
+    det_group_ids, det_starts = np.unique(det_groups[det_order], return_index=True)
+    det_ends = np.append(det_starts[1:], n_detections)
+
+    # Sort objects by group, so the objects of any group are a contiguous slice
+    true_order = np.argsort(true_groups, kind='stable')  # (n_objects)
+    true_starts = np.searchsorted(true_groups[true_order], det_group_ids, side='left')
+    true_ends = np.searchsorted(true_groups[true_order], det_group_ids, side='right')
+
+    for g in range(det_group_ids.shape[0]):
+        # If no such object in this image, then all detections of this group are false positives
+        if true_starts[g] == true_ends[g]:
+            continue
+
+        det_ind = det_order[det_starts[g]:det_ends[g]]  # (n_group_detections), in order of decreasing scores
+        true_ind = true_order[true_starts[g]:true_ends[g]]  # (n_group_objects)
+        overlaps = find_jaccard_overlap_np(det_boxes[det_ind], true_boxes[true_ind])  # (n_group_detections, n_group_objects)
+        difficult = true_difficulties[true_ind].astype(bool)  # (n_group_objects)
+
+        if metric == 'voc':
+            # Find the object that each detection overlaps most; it's a match if the overlap is greater than 0.5
+            max_overlap = overlaps.max(axis=1)  # (n_group_detections)
+            matched = overlaps.argmax(axis=1)  # (n_group_detections)
+            is_match = max_overlap > iou_thresholds[0]  # (n_group_detections)
+
+            # If the object it matched with is 'difficult', ignore the detection
+            ignored[0, det_ind] = is_match & difficult[matched]
+
+            # Only the first (highest scoring) detection of an object is a true positive, the rest are duplicates
+            candidates = np.nonzero(is_match & ~difficult[matched])[0]
+            _, first = np.unique(matched[candidates], return_index=True)
+            true_positives[0, det_ind[candidates[first]]] = True
+
+        else:
+            # Detections that don't overlap any object above the lowest threshold are false positives at all thresholds
+            # The rest must be matched one at a time, in order of decreasing scores, since each match uses up an object
+            object_taken = np.zeros((n_thresholds, true_ind.shape[0]), dtype=bool)  # (n_iou_thresholds, n_group_objects)
+            for d in np.nonzero(overlaps.max(axis=1) >= iou_thresholds[0])[0]:
+                # Objects still available at each threshold, with 'difficult' objects able to absorb any detection
+                available = (overlaps[d][None, :] >= iou_thresholds[:, None]) & (
+                        ~object_taken | difficult[None, :])  # (n_iou_thresholds, n_group_objects)
+
+                # Prefer the best-overlapping regular object, and fall back to the best-overlapping 'difficult' one
+                regular_overlaps = np.where(available & ~difficult[None, :], overlaps[d][None, :], -1.)
+                difficult_overlaps = np.where(available & difficult[None, :], overlaps[d][None, :], -1.)
+                has_regular = regular_overlaps.max(axis=1) >= 0  # (n_iou_thresholds)
+                has_difficult = difficult_overlaps.max(axis=1) >= 0  # (n_iou_thresholds)
+
+                true_positives[has_regular, det_ind[d]] = True
+                object_taken[np.nonzero(has_regular)[0], regular_overlaps[has_regular].argmax(axis=1)] = True
+                ignored[~has_regular & has_difficult, det_ind[d]] = True
+
+    return true_positives, ignored
+
+
+def average_precision(true_positives, false_positives, n_easy_objects, recall_thresholds, interpolate):
+    """
+    Average the precisions at a set of recall thresholds.
+
+    :param true_positives: true positive flags in order of decreasing scores, an array of dimensions (n_detections)
+    :param false_positives: false positive flags in order of decreasing scores, an array of dimensions (n_detections)
+    :param n_easy_objects: number of objects that are not 'difficult'
+    :param recall_thresholds: recall thresholds, an array of dimensions (n_recall_thresholds)
+    :param interpolate: if True, use the precision envelope (COCO); otherwise the max precision above each threshold (VOC)
+    :return: average precision, a float
+    """
+    # Compute cumulative precision and recall at each detection in the order of decreasing scores
+    cumul_true_positives = np.cumsum(true_positives, dtype=np.float32)  # (n_detections)
+    cumul_false_positives = np.cumsum(false_positives, dtype=np.float32)  # (n_detections)
+    cumul_precision = cumul_true_positives / (
+            cumul_true_positives + cumul_false_positives + np.float32(1e-10))  # (n_detections)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cumul_recall = cumul_true_positives / np.float32(n_easy_objects)  # (n_detections)
+
+    if interpolate:
+        # Make precision monotonically decreasing, then take it at the first detection reaching each recall threshold
+        envelope = np.maximum.accumulate(cumul_precision[::-1])[::-1]  # (n_detections)
+        ind = np.searchsorted(cumul_recall, recall_thresholds, side='left')  # (n_recall_thresholds)
+        precisions = np.where(ind < envelope.shape[0], envelope[np.minimum(ind, envelope.shape[0] - 1)], 0.)
+    else:
+        # Find the mean of the maximum of the precisions corresponding to recalls above the threshold 't'
+        recalls_above_t = cumul_recall[None, :] >= recall_thresholds[:, None]  # (n_recall_thresholds, n_detections)
+        precisions = np.where(recalls_above_t, cumul_precision[None, :], 0.).max(axis=1)
+
+    return precisions.astype(np.float32).mean(dtype=np.float32)
+
+
+def calculate_mAP(det_boxes, det_labels, det_scores, true_boxes, true_labels, true_difficulties, metric='voc'):
+    """
+    Calculate the Mean Average Precision (mAP) of detected objects.
+
+    See https://medium.com/@jonathan_hui/map-mean-average-precision-for-object-detection-45c121a31173 for an explanation
+
+    :param det_boxes: list of tensors, one tensor for each image containing detected objects' bounding boxes
+    :param det_labels: list of tensors, one tensor for each image containing detected objects' labels
+    :param det_scores: list of tensors, one tensor for each image containing detected objects' labels' scores
+    :param true_boxes: list of tensors, one tensor for each image containing actual objects' bounding boxes
+    :param true_labels: list of tensors, one tensor for each image containing actual objects' labels
+    :param true_difficulties: list of tensors, one tensor for each image containing actual objects' difficulty (0 or 1)
+    :param metric: 'voc' for the 11-point mAP at an IoU of 0.5, or 'coco' for the 101-point mAP@[0.5:0.95]
+    :return: list of average precisions for all classes, mean average precision (mAP)
+    """
+    assert len(det_boxes) == len(det_labels) == len(det_scores) == len(true_boxes) == len(
+        true_labels) == len(
+        true_difficulties)  # these are all lists of tensors of the same length, i.e. number of images
+    assert metric in metric_thresholds
+    n_classes = len(label_map)
+
+    # Store all (true) objects in single continuous arrays while keeping track of the image they are from
+    true_boxes, true_images = to_flat_arrays(true_boxes, np.float32)  # (n_objects, 4), (n_objects)
+    true_labels, _ = to_flat_arrays(true_labels, np.int64)  # (n_objects)
+    true_difficulties, _ = to_flat_arrays(true_difficulties, np.uint8)  # (n_objects)
+
+    # Store all detections in single continuous arrays while keeping track of the image they are from
+    det_boxes, det_images = to_flat_arrays(det_boxes, np.float32)  # (n_detections, 4), (n_detections)
+    det_labels, _ = to_flat_arrays(det_labels, np.int64)  # (n_detections)
+    det_scores, _ = to_flat_arrays(det_scores, np.float32)  # (n_detections)
+
+    assert true_images.shape[0] == true_boxes.shape[0] == true_labels.shape[0]
+    assert det_images.shape[0] == det_boxes.shape[0] == det_labels.shape[0] == det_scores.shape[0]
+
+    # Sort detections by class, and in decreasing order of confidence/scores within each class
+    det_order = np.lexsort((-det_scores, det_labels))  # (n_detections)
+    det_ranks = np.empty_like(det_order)
+    det_ranks[det_order] = np.arange(det_order.shape[0])  # (n_detections)
+
+    # Check if each detection is a true or false positive, for every IoU threshold
+    true_positives, ignored = match_detections(det_boxes, det_images * n_classes + det_labels, det_ranks,
+                                               true_boxes, true_images * n_classes + true_labels, true_difficulties,
+                                               metric)  # (n_iou_thresholds, n_detections)
+    false_positives = ~true_positives & ~ignored
+    true_positives = true_positives[:, det_order]
+    false_positives = false_positives[:, det_order]
+
+    # Calculate APs for each class (except background)
+    class_starts = np.searchsorted(det_labels[det_order], np.arange(n_classes), side='left')
+    class_ends = np.searchsorted(det_labels[det_order], np.arange(n_classes), side='right')
+    average_precisions = np.zeros((n_classes - 1), dtype=np.float32)  # (n_classes - 1)
+    for c in range(1, n_classes):
+        if class_starts[c] == class_ends[c]:
+            continue
+        n_easy_class_objects = ((true_labels == c) & (true_difficulties == 0)).sum()  # ignore difficult objects
+        average_precisions[c - 1] = np.mean([average_precision(tp[class_starts[c]:class_ends[c]],
+                                                               fp[class_starts[c]:class_ends[c]],
+                                                               n_easy_class_objects,
+                                                               metric_thresholds[metric]['recall_thresholds'],
+                                                               interpolate=metric == 'coco')
+                                             for tp, fp in zip(true_positives, false_positives)], dtype=np.float32)
+
+    # Calculate Mean Average Precision (mAP)
+    mean_average_precision = average_precisions.mean(dtype=np.float32).item()
+
+    # Keep class-wise average precisions in a dictionary
+    average_precisions = {rev_label_map[c + 1]: v for c, v in enumerate(average_precisions.tolist())}
+
+    return average_precisions, mean_average_precision
@@ -1,8 +1,11 @@
 from torch import nn
 from utils import *
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 from math import sqrt
 from itertools import product as product
+from functools import lru_cache
+import inspect
 import torchvision
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -13,7 +16,10 @@ class VGGBase(nn.Module):
     VGG base convolutions to produce lower-level feature maps.
     """
 
-    def __init__(self):
+    def __init__(self, pretrained=True):
+        """
+        :param pretrained: initialize with VGG-16 weights pretrained on ImageNet? Not needed if loading a checkpoint
+        """
         super(VGGBase, self).__init__()
 
         # Standard convolutional layers in VGG16
@@ -46,7 +52,8 @@ class VGGBase(nn.Module):
         self.conv7 = nn.Conv2d(1024, 1024, kernel_size=1)
 
         # Load pretrained layers
-        self.load_pretrained_layers()
+        if pretrained:
+            self.load_pretrained_layers()
 
     def forward(self, image):
         """
@@ -325,12 +332,16 @@ class SSD300(nn.Module):
     The SSD300 network - encapsulates the base VGG network, auxiliary, and prediction convolutions.
     """
 
-    def __init__(self, n_classes):
+    def __init__(self, n_classes, pretrained=True):
+        """
+        :param n_classes: number of different types of objects
+        :param pretrained: initialize the base with VGG-16 weights pretrained on ImageNet? Not needed if loading a checkpoint
+        """
         super(SSD300, self).__init__()
 
         self.n_classes = n_classes
 
-        self.base = VGGBase()
+        self.base = VGGBase(pretrained=pretrained)
         self.aux_convs = AuxiliaryConvolutions()
         self.pred_convs = PredictionConvolutions(n_classes)
 
@@ -339,8 +350,13 @@ class SSD300(nn.Module):
         self.rescale_factors = nn.Parameter(torch.FloatTensor(1, 512, 1, 1))  # there are 512 channels in conv4_3_feats
         nn.init.constant_(self.rescale_factors, 20)
 
-        # Prior boxes
-        self.priors_cxcy = self.create_prior_boxes()
+        # Prior boxes, and the terms of decoding w.r.t. them that are the same for every batch
+        # Registered as buffers so they move with the model, but not saved with it, since they are never learned
+        priors_cxcy = self.create_prior_boxes().clone()  # (8732, 4)
+        self.register_buffer('priors_cxcy', priors_cxcy, persistent=False)
+        self.register_buffer('priors_xy', cxcy_to_xy(priors_cxcy), persistent=False)  # (8732, 4)
+        self.register_buffer('priors_center_scales', priors_cxcy[:, 2:] / 10, persistent=False)  # (8732, 2)
+        self.register_buffer('priors_half_sizes', priors_cxcy[:, 2:] / 2, persistent=False)  # (8732, 2)
 
     def forward(self, image):
         """
@@ -368,11 +384,15 @@ class SSD300(nn.Module):
 
         return locs, classes_scores
 
-    def create_prior_boxes(self):
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def create_prior_boxes():
         """
         Create the 8732 prior (default) boxes for the SSD300, as defined in the paper.
 
-        :return: prior boxes in center-size coordinates, a tensor of dimensions (8732, 4)
+        They are the same for every model, so they are only created once, and cached.
+
+        :return: prior boxes in center-size coordinates, a tensor of dimensions (8732, 4), on the CPU
         """
         fmap_dims = {'conv4_3': 38,
                      'conv7': 19,
@@ -400,35 +420,59 @@ class SSD300(nn.Module):
         prior_boxes = []
 
         for k, fmap in enumerate(fmaps):
-            for i in range(fmap_dims[fmap]):
-                for j in range(fmap_dims[fmap]):
-                    cx = (j + 0.5) / fmap_dims[fmap]
-                    cy = (i + 0.5) / fmap_dims[fmap]
-
-                    for ratio in aspect_ratios[fmap]:
-                        prior_boxes.append([cx, cy, obj_scales[fmap] * sqrt(ratio), obj_scales[fmap] / sqrt(ratio)])
-
-                        # For an aspect ratio of 1, use an additional prior whose scale is the geometric mean of the
-                        # scale of the current feature map and the scale of the next feature map
-                        if ratio == 1.:
-                            try:
-                                additional_scale = sqrt(obj_scales[fmap] * obj_scales[fmaps[k + 1]])
-                            # For the last feature map, there is no "next" feature map
-                            except IndexError:
-                                additional_scale = 1.
-                            prior_boxes.append([cx, cy, additional_scale, additional_scale])
-
-        prior_boxes = torch.FloatTensor(prior_boxes).to(device)  # (8732, 4)
+            # For an aspect ratio of 1, use an additional prior whose scale is the geometric mean of the
+            # scale of the current feature map and the scale of the next feature map
+            # For the last feature map, there is no "next" feature map
+            if k + 1 < len(fmaps):
+                additional_scale = sqrt(obj_scales[fmap] * obj_scales[fmaps[k + 1]])
+            else:
+                additional_scale = 1.
+
+            # Sizes of the priors at each position of this feature map
+            sizes = []
+            for ratio in aspect_ratios[fmap]:
+                sizes.append([obj_scales[fmap] * sqrt(ratio), obj_scales[fmap] / sqrt(ratio)])
+                if ratio == 1.:
+                    sizes.append([additional_scale, additional_scale])
+            sizes = torch.DoubleTensor(sizes)  # (n_sizes, 2)
+
+            # Centers of all positions, row by row, each repeated for every size
+            # Computed in double precision, like the Python floats these boxes used to be created from
+            centers = (torch.arange(fmap_dims[fmap], dtype=torch.double) + 0.5) / fmap_dims[fmap]
+            cy, cx = torch.meshgrid(centers, centers, indexing='ij')  # (fmap_dim, fmap_dim)
+            centers = torch.stack([cx, cy], dim=2).view(-1, 1, 2)  # (fmap_dim * fmap_dim, 1, 2)
+
+            prior_boxes.append(torch.cat([centers.expand(-1, sizes.size(0), -1),
+                                          sizes.unsqueeze(0).expand(centers.size(0), -1, -1)],
+                                         dim=2).view(-1, 4))  # (fmap_dim * fmap_dim * n_sizes, 4)
+
+        prior_boxes = torch.cat(prior_boxes, dim=0).float()  # (8732, 4)
         prior_boxes.clamp_(0, 1)  # (8732, 4)
 
         return prior_boxes
 
+    def decode_locs(self, predicted_locs):
+        """
+        Decode locations predicted w.r.t. the prior boxes into boundary coordinates, for a whole batch at once.
+
+        This is 'cxcy_to_xy(gcxgcy_to_cxcy(...))' in one pass, with the terms that only depend on the priors precomputed.
+
+        :param predicted_locs: predicted locations/boxes w.r.t the 8732 prior boxes, a tensor of dimensions (N, 8732, 4)
+        :return: decoded boxes in fractional boundary coordinates, a tensor of dimensions (N, 8732, 4)
+        """
+        centers = torch.addcmul(self.priors_cxcy[:, :2], predicted_locs[..., :2], self.priors_center_scales)  # (N, 8732, 2)
+        half_sizes = torch.exp(predicted_locs[..., 2:] / 5) * self.priors_half_sizes  # (N, 8732, 2)
+        return torch.cat([centers - half_sizes, centers + half_sizes], dim=-1)  # (N, 8732, 4)
+
     def detect_objects(self, predicted_locs, predicted_scores, min_score, max_overlap, top_k):
         """
         Decipher the 8732 locations and class scores (output of ths SSD300) to detect objects.
 
         For each class, perform Non-Maximum Suppression (NMS) on boxes that are above a minimum threshold.
 
+        The whole batch is processed at once - candidate boxes from every image and class are gathered into one tensor
+        and suppressed with a single batched NMS, where each (image, class) pair forms its own group.
+
         :param predicted_locs: predicted locations/boxes w.r.t the 8732 prior boxes, a tensor of dimensions (N, 8732, 4)
         :param predicted_scores: class scores for each of the encoded locations/boxes, a tensor of dimensions (N, 8732, n_classes)
         :param min_score: minimum threshold for a box to be considered a match for a certain class
@@ -440,91 +484,47 @@ class SSD300(nn.Module):
         n_priors = self.priors_cxcy.size(0)
         predicted_scores = F.softmax(predicted_scores, dim=2)  # (N, 8732, n_classes)
 
-        # Lists to store final predicted boxes, labels, and scores for all images
-        all_images_boxes = list()
-        all_images_labels = list()
-        all_images_scores = list()
-
         assert n_priors == predicted_locs.size(1) == predicted_scores.size(1)
 
+        # Decode object coordinates from the form we regressed predicted boxes to, for all images at once
+        decoded_locs = self.decode_locs(predicted_locs)  # (N, 8732, 4), these are fractional pt. coordinates
+
+        # Keep only (image, prior, class) candidates whose scores are above the minimum score, ignoring 'background'
+        image_ind, prior_ind, class_ind = (predicted_scores[:, :, 1:] > min_score).nonzero(as_tuple=True)  # (n_qualified)
+        class_ind = class_ind + 1  # (n_qualified), labels in [1, n_classes - 1]
+        candidate_boxes = decoded_locs[image_ind, prior_ind]  # (n_qualified, 4)
+        candidate_scores = predicted_scores[image_ind, prior_ind, class_ind]  # (n_qualified)
+
+        # Non-Maximum Suppression (NMS) within each (image, class) group
+        # Returned indices are in order of decreasing scores
+        group_ind = image_ind * self.n_classes + class_ind  # (n_qualified)
+        keep = torchvision.ops.batched_nms(candidate_boxes, candidate_scores, group_ind, max_overlap)  # (n_kept)
+
+        # Order the kept boxes by image, then by class, then by decreasing score, as the per-class NMS would
+        _, order = group_ind[keep].sort(stable=True)
+        keep = keep[order]  # (n_kept)
+        n_kept_per_image = torch.bincount(image_ind[keep], minlength=batch_size).tolist()  # N ints
+
+        # Lists to store final predicted boxes, labels, and scores for all images
+        all_images_boxes = list(candidate_boxes[keep].split(n_kept_per_image))
+        all_images_labels = list(class_ind[keep].split(n_kept_per_image))
+        all_images_scores = list(candidate_scores[keep].split(n_kept_per_image))
+
         for i in range(batch_size):
-            # Decode object coordinates from the form we regressed predicted boxes to
-            decoded_locs = cxcy_to_xy(
-                gcxgcy_to_cxcy(predicted_locs[i], self.priors_cxcy))  # (8732, 4), these are fractional pt. coordinates
-
-            # Lists to store boxes and scores for this image
-            image_boxes = list()
-            image_labels = list()
-            image_scores = list()
-
-            max_scores, best_label = predicted_scores[i].max(dim=1)  # (8732)
-
-            # Check for each class
-            for c in range(1, self.n_classes):
-                # Keep only predicted boxes and scores where scores for this class are above the minimum score
-                class_scores = predicted_scores[i][:, c]  # (8732)
-                score_above_min_score = class_scores > min_score  # torch.uint8 (byte) tensor, for indexing
-                n_above_min_score = score_above_min_score.sum().item()
-                if n_above_min_score == 0:
-                    continue
-                class_scores = class_scores[score_above_min_score]  # (n_qualified), n_min_score <= 8732
-                class_decoded_locs = decoded_locs[score_above_min_score]  # (n_qualified, 4)
-
-                # Sort predicted boxes and scores by scores
-                class_scores, sort_ind = class_scores.sort(dim=0, descending=True)  # (n_qualified), (n_min_score)
-                class_decoded_locs = class_decoded_locs[sort_ind]  # (n_min_score, 4)
-
-                # Find the overlap between predicted boxes
-                overlap = find_jaccard_overlap(class_decoded_locs, class_decoded_locs)  # (n_qualified, n_min_score)
-
-                # Non-Maximum Suppression (NMS)
-
-                # A torch.uint8 (byte) tensor to keep track of which predicted boxes to suppress
-                # 1 implies suppress, 0 implies don't suppress
-                suppress = torch.zeros((n_above_min_score), dtype=torch.uint8).to(device)  # (n_qualified)
-
-                # Consider each box in order of decreasing scores
-                for box in range(class_decoded_locs.size(0)):
-                    # If this box is already marked for suppression
-                    if suppress[box] == 1:
-                        continue
-
-                    # Suppress boxes whose overlaps (with this box) are greater than maximum overlap
-                    # Find such boxes and update suppress indices
-                    suppress = torch.max(suppress, overlap[box] > max_overlap)
-                    # The max operation retains previously suppressed boxes, like an 'OR' operation
-
-                    # Don't suppress this box, even though it has an overlap of 1 with itself
-                    suppress[box] = 0
-
-                # Store only unsuppressed boxes for this class
-                image_boxes.append(class_decoded_locs[1 - suppress])
-                image_labels.append(torch.LongTensor((1 - suppress).sum().item() * [c]).to(device))
-                image_scores.append(class_scores[1 - suppress])
+            n_objects = n_kept_per_image[i]
 
             # If no object in any class is found, store a placeholder for 'background'
-            if len(image_boxes) == 0:
-                image_boxes.append(torch.FloatTensor([[0., 0., 1., 1.]]).to(device))
-                image_labels.append(torch.LongTensor([0]).to(device))
-                image_scores.append(torch.FloatTensor([0.]).to(device))
-
-            # Concatenate into single tensors
-            image_boxes = torch.cat(image_boxes, dim=0)  # (n_objects, 4)
-            image_labels = torch.cat(image_labels, dim=0)  # (n_objects)
-            image_scores = torch.cat(image_scores, dim=0)  # (n_objects)
-            n_objects = image_scores.size(0)
+            if n_objects == 0:
+                all_images_boxes[i] = torch.FloatTensor([[0., 0., 1., 1.]]).to(device)
+                all_images_labels[i] = torch.LongTensor([0]).to(device)
+                all_images_scores[i] = torch.FloatTensor([0.]).to(device)
 
             # Keep only the top k objects
-            if n_objects > top_k:
-                image_scores, sort_ind = image_scores.sort(dim=0, descending=True)
-                image_scores = image_scores[:top_k]  # (top_k)
-                image_boxes = image_boxes[sort_ind][:top_k]  # (top_k, 4)
-                image_labels = image_labels[sort_ind][:top_k]  # (top_k)
-
-            # Append to lists that store predicted boxes and scores for all images
-            all_images_boxes.append(image_boxes)
-            all_images_labels.append(image_labels)
-            all_images_scores.append(image_scores)
+            elif n_objects > top_k:
+                image_scores, sort_ind = all_images_scores[i].sort(dim=0, descending=True)
+                all_images_scores[i] = image_scores[:top_k]  # (top_k)
+                all_images_boxes[i] = all_images_boxes[i][sort_ind][:top_k]  # (top_k, 4)
+                all_images_labels[i] = all_images_labels[i][sort_ind][:top_k]  # (top_k)
 
         return all_images_boxes, all_images_labels, all_images_scores  # lists of length batch_size
 
@@ -540,8 +540,10 @@ class MultiBoxLoss(nn.Module):
 
     def __init__(self, priors_cxcy, threshold=0.5, neg_pos_ratio=3, alpha=1.):
         super(MultiBoxLoss, self).__init__()
-        self.priors_cxcy = priors_cxcy
-        self.priors_xy = cxcy_to_xy(priors_cxcy)
+        self.register_buffer('priors_cxcy', priors_cxcy, persistent=False)
+        self.register_buffer('priors_xy', cxcy_to_xy(priors_cxcy), persistent=False)
+        self.register_buffer('hardness_ranks', torch.arange(priors_cxcy.size(0), device=priors_cxcy.device).unsqueeze(0),
+                             persistent=False)  # (1, 8732)
         self.threshold = threshold
         self.neg_pos_ratio = neg_pos_ratio
         self.alpha = alpha
@@ -565,43 +567,47 @@ class MultiBoxLoss(nn.Module):
 
         assert n_priors == predicted_locs.size(1) == predicted_scores.size(1)
 
-        true_locs = torch.zeros((batch_size, n_priors, 4), dtype=torch.float).to(device)  # (N, 8732, 4)
-        true_classes = torch.zeros((batch_size, n_priors), dtype=torch.long).to(device)  # (N, 8732)
+        # Pad the true boxes and labels of all images into single tensors, and keep track of which entries are real
+        true_boxes = pad_sequence(boxes, batch_first=True)  # (N, n_max_objects, 4)
+        true_labels = pad_sequence(labels, batch_first=True)  # (N, n_max_objects)
+        max_objects = true_boxes.size(1)
+        n_objects = torch.LongTensor([b.size(0) for b in boxes]).to(device)  # (N)
+        object_mask = torch.arange(max_objects, device=device).unsqueeze(0) < n_objects.unsqueeze(1)  # (N, n_max_objects)
 
-        # For each image
-        for i in range(batch_size):
-            n_objects = boxes[i].size(0)
-
-            overlap = find_jaccard_overlap(boxes[i],
-                                           self.priors_xy)  # (n_objects, 8732)
+        image_ind, object_ind = object_mask.nonzero(as_tuple=True)  # (n_objects_total)
 
-            # For each prior, find the object that has the maximum overlap
-            overlap_for_each_prior, object_for_each_prior = overlap.max(dim=0)  # (8732)
+        # Overlaps of every object in every image with the priors, computed in one pass over the real objects only
+        # Padding objects get an overlap of -1, so they are never matched
+        overlap = torch.full((batch_size, max_objects, n_priors), -1., dtype=torch.float).to(device)  # (N, n_max_objects, 8732)
+        overlap[image_ind, object_ind] = find_jaccard_overlap(torch.cat(boxes, dim=0),
+                                                              self.priors_xy)  # (n_objects_total, 8732)
 
-            # We don't want a situation where an object is not represented in our positive (non-background) priors -
-            # 1. An object might not be the best object for all priors, and is therefore not in object_for_each_prior.
-            # 2. All priors with the object may be assigned as background based on the threshold (0.5).
+        # For each prior, find the object that has the maximum overlap
+        overlap_for_each_prior, object_for_each_prior = overlap.max(dim=1)  # (N, 8732)
 
-            # To remedy this -
-            # First, find the prior that has the maximum overlap for each object.
-            _, prior_for_each_object = overlap.max(dim=1)  # (N_o)
+        # We don't want a situation where an object is not represented in our positive (non-background) priors -
+        # 1. An object might not be the best object for all priors, and is therefore not in object_for_each_prior.
+        # 2. All priors with the object may be assigned as background based on the threshold (0.5).
 
-            # Then, assign each object to the corresponding maximum-overlap-prior. (This fixes 1.)
-            object_for_each_prior[prior_for_each_object] = torch.LongTensor(range(n_objects)).to(device)
+        # To remedy this -
+        # First, find the prior that has the maximum overlap for each object.
+        _, prior_for_each_object = overlap.max(dim=2)  # (N, n_max_objects)
+        prior_ind = prior_for_each_object[image_ind, object_ind]  # (n_objects_total)
 
-            # To ensure these priors qualify, artificially give them an overlap of greater than 0.5. (This fixes 2.)
-            overlap_for_each_prior[prior_for_each_object] = 1.
+        # Then, assign each object to the corresponding maximum-overlap-prior. (This fixes 1.)
+        object_for_each_prior[image_ind, prior_ind] = object_ind
 
-            # Labels for each prior
-            label_for_each_prior = labels[i][object_for_each_prior]  # (8732)
-            # Set priors whose overlaps with objects are less than the threshold to be background (no object)
-            label_for_each_prior[overlap_for_each_prior < self.threshold] = 0  # (8732)
+        # To ensure these priors qualify, artificially give them an overlap of greater than 0.5. (This fixes 2.)
+        overlap_for_each_prior[image_ind, prior_ind] = 1.
 
-            # Store
-            true_classes[i] = label_for_each_prior
+        # Labels for each prior
+        true_classes = true_labels.gather(1, object_for_each_prior)  # (N, 8732)
+        # Set priors whose overlaps with objects are less than the threshold to be background (no object)
+        true_classes[overlap_for_each_prior < self.threshold] = 0  # (N, 8732)
 
-            # Encode center-size object coordinates into the form we regressed predicted boxes to
-            true_locs[i] = cxcy_to_gcxgcy(xy_to_cxcy(boxes[i][object_for_each_prior]), self.priors_cxcy)  # (8732, 4)
+        # Encode center-size object coordinates into the form we regressed predicted boxes to
+        matched_boxes = true_boxes.gather(1, object_for_each_prior.unsqueeze(2).expand(-1, -1, 4))  # (N, 8732, 4)
+        true_locs = cxcy_to_gcxgcy(xy_to_cxcy(matched_boxes), self.priors_cxcy)  # (N, 8732, 4)
 
         # Identify priors that are positive (object/non-background)
         positive_priors = true_classes != 0  # (N, 8732)
@@ -637,8 +643,7 @@ class MultiBoxLoss(nn.Module):
         conf_loss_neg = conf_loss_all.clone()  # (N, 8732)
         conf_loss_neg[positive_priors] = 0.  # (N, 8732), positive priors are ignored (never in top n_hard_negatives)
         conf_loss_neg, _ = conf_loss_neg.sort(dim=1, descending=True)  # (N, 8732), sorted by decreasing hardness
-        hardness_ranks = torch.LongTensor(range(n_priors)).unsqueeze(0).expand_as(conf_loss_neg).to(device)  # (N, 8732)
-        hard_negatives = hardness_ranks < n_hard_negatives.unsqueeze(1)  # (N, 8732)
+        hard_negatives = self.hardness_ranks < n_hard_negatives.unsqueeze(1)  # (N, 8732)
         conf_loss_hard_neg = conf_loss_neg[hard_negatives]  # (sum(n_hard_negatives))
 
         # As in the paper, averaged over positive priors only, although computed over both positive and hard-negative priors
@@ -647,3 +652,30 @@ class MultiBoxLoss(nn.Module):
         # TOTAL LOSS
 
         return conf_loss + self.alpha * loc_loss
+
+
+def load_checkpoint(checkpoint_path, map_location=None):
+    """
+    Load a checkpoint saved during training, and rebuild the SSD300 in it.
+
+    Checkpoints hold state dicts of the model and optimizer (see 'save_checkpoint' in utils.py), but older ones pickled
+    the model and optimizer objects themselves. Both are accepted.
+
+    :param checkpoint_path: path to the checkpoint
+    :param map_location: device to load tensors onto
+    :return: the checkpoint, a dict, with the model under 'model' as an SSD300
+    """
+    # Older checkpoints are whole pickled objects, which can't be loaded with weights_only (torch>=1.13)
+    kwargs = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+    checkpoint = torch.load(checkpoint_path, map_location=map_location, **kwargs)
+
+    # Pickled models are rebuilt too, so they pick up changes to the class, e.g. new buffers
+    state_dict = checkpoint['model']
+    if isinstance(state_dict, nn.Module):
+        checkpoint['n_classes'] = state_dict.n_classes
+        state_dict = state_dict.state_dict()
+    model = SSD300(n_classes=checkpoint['n_classes'], pretrained=False)
+    model.load_state_dict(state_dict)
+    checkpoint['model'] = model.to(map_location) if map_location is not None else model
+
+    return checkpoint
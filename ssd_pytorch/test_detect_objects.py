@@ -0,0 +1,125 @@
+"""
+Parity test of the batched SSD300.detect_objects against the original per-image, per-class greedy NMS loop.
+
+Run from the repository root or from ssd_pytorch with: python -m pytest ssd_pytorch/test_detect_objects.py
+"""
+import os
+import sys
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))  # flat imports, as the scripts in this directory use
+
+from model import SSD300, device  # noqa: E402
+from utils import cxcy_to_xy, find_jaccard_overlap, gcxgcy_to_cxcy  # noqa: E402
+
+
+def detect_objects_reference(model, predicted_locs, predicted_scores, min_score, max_overlap, top_k):
+    """
+    The original detect_objects, one image and one class at a time with a greedy NMS loop, kept as the reference.
+
+    Only the deprecated uint8 mask indexing has been replaced by bool masks, which select the same boxes.
+    """
+    batch_size = predicted_locs.size(0)
+    predicted_scores = F.softmax(predicted_scores, dim=2)  # (N, 8732, n_classes)
+
+    all_images_boxes = list()
+    all_images_labels = list()
+    all_images_scores = list()
+
+    for i in range(batch_size):
+        decoded_locs = cxcy_to_xy(gcxgcy_to_cxcy(predicted_locs[i], model.priors_cxcy))  # (8732, 4)
+
+        image_boxes = list()
+        image_labels = list()
+        image_scores = list()
+
+        for c in range(1, model.n_classes):
+            class_scores = predicted_scores[i][:, c]  # (8732)
+            score_above_min_score = class_scores > min_score
+            n_above_min_score = score_above_min_score.sum().item()
+            if n_above_min_score == 0:
+                continue
+            class_scores = class_scores[score_above_min_score]  # (n_qualified)
+            class_decoded_locs = decoded_locs[score_above_min_score]  # (n_qualified, 4)
+
+            class_scores, sort_ind = class_scores.sort(dim=0, descending=True)  # (n_qualified)
+            class_decoded_locs = class_decoded_locs[sort_ind]  # (n_qualified, 4)
+
+            overlap = find_jaccard_overlap(class_decoded_locs, class_decoded_locs)  # (n_qualified, n_qualified)
+
+            suppress = torch.zeros(n_above_min_score, dtype=torch.bool, device=predicted_locs.device)
+            for box in range(class_decoded_locs.size(0)):
+                if suppress[box]:
+                    continue
+                suppress = suppress | (overlap[box] > max_overlap)
+                suppress[box] = False
+
+            image_boxes.append(class_decoded_locs[~suppress])
+            image_labels.append(torch.full(((~suppress).sum().item(),), c, dtype=torch.long, device=device))
+            image_scores.append(class_scores[~suppress])
+
+        if len(image_boxes) == 0:
+            image_boxes.append(torch.FloatTensor([[0., 0., 1., 1.]]).to(device))
+            image_labels.append(torch.LongTensor([0]).to(device))
+            image_scores.append(torch.FloatTensor([0.]).to(device))
+
+        image_boxes = torch.cat(image_boxes, dim=0)  # (n_objects, 4)
+        image_labels = torch.cat(image_labels, dim=0)  # (n_objects)
+        image_scores = torch.cat(image_scores, dim=0)  # (n_objects)
+
+        if image_scores.size(0) > top_k:
+            image_scores, sort_ind = image_scores.sort(dim=0, descending=True)
+            image_scores = image_scores[:top_k]  # (top_k)
+            image_boxes = image_boxes[sort_ind][:top_k]  # (top_k, 4)
+            image_labels = image_labels[sort_ind][:top_k]  # (top_k)
+
+        all_images_boxes.append(image_boxes)
+        all_images_labels.append(image_labels)
+        all_images_scores.append(image_scores)
+
+    return all_images_boxes, all_images_labels, all_images_scores
+
+
+@pytest.fixture(scope='module')
+def model():
+    return SSD300(n_classes=7, pretrained=False).to(device).eval()  # 6 Lego classes and background
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('min_score, max_overlap, top_k', [(0.2, 0.45, 200),  # detect.py, detect_webcam.py
+                                                           (0.01, 0.45, 200),  # eval.py
+                                                           (0.2, 0.45, 10)])  # top k cut
+def test_detect_objects_parity(model, seed, min_score, max_overlap, top_k):
+    torch.manual_seed(seed)
+    n_priors = model.priors_cxcy.size(0)
+    predicted_locs = torch.randn(4, n_priors, 4, device=device) * 0.5  # (N, 8732, 4)
+    predicted_scores = torch.randn(4, n_priors, model.n_classes, device=device) * 3  # (N, 8732, n_classes)
+
+    with torch.no_grad():
+        boxes, labels, scores = model.detect_objects(predicted_locs, predicted_scores, min_score, max_overlap, top_k)
+        ref_boxes, ref_labels, ref_scores = detect_objects_reference(model, predicted_locs, predicted_scores,
+                                                                     min_score, max_overlap, top_k)
+
+    assert len(boxes) == len(labels) == len(scores) == len(ref_boxes)
+    for i in range(len(ref_boxes)):
+        # Compare in a canonical order, by label and then decreasing score (scores are in [0, 1])
+        order, ref_order = (torch.argsort(y.double() * 10 - x.double()) for x, y in
+                            ((scores[i], labels[i]), (ref_scores[i], ref_labels[i])))
+        assert torch.equal(labels[i][order], ref_labels[i][ref_order])
+        assert torch.allclose(scores[i][order], ref_scores[i][ref_order])
+        assert torch.allclose(boxes[i][order], ref_boxes[i][ref_order], atol=1e-5)
+
+
+def test_detect_objects_no_objects(model):
+    n_priors = model.priors_cxcy.size(0)
+    predicted_locs = torch.zeros(2, n_priors, 4, device=device)
+    predicted_scores = torch.zeros(2, n_priors, model.n_classes, device=device)  # uniform 1/7 scores
+
+    boxes, labels, scores = model.detect_objects(predicted_locs, predicted_scores, 0.2, 0.45, 200)
+    ref_boxes, ref_labels, ref_scores = detect_objects_reference(model, predicted_locs, predicted_scores, 0.2, 0.45,
+                                                                 200)
+    for x, y in zip(boxes + labels + scores, ref_boxes + ref_labels + ref_scores):
+        assert torch.equal(x, y)  # background placeholders
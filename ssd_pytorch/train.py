@@ -2,13 +2,14 @@ import time
 import torch.backends.cudnn as cudnn
 import torch.optim
 import torch.utils.data
-from model import SSD300, MultiBoxLoss
-from datasets import PascalVOCDataset
+from model import SSD300, MultiBoxLoss, load_checkpoint
+from datasets import PascalVOCDataset, ResumableRandomSampler
 from utils import *
 
 # Data parameters
 data_folder = './data'  # folder with data files
 keep_difficult = True  # use objects considered difficult to detect?
+batch_augment = False  # augment whole batches on the device with 'batch_transform', instead of each image in the DataLoader workers?
 
 # Model parameters
 n_classes = len(label_map)  # number of different types of objects
@@ -23,9 +24,11 @@ else:
 
 # Learning parameters
 batch_size = 16  # batch size
-iterations = 120000  # number of iterations to train
+accumulation_steps = 1  # accumulate gradients over this many batches per iteration, for an effective batch size of batch_size * accumulation_steps
+iterations = 120000  # number of iterations (optimizer steps) to train
 workers = 4  # number of workers for loading data in the DataLoader
 print_freq = 200  # print training status every __ batches
+checkpoint_freq = 1000  # save a checkpoint every __ iterations, as well as at the end of each epoch
 lr = 1e-3  # learning rate
 #lr = 0.00001
 decay_lr_at = [80000, 100000]  # decay learning rate after these iterations
@@ -33,6 +36,12 @@ decay_lr_to = 0.1  # decay learning rate to this fraction of the existing learni
 momentum = 0.9  # momentum
 weight_decay = 5e-4  # weight decay
 grad_clip = None  # clip if gradients are exploding, which may happen at larger batch sizes (sometimes at 32) - you will recognize it by a sorting error in the MuliBox loss calculation
+seed = 0  # random seed for the order of training data, so it can be resumed mid-epoch
+
+# Performance parameters
+amp = False  # run the forward prop. in mixed precision with autocast?
+amp_dtype = torch.bfloat16  # lower precision type for autocast - bfloat16 on CPU, bfloat16 or float16 on GPU
+channels_last = True  # store images and weights in channels-last memory format, which convolutions run faster in
 
 cudnn.benchmark = True
 
@@ -41,74 +50,112 @@ def main():
     """
     Training.
     """
-    global start_epoch, label_map, epoch, checkpoint, decay_lr_at
-
-    # Initialize model or load checkpoint
-    if checkpoint is None:
-        start_epoch = 0
-        model = SSD300(n_classes=n_classes)
-        # Initialize the optimizer, with twice the default learning rate for biases, as in the original Caffe repo
-        biases = list()
-        not_biases = list()
-        for param_name, param in model.named_parameters():
-            if param.requires_grad:
-                if param_name.endswith('.bias'):
-                    biases.append(param)
-                else:
-                    not_biases.append(param)
-        optimizer = torch.optim.SGD(params=[{'params': biases, 'lr': 2 * lr}, {'params': not_biases}],
-                                    lr=lr, momentum=momentum, weight_decay=weight_decay)
-
+    global checkpoint
+
+    # Initialize model and optimizer
+    model = SSD300(n_classes=n_classes, pretrained=checkpoint is None)
+    # Initialize the optimizer, with twice the default learning rate for biases, as in the original Caffe repo
+    biases = list()
+    not_biases = list()
+    for param_name, param in model.named_parameters():
+        if param.requires_grad:
+            if param_name.endswith('.bias'):
+                biases.append(param)
+            else:
+                not_biases.append(param)
+    optimizer = torch.optim.SGD(params=[{'params': biases, 'lr': 2 * lr}, {'params': not_biases}],
+                                lr=lr, momentum=momentum, weight_decay=weight_decay)
+
+    # Scale the loss when training in float16, so small gradients don't underflow - bfloat16 doesn't need it
+    if hasattr(torch.amp, 'GradScaler'):  # torch>=2.3
+        scaler = torch.amp.GradScaler(device.type, enabled=amp and amp_dtype == torch.float16)
     else:
-        checkpoint = torch.load(checkpoint)
-        start_epoch = checkpoint['epoch'] + 1
-        print('\nLoaded checkpoint from epoch %d.\n' % start_epoch)
-        model = checkpoint['model']
-        optimizer = checkpoint['optimizer']
+        scaler = torch.cuda.amp.GradScaler(enabled=amp and amp_dtype == torch.float16 and device.type == 'cuda')
+
+    # Custom dataloaders
+    train_dataset = PascalVOCDataset(data_folder,
+                                     split='train',
+                                     keep_difficult=keep_difficult,
+                                     batch_augment=batch_augment)
+    sampler = ResumableRandomSampler(train_dataset, seed=seed)
+    start_epoch, start_batch, iteration = 0, 0, 0
+
+    # Load checkpoint, if any
+    if checkpoint is not None:
+        checkpoint = load_checkpoint(checkpoint, map_location='cpu')
+        model.load_state_dict(checkpoint['model'].state_dict())
+        optimizer_state = checkpoint['optimizer']
+        if isinstance(optimizer_state, torch.optim.Optimizer):
+            optimizer_state = optimizer_state.state_dict()
+        optimizer.load_state_dict(optimizer_state)
+        if checkpoint.get('iteration') is not None:
+            # Resume where training stopped, which may be in the middle of an epoch
+            start_epoch, start_batch, iteration = checkpoint['epoch'], checkpoint['batch'], checkpoint['iteration']
+            if 'sampler' in checkpoint:
+                sampler.load_state_dict(checkpoint['sampler'])
+            if checkpoint.get('scaler'):
+                scaler.load_state_dict(checkpoint['scaler'])
+        else:
+            # Older checkpoints are saved at the end of an epoch, and don't count iterations
+            start_epoch = checkpoint['epoch'] + 1
+            iteration = start_epoch * (len(train_dataset) // (batch_size * accumulation_steps))
+        print('\nLoaded checkpoint from epoch %d, iteration %d.\n' % (start_epoch, iteration))
+        del checkpoint
 
     # Move to default device
     model = model.to(device)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    # Optimizer state was loaded onto the CPU, move it to the parameters' device
+    for state in optimizer.state.values():
+        for k, v in state.items():
+            if torch.is_tensor(v):
+                state[k] = v.to(device)
     criterion = MultiBoxLoss(priors_cxcy=model.priors_cxcy).to(device)
 
-    # Custom dataloaders
-    train_dataset = PascalVOCDataset(data_folder,
-                                     split='train',
-                                     keep_difficult=keep_difficult)
-    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True,
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, sampler=sampler,
                                                collate_fn=train_dataset.collate_fn, num_workers=workers,
-                                               pin_memory=True)  # note that we're passing the collate function here
-
-    epochs = iterations // (len(train_dataset) // batch_size)
+                                               pin_memory=True,
+                                               persistent_workers=workers > 0)  # note that we're passing the collate function here
 
     print("LR is: ", lr)
-           
-    # Epochs
-    for epoch in range(start_epoch, epochs):
 
-        # Decay learning rate at particular epochs
-        if epoch in decay_lr_at:
-            adjust_learning_rate(optimizer, decay_lr_to)
+    # Epochs, until the number of iterations is reached
+    epoch = start_epoch
+    while iteration < iterations:
+        # Skip the batches of this epoch that were done before a restart
+        sampler.set_epoch(epoch, start=start_batch * batch_size)
 
         # One epoch's training
-        train(train_loader=train_loader,
-              model=model,
-              criterion=criterion,
-              optimizer=optimizer,
-              epoch=epoch)
+        iteration = train(train_loader=train_loader,
+                          model=model,
+                          criterion=criterion,
+                          optimizer=optimizer,
+                          scaler=scaler,
+                          epoch=epoch,
+                          iteration=iteration,
+                          start_batch=start_batch)
 
-        # Save checkpoint
-        save_checkpoint(epoch, model, optimizer)
+        epoch += 1
+        start_batch = 0
 
 
-def train(train_loader, model, criterion, optimizer, epoch):
+def train(train_loader, model, criterion, optimizer, scaler, epoch, iteration, start_batch=0):
     """
     One epoch's training.
 
+    Each iteration accumulates gradients over 'accumulation_steps' batches before updating the model. The learning rate
+    is decayed, and checkpoints saved, by iteration.
+
     :param train_loader: DataLoader for training data
     :param model: model
     :param criterion: MultiBox loss
     :param optimizer: optimizer
+    :param scaler: gradient scaler for mixed precision
     :param epoch: epoch number
+    :param iteration: number of iterations done before this epoch
+    :param start_batch: number of batches of this epoch done before a restart, which train_loader skips
+    :return: number of iterations done after this epoch, which ends early once 'iterations' are done
     """
     model.train()  # training mode enables dropout
 
@@ -116,35 +163,61 @@ def train(train_loader, model, criterion, optimizer, epoch):
     data_time = AverageMeter()  # data loading time
     losses = AverageMeter()  # loss
 
+    n_batches = start_batch + len(train_loader)
     start = time.time()
 
+    optimizer.zero_grad(set_to_none=True)
+
     # Batches
-    for i, (images, boxes, labels, _) in enumerate(train_loader):
+    for i, (images, boxes, labels, difficulties, *original_sizes) in enumerate(train_loader, start=start_batch):
         data_time.update(time.time() - start)
 
         # Move to default device
-        images = images.to(device)  # (batch_size (N), 3, 300, 300)
+        images = images.to(device, non_blocking=True)  # (batch_size (N), 3, 300, 300), or the dataset dims if batch_augment
         boxes = [b.to(device) for b in boxes]
         labels = [l.to(device) for l in labels]
 
-        # Forward prop.
-        predicted_locs, predicted_scores = model(images)  # (N, 8732, 4), (N, 8732, n_classes)
+        # Augment the whole batch at once, if the dataset left it to us
+        if batch_augment:
+            images, boxes, labels, _ = batch_transform(images, boxes, labels, difficulties, *original_sizes)
 
-        # Loss
-        loss = criterion(predicted_locs, predicted_scores, boxes, labels)  # scalar
+        if channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
 
-        # Backward prop.
-        optimizer.zero_grad()
-        loss.backward()
+        # Forward prop., in mixed precision if enabled
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp):
+            predicted_locs, predicted_scores = model(images)  # (N, 8732, 4), (N, 8732, n_classes)
 
-        # Clip gradients, if necessary
-        if grad_clip is not None:
-            clip_gradient(optimizer, grad_clip)
+        # Loss, in full precision - the hard negative mining sorts losses, which needs the precision
+        loss = criterion(predicted_locs.float(), predicted_scores.float(), boxes, labels)  # scalar
 
-        # Update model
-        optimizer.step()
+        # Backward prop., averaging gradients over the accumulated batches - fewer in the last window of the epoch
+        window_start = i - i % accumulation_steps
+        scaler.scale(loss / min(accumulation_steps, n_batches - window_start)).backward()
 
         losses.update(loss.item(), images.size(0))
+
+        # Update model once enough batches are accumulated, or at the end of the epoch
+        if (i + 1) % accumulation_steps == 0 or i + 1 == n_batches:
+            # Clip gradients, if necessary
+            if grad_clip is not None:
+                scaler.unscale_(optimizer)
+                clip_gradient(optimizer, grad_clip)
+
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+            iteration += 1
+
+            # Decay learning rate at particular iterations
+            if iteration in decay_lr_at:
+                adjust_learning_rate(optimizer, decay_lr_to)
+
+            # Save checkpoint, from which training resumes after this batch
+            if iteration % checkpoint_freq == 0 and i + 1 < n_batches:
+                save_checkpoint(epoch, model, optimizer, iteration=iteration, batch=i + 1,
+                                sampler=train_loader.sampler, scaler=scaler)
+
         batch_time.update(time.time() - start)
 
         start = time.time()
@@ -152,13 +225,26 @@ def train(train_loader, model, criterion, optimizer, epoch):
         # Print status
         if i % print_freq == 0:
             print('Epoch: [{0}][{1}/{2}]\t'
+                  'Iteration {3}\t'
                   'Batch Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Data Time {data_time.val:.3f} ({data_time.avg:.3f})\t'
-                  'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(epoch, i, len(train_loader),
+                  'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(epoch, i, n_batches, iteration,
                                                                   batch_time=batch_time,
                                                                   data_time=data_time, loss=losses))
+
+        if iteration >= iterations:
+            break
     del predicted_locs, predicted_scores, images, boxes, labels  # free some memory since their histories may be stored
 
+    # Save checkpoint, from which training resumes after the last batch - or at the start of the next epoch
+    if i + 1 < n_batches:
+        save_checkpoint(epoch, model, optimizer, iteration=iteration, batch=i + 1,
+                        sampler=train_loader.sampler, scaler=scaler)
+    else:
+        save_checkpoint(epoch + 1, model, optimizer, iteration=iteration, sampler=train_loader.sampler, scaler=scaler)
+
+    return iteration
+
 
 if __name__ == '__main__':
     main()
@@ -1,9 +1,13 @@
 import json
+import multiprocessing
 import os
+import numpy as np
 import torch
 import random
 import xml.etree.ElementTree as ET
+import torch.nn.functional as F
 import torchvision.transforms.functional as FT
+from torch.nn.utils.rnn import pad_sequence
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -51,18 +55,66 @@ def parse_annotation(annotation_path):
 
 
 
-def create_data_lists(train_path, test_path, output_folder):
+def parse_annotations(annotation_paths, manifest=None, workers=None):
+    """
+    Parse many annotation XML files in a process pool, skipping the ones that haven't changed since they were last parsed.
+
+    A file is considered unchanged if its modification time and size match those recorded in the manifest.
+
+    :param annotation_paths: list of paths to annotation XML files
+    :param manifest: dictionary of previously parsed annotations keyed by path, updated in place; None to parse all files
+    :param workers: number of processes to parse with; None for one per CPU, 1 to parse in this process
+    :return: list of parsed annotations (see 'parse_annotation'), number of files that had to be parsed
+    """
+    if manifest is None:
+        manifest = dict()
+
+    # Find new or changed files
+    stats = dict()
+    for path in annotation_paths:
+        stat = os.stat(path)
+        stats[path] = [stat.st_mtime_ns, stat.st_size]
+    stale = [path for path in stats if path not in manifest or manifest[path]['stat'] != stats[path]]
+
+    # Parse them
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(stale) < 100:
+        parsed = [parse_annotation(path) for path in stale]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            parsed = pool.map(parse_annotation, stale, chunksize=max(1, min(64, len(stale) // (4 * workers))))
+
+    for path, objects in zip(stale, parsed):
+        manifest[path] = {'stat': stats[path], 'objects': objects}
+
+    return [manifest[path]['objects'] for path in annotation_paths], len(stale)
+
+
+def create_data_lists(train_path, test_path, output_folder, workers=None, incremental=True):
     """
     Create lists of images, the bounding boxes and labels of the objects in these images, and save these to file.
 
+    Annotations are parsed in parallel, and a manifest of parsed annotations is kept in the output folder so that
+    later runs only parse the annotation files that were added or changed since, e.g. by a new batch of renders.
+
     :param train_path: path to the 'data/Train' folder
     :param test_path: path to the 'data/Test' folder
     :param output_folder: folder where the JSONs must be saved
+    :param workers: number of processes to parse annotations with; None for one per CPU
+    :param incremental: reuse the annotations in the manifest that haven't changed? If False, parse all of them again
     """
     
     train_path = os.path.abspath(train_path)
     test_path = os.path.abspath(test_path)
 
+    # Load the annotations parsed by previous runs
+    manifest_path = os.path.join(output_folder, 'annotations_manifest.json')
+    manifest = dict()
+    if incremental and os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as j:
+            manifest = json.load(j)
+    annotation_paths = list()
+
     train_images = list()
     train_objects = list()
     n_objects = 0
@@ -74,12 +126,15 @@ def create_data_lists(train_path, test_path, output_folder):
         with open(os.path.join(path, 'trainval.txt')) as f:
             ids = f.read().splitlines()
 
-        for id in ids:
-            # Parse annotation's XML file
-            objects = parse_annotation(os.path.join(path, 'Annotations', id + '.xml'))
+        # Parse annotations' XML files
+        paths = [os.path.join(path, 'Annotations', id + '.xml') for id in ids]
+        annotations, n_parsed = parse_annotations(paths, manifest=manifest, workers=workers)
+        annotation_paths.extend(paths)
+
+        for id, objects in zip(ids, annotations):
             if len(objects['boxes']) == 0:
                 continue
-            n_objects += len(objects)
+            n_objects += len(objects['boxes'])
             train_objects.append(objects)
             train_images.append(os.path.join(path, 'JPEGImages', id + '.jpg'))
 
@@ -92,9 +147,11 @@ def create_data_lists(train_path, test_path, output_folder):
         json.dump(train_objects, j)
     with open(os.path.join(output_folder, 'label_map.json'), 'w') as j:
         json.dump(label_map, j)  # save label map too
+    save_annotation_index(train_images, train_objects, output_folder, 'TRAIN')
 
-    print('\nThere are %d training images containing a total of %d objects. Files have been saved to %s.' % (
-        len(train_images), n_objects, os.path.abspath(output_folder)))
+    print('\nThere are %d training images containing a total of %d objects (%d of %d annotation files parsed). '
+          'Files have been saved to %s.' % (len(train_images), n_objects, n_parsed, len(ids),
+                                            os.path.abspath(output_folder)))
 
     # Test data
     test_images = list()
@@ -105,13 +162,14 @@ def create_data_lists(train_path, test_path, output_folder):
     with open(os.path.join(test_path, 'test.txt')) as f:
         ids = f.read().splitlines()
 
-    for id in ids:
-        # Parse annotation's XML file
-        objects = parse_annotation(os.path.join(test_path, 'Annotations', id + '.xml'))
-        if len(objects) == 0:
-            continue
+    # Parse annotations' XML files
+    paths = [os.path.join(test_path, 'Annotations', id + '.xml') for id in ids]
+    annotations, n_parsed = parse_annotations(paths, manifest=manifest, workers=workers)
+    annotation_paths.extend(paths)
+
+    for id, objects in zip(ids, annotations):
         test_objects.append(objects)
-        n_objects += len(objects)
+        n_objects += len(objects['boxes'])
         test_images.append(os.path.join(test_path, 'JPEGImages', id + '.jpg'))
 
     assert len(test_objects) == len(test_images)
@@ -121,9 +179,70 @@ def create_data_lists(train_path, test_path, output_folder):
         json.dump(test_images, j)
     with open(os.path.join(output_folder, 'TEST_objects.json'), 'w') as j:
         json.dump(test_objects, j)
+    save_annotation_index(test_images, test_objects, output_folder, 'TEST')
+
+    print('\nThere are %d test images containing a total of %d objects (%d of %d annotation files parsed). '
+          'Files have been saved to %s.' % (len(test_images), n_objects, n_parsed, len(ids),
+                                            os.path.abspath(output_folder)))
+
+    # Save the manifest, keeping only the annotations that are still in use
+    manifest = {path: manifest[path] for path in annotation_paths}
+    with open(manifest_path, 'w') as j:
+        json.dump(manifest, j)
+
+
+# Arrays making up the annotation index of a split, see 'save_annotation_index'
+annotation_index_arrays = ('images', 'offsets', 'boxes', 'labels', 'difficulties')
+
+
+def annotation_index(images, objects):
+    """
+    Pack lists of images and objects into flat arrays.
+
+    The boxes, labels and difficulties of all images are concatenated, and rows 'offsets[i]:offsets[i + 1]' of these
+    arrays are the objects of image i.
+
+    :param images: list of image paths
+    :param objects: list of dictionaries of the boxes, labels and difficulties of the objects in each image
+    :return: dictionary of arrays, keyed by the names in 'annotation_index_arrays'
+    """
+    offsets = np.zeros(len(objects) + 1, dtype=np.int64)  # (n_images + 1)
+    np.cumsum([len(o['labels']) for o in objects], out=offsets[1:])
+
+    return {'images': np.array([i.encode('utf-8') for i in images], dtype=np.bytes_),  # (n_images)
+            'offsets': offsets,
+            'boxes': np.array([b for o in objects for b in o['boxes']], dtype=np.float32).reshape(-1, 4),  # (n_objects, 4)
+            'labels': np.array([l for o in objects for l in o['labels']], dtype=np.int32),  # (n_objects)
+            'difficulties': np.array([d for o in objects for d in o['difficulties']], dtype=np.uint8)}  # (n_objects)
 
-    print('\nThere are %d test images containing a total of %d objects. Files have been saved to %s.' % (
-        len(test_images), n_objects, os.path.abspath(output_folder)))
+
+def save_annotation_index(images, objects, output_folder, split):
+    """
+    Save images and objects as .npy files, which datasets can memory-map instead of loading the JSON lists.
+
+    :param images: list of image paths
+    :param objects: list of dictionaries of the boxes, labels and difficulties of the objects in each image
+    :param output_folder: folder where the .npy files must be saved
+    :param split: split, one of 'TRAIN' or 'TEST'
+    """
+    index = annotation_index(images, objects)
+    for name in annotation_index_arrays:
+        np.save(os.path.join(output_folder, '%s_%s.npy' % (split, name)), index[name])
+
+
+def load_annotation_index(data_folder, split):
+    """
+    Memory-map the annotation index saved by 'save_annotation_index'.
+
+    :param data_folder: folder where the .npy files are stored
+    :param split: split, one of 'TRAIN' or 'TEST'
+    :return: dictionary of read-only memory-mapped arrays, or None if there is no index for this split
+    """
+    paths = {name: os.path.join(data_folder, '%s_%s.npy' % (split, name)) for name in annotation_index_arrays}
+    if not all(os.path.isfile(p) for p in paths.values()):
+        return None
+
+    return {name: np.load(p, mmap_mode='r') for name, p in paths.items()}
 
 
 def decimate(tensor, m):
@@ -145,161 +264,26 @@ def decimate(tensor, m):
     return tensor
 
 
-def calculate_mAP(det_boxes, det_labels, det_scores, true_boxes, true_labels, true_difficulties):
-    """
-    Calculate the Mean Average Precision (mAP) of detected objects.
-
-    See https://medium.com/@jonathan_hui/map-mean-average-precision-for-object-detection-45c121a31173 for an explanation
-
-    :param det_boxes: list of tensors, one tensor for each image containing detected objects' bounding boxes
-    :param det_labels: list of tensors, one tensor for each image containing detected objects' labels
-    :param det_scores: list of tensors, one tensor for each image containing detected objects' labels' scores
-    :param true_boxes: list of tensors, one tensor for each image containing actual objects' bounding boxes
-    :param true_labels: list of tensors, one tensor for each image containing actual objects' labels
-    :param true_difficulties: list of tensors, one tensor for each image containing actual objects' difficulty (0 or 1)
-    :return: list of average precisions for all classes, mean average precision (mAP)
-    """
-    assert len(det_boxes) == len(det_labels) == len(det_scores) == len(true_boxes) == len(
-        true_labels) == len(
-        true_difficulties)  # these are all lists of tensors of the same length, i.e. number of images
-    n_classes = len(label_map)
-
-    # Store all (true) objects in a single continuous tensor while keeping track of the image it is from
-    true_images = list()
-    for i in range(len(true_labels)):
-        true_images.extend([i] * true_labels[i].size(0))
-    true_images = torch.LongTensor(true_images).to(
-        device)  # (n_objects), n_objects is the total no. of objects across all images
-    true_boxes = torch.cat(true_boxes, dim=0)  # (n_objects, 4)
-    true_labels = torch.cat(true_labels, dim=0)  # (n_objects)
-    true_difficulties = torch.cat(true_difficulties, dim=0)  # (n_objects)
-
-    assert true_images.size(0) == true_boxes.size(0) == true_labels.size(0)
-
-    # Store all detections in a single continuous tensor while keeping track of the image it is from
-    det_images = list()
-    for i in range(len(det_labels)):
-        det_images.extend([i] * det_labels[i].size(0))
-    det_images = torch.LongTensor(det_images).to(device)  # (n_detections)
-    det_boxes = torch.cat(det_boxes, dim=0)  # (n_detections, 4)
-    det_labels = torch.cat(det_labels, dim=0)  # (n_detections)
-    det_scores = torch.cat(det_scores, dim=0)  # (n_detections)
-
-    assert det_images.size(0) == det_boxes.size(0) == det_labels.size(0) == det_scores.size(0)
-
-    # Calculate APs for each class (except background)
-    average_precisions = torch.zeros((n_classes - 1), dtype=torch.float)  # (n_classes - 1)
-    for c in range(1, n_classes):
-        # Extract only objects with this class
-        true_class_images = true_images[true_labels == c]  # (n_class_objects)
-        true_class_boxes = true_boxes[true_labels == c]  # (n_class_objects, 4)
-        true_class_difficulties = true_difficulties[true_labels == c]  # (n_class_objects)
-        n_easy_class_objects = (1 - true_class_difficulties).sum().item()  # ignore difficult objects
-
-        # Keep track of which true objects with this class have already been 'detected'
-        # So far, none
-        true_class_boxes_detected = torch.zeros((true_class_difficulties.size(0)), dtype=torch.uint8).to(
-            device)  # (n_class_objects)
-
-        # Extract only detections with this class
-        det_class_images = det_images[det_labels == c]  # (n_class_detections)
-        det_class_boxes = det_boxes[det_labels == c]  # (n_class_detections, 4)
-        det_class_scores = det_scores[det_labels == c]  # (n_class_detections)
-        n_class_detections = det_class_boxes.size(0)
-        if n_class_detections == 0:
-            continue
-
-        # Sort detections in decreasing order of confidence/scores
-        det_class_scores, sort_ind = torch.sort(det_class_scores, dim=0, descending=True)  # (n_class_detections)
-        det_class_images = det_class_images[sort_ind]  # (n_class_detections)
-        det_class_boxes = det_class_boxes[sort_ind]  # (n_class_detections, 4)
-
-        # In the order of decreasing scores, check if true or false positive
-        true_positives = torch.zeros((n_class_detections), dtype=torch.float).to(device)  # (n_class_detections)
-        false_positives = torch.zeros((n_class_detections), dtype=torch.float).to(device)  # (n_class_detections)
-        for d in range(n_class_detections):
-            this_detection_box = det_class_boxes[d].unsqueeze(0)  # (1, 4)
-            this_image = det_class_images[d]  # (), scalar
-
-            # Find objects in the same image with this class, their difficulties, and whether they have been detected before
-            object_boxes = true_class_boxes[true_class_images == this_image]  # (n_class_objects_in_img)
-            object_difficulties = true_class_difficulties[true_class_images == this_image]  # (n_class_objects_in_img)
-            # If no such object in this image, then the detection is a false positive
-            if object_boxes.size(0) == 0:
-                false_positives[d] = 1
-                continue
-
-            # Find maximum overlap of this detection with objects in this image of this class
-            overlaps = find_jaccard_overlap(this_detection_box, object_boxes)  # (1, n_class_objects_in_img)
-            max_overlap, ind = torch.max(overlaps.squeeze(0), dim=0)  # (), () - scalars
-
-            # 'ind' is the index of the object in these image-level tensors 'object_boxes', 'object_difficulties'
-            # In the original class-level tensors 'true_class_boxes', etc., 'ind' corresponds to object with index...
-            original_ind = torch.LongTensor(range(true_class_boxes.size(0)))[true_class_images == this_image][ind]
-            # We need 'original_ind' to update 'true_class_boxes_detected'
-
-            # If the maximum overlap is greater than the threshold of 0.5, it's a match
-            if max_overlap.item() > 0.5:
-                # If the object it matched with is 'difficult', ignore it
-                if object_difficulties[ind] == 0:
-                    # If this object has already not been detected, it's a true positive
-                    if true_class_boxes_detected[original_ind] == 0:
-                        true_positives[d] = 1
-                        true_class_boxes_detected[original_ind] = 1  # this object has now been detected/accounted for
-                    # Otherwise, it's a false positive (since this object is already accounted for)
-                    else:
-                        false_positives[d] = 1
-            # Otherwise, the detection occurs in a different location than the actual object, and is a false positive
-            else:
-                false_positives[d] = 1
-
-        # Compute cumulative precision and recall at each detection in the order of decreasing scores
-        cumul_true_positives = torch.cumsum(true_positives, dim=0)  # (n_class_detections)
-        cumul_false_positives = torch.cumsum(false_positives, dim=0)  # (n_class_detections)
-        cumul_precision = cumul_true_positives / (
-                cumul_true_positives + cumul_false_positives + 1e-10)  # (n_class_detections)
-        cumul_recall = cumul_true_positives / n_easy_class_objects  # (n_class_detections)
-
-        # Find the mean of the maximum of the precisions corresponding to recalls above the threshold 't'
-        recall_thresholds = torch.arange(start=0, end=1.1, step=.1).tolist()  # (11)
-        precisions = torch.zeros((len(recall_thresholds)), dtype=torch.float).to(device)  # (11)
-        for i, t in enumerate(recall_thresholds):
-            recalls_above_t = cumul_recall >= t
-            if recalls_above_t.any():
-                precisions[i] = cumul_precision[recalls_above_t].max()
-            else:
-                precisions[i] = 0.
-        average_precisions[c - 1] = precisions.mean()  # c is in [1, n_classes - 1]
-
-    # Calculate Mean Average Precision (mAP)
-    mean_average_precision = average_precisions.mean().item()
-
-    # Keep class-wise average precisions in a dictionary
-    average_precisions = {rev_label_map[c + 1]: v for c, v in enumerate(average_precisions.tolist())}
-
-    return average_precisions, mean_average_precision
-
-
 def xy_to_cxcy(xy):
     """
     Convert bounding boxes from boundary coordinates (x_min, y_min, x_max, y_max) to center-size coordinates (c_x, c_y, w, h).
 
-    :param xy: bounding boxes in boundary coordinates, a tensor of size (n_boxes, 4)
-    :return: bounding boxes in center-size coordinates, a tensor of size (n_boxes, 4)
+    :param xy: bounding boxes in boundary coordinates, a tensor of size (..., n_boxes, 4)
+    :return: bounding boxes in center-size coordinates, a tensor of size (..., n_boxes, 4)
     """
-    return torch.cat([(xy[:, 2:] + xy[:, :2]) / 2,  # c_x, c_y
-                      xy[:, 2:] - xy[:, :2]], 1)  # w, h
+    return torch.cat([(xy[..., 2:] + xy[..., :2]) / 2,  # c_x, c_y
+                      xy[..., 2:] - xy[..., :2]], -1)  # w, h
 
 
 def cxcy_to_xy(cxcy):
     """
     Convert bounding boxes from center-size coordinates (c_x, c_y, w, h) to boundary coordinates (x_min, y_min, x_max, y_max).
 
-    :param cxcy: bounding boxes in center-size coordinates, a tensor of size (n_boxes, 4)
-    :return: bounding boxes in boundary coordinates, a tensor of size (n_boxes, 4)
+    :param cxcy: bounding boxes in center-size coordinates, a tensor of size (..., n_boxes, 4)
+    :return: bounding boxes in boundary coordinates, a tensor of size (..., n_boxes, 4)
     """
-    return torch.cat([cxcy[:, :2] - (cxcy[:, 2:] / 2),  # x_min, y_min
-                      cxcy[:, :2] + (cxcy[:, 2:] / 2)], 1)  # x_max, y_max
+    return torch.cat([cxcy[..., :2] - (cxcy[..., 2:] / 2),  # x_min, y_min
+                      cxcy[..., :2] + (cxcy[..., 2:] / 2)], -1)  # x_max, y_max
 
 
 def cxcy_to_gcxgcy(cxcy, priors_cxcy):
@@ -311,16 +295,16 @@ def cxcy_to_gcxgcy(cxcy, priors_cxcy):
 
     In the model, we are predicting bounding box coordinates in this encoded form.
 
-    :param cxcy: bounding boxes in center-size coordinates, a tensor of size (n_priors, 4)
+    :param cxcy: bounding boxes in center-size coordinates, a tensor of size (..., n_priors, 4)
     :param priors_cxcy: prior boxes with respect to which the encoding must be performed, a tensor of size (n_priors, 4)
-    :return: encoded bounding boxes, a tensor of size (n_priors, 4)
+    :return: encoded bounding boxes, a tensor of size (..., n_priors, 4)
     """
 
     # The 10 and 5 below are referred to as 'variances' in the original Caffe repo, completely empirical
     # They are for some sort of numerical conditioning, for 'scaling the localization gradient'
     # See https://github.com/weiliu89/caffe/issues/155
-    return torch.cat([(cxcy[:, :2] - priors_cxcy[:, :2]) / (priors_cxcy[:, 2:] / 10),  # g_c_x, g_c_y
-                      torch.log(cxcy[:, 2:] / priors_cxcy[:, 2:]) * 5], 1)  # g_w, g_h
+    return torch.cat([(cxcy[..., :2] - priors_cxcy[..., :2]) / (priors_cxcy[..., 2:] / 10),  # g_c_x, g_c_y
+                      torch.log(cxcy[..., 2:] / priors_cxcy[..., 2:]) * 5], -1)  # g_w, g_h
 
 
 def gcxgcy_to_cxcy(gcxgcy, priors_cxcy):
@@ -331,13 +315,13 @@ def gcxgcy_to_cxcy(gcxgcy, priors_cxcy):
 
     This is the inverse of the function above.
 
-    :param gcxgcy: encoded bounding boxes, i.e. output of the model, a tensor of size (n_priors, 4)
+    :param gcxgcy: encoded bounding boxes, i.e. output of the model, a tensor of size (..., n_priors, 4)
     :param priors_cxcy: prior boxes with respect to which the encoding is defined, a tensor of size (n_priors, 4)
-    :return: decoded bounding boxes in center-size form, a tensor of size (n_priors, 4)
+    :return: decoded bounding boxes in center-size form, a tensor of size (..., n_priors, 4)
     """
 
-    return torch.cat([gcxgcy[:, :2] * priors_cxcy[:, 2:] / 10 + priors_cxcy[:, :2],  # c_x, c_y
-                      torch.exp(gcxgcy[:, 2:] / 5) * priors_cxcy[:, 2:]], 1)  # w, h
+    return torch.cat([gcxgcy[..., :2] * priors_cxcy[..., 2:] / 10 + priors_cxcy[..., :2],  # c_x, c_y
+                      torch.exp(gcxgcy[..., 2:] / 5) * priors_cxcy[..., 2:]], -1)  # w, h
 
 
 def find_intersection(set_1, set_2):
@@ -350,10 +334,12 @@ def find_intersection(set_1, set_2):
     """
 
     # PyTorch auto-broadcasts singleton dimensions
-    lower_bounds = torch.max(set_1[:, :2].unsqueeze(1), set_2[:, :2].unsqueeze(0))  # (n1, n2, 2)
-    upper_bounds = torch.min(set_1[:, 2:].unsqueeze(1), set_2[:, 2:].unsqueeze(0))  # (n1, n2, 2)
-    intersection_dims = torch.clamp(upper_bounds - lower_bounds, min=0)  # (n1, n2, 2)
-    return intersection_dims[:, :, 0] * intersection_dims[:, :, 1]  # (n1, n2)
+    # Widths and heights are found separately, which avoids building and then slicing (n1, n2, 2) intermediates
+    intersection_w = torch.min(set_1[:, 2].unsqueeze(1), set_2[:, 2].unsqueeze(0)) - torch.max(
+        set_1[:, 0].unsqueeze(1), set_2[:, 0].unsqueeze(0))  # (n1, n2)
+    intersection_h = torch.min(set_1[:, 3].unsqueeze(1), set_2[:, 3].unsqueeze(0)) - torch.max(
+        set_1[:, 1].unsqueeze(1), set_2[:, 1].unsqueeze(0))  # (n1, n2)
+    return intersection_w.clamp_(min=0) * intersection_h.clamp_(min=0)  # (n1, n2)
 
 
 def find_jaccard_overlap(set_1, set_2):
@@ -641,6 +627,289 @@ def transform(image, boxes, labels, difficulties, split):
     return new_image, new_boxes, new_labels, new_difficulties
 
 
+# Batched versions of the augmentations above, applied to a whole batch of images at once as tensor ops
+# Each image still gets its own random parameters, drawn from the same distributions as in 'transform'
+
+def adjust_brightness_batch(images, factors):
+    """
+    Adjust the brightness of each image in a batch by its own factor.
+
+    :param images: images, a tensor of dimensions (N, 3, H, W) with values in [0, 1]
+    :param factors: brightness factors, a tensor of dimensions (N)
+    :return: adjusted images
+    """
+    return (images * factors.view(-1, 1, 1, 1)).clamp_(0, 1)
+
+
+def adjust_contrast_batch(images, factors):
+    """
+    Adjust the contrast of each image in a batch by its own factor, blending it with its mean grayscale value.
+
+    :param images: images, a tensor of dimensions (N, 3, H, W) with values in [0, 1]
+    :param factors: contrast factors, a tensor of dimensions (N)
+    :return: adjusted images
+    """
+    means = FT.rgb_to_grayscale(images).mean(dim=(1, 2, 3), keepdim=True)  # (N, 1, 1, 1)
+    factors = factors.view(-1, 1, 1, 1)
+    return (factors * images + (1 - factors) * means).clamp_(0, 1)
+
+
+def adjust_saturation_batch(images, factors):
+    """
+    Adjust the saturation of each image in a batch by its own factor, blending it with its grayscale version.
+
+    :param images: images, a tensor of dimensions (N, 3, H, W) with values in [0, 1]
+    :param factors: saturation factors, a tensor of dimensions (N)
+    :return: adjusted images
+    """
+    factors = factors.view(-1, 1, 1, 1)
+    return (factors * images + (1 - factors) * FT.rgb_to_grayscale(images)).clamp_(0, 1)
+
+
+def adjust_hue_batch(images, factors):
+    """
+    Shift the hue of each image in a batch by its own factor, in HSV space.
+
+    :param images: images, a tensor of dimensions (N, 3, H, W) with values in [0, 1]
+    :param factors: hue shifts, in [-0.5, 0.5], a tensor of dimensions (N)
+    :return: adjusted images
+    """
+    # RGB to HSV
+    r, g, b = images.unbind(dim=1)  # (N, H, W) each
+    max_c = images.max(dim=1)[0]  # (N, H, W)
+    min_c = images.min(dim=1)[0]  # (N, H, W)
+    chroma = max_c - min_c
+    gray = max_c == min_c
+    s = chroma / torch.where(gray, torch.ones_like(max_c), max_c)
+    chroma = torch.where(gray, torch.ones_like(chroma), chroma)
+    rc, gc, bc = (max_c - r) / chroma, (max_c - g) / chroma, (max_c - b) / chroma
+    h = ((max_c == r) * (bc - gc) + ((max_c == g) & (max_c != r)) * (2. + rc - bc) +
+         ((max_c != g) & (max_c != r)) * (4. + gc - rc))
+    h = torch.fmod(h / 6. + 1., 1.)
+    v = max_c
+
+    # Shift hue
+    h = torch.remainder(h + factors.view(-1, 1, 1), 1.)
+
+    # HSV to RGB
+    i = torch.floor(h * 6.)
+    f = h * 6. - i
+    i = i.long() % 6
+    p = (v * (1. - s)).clamp_(0, 1)
+    q = (v * (1. - s * f)).clamp_(0, 1)
+    t = (v * (1. - s * (1. - f))).clamp_(0, 1)
+    sector = i.unsqueeze(1) == torch.arange(6, device=images.device).view(1, -1, 1, 1)  # (N, 6, H, W)
+    candidates = torch.stack([torch.stack([v, q, p, p, t, v], dim=1),
+                              torch.stack([t, v, v, q, p, p], dim=1),
+                              torch.stack([p, p, t, v, v, q], dim=1)], dim=1)  # (N, 3, 6, H, W)
+    return (candidates * sector.unsqueeze(1)).sum(dim=2)  # (N, 3, H, W)
+
+
+def photometric_distort_batch(images):
+    """
+    Distort brightness, contrast, saturation, and hue of each image in a batch, each with a 50% chance, in random order.
+
+    :param images: images, a tensor of dimensions (N, 3, H, W) with values in [0, 1]
+    :return: distorted images
+    """
+    batch_size = images.size(0)
+    distortions = [adjust_brightness_batch,
+                   adjust_contrast_batch,
+                   adjust_saturation_batch,
+                   adjust_hue_batch]
+
+    # For each image, a random order of the distortions, whether to apply each, and their adjust factors
+    order = torch.rand((batch_size, 4)).argsort(dim=1)  # (N, 4)
+    apply = torch.rand((batch_size, 4)) < 0.5  # (N, 4)
+    # Caffe repo uses 'lower' and 'upper' values of 0.5 and 1.5 for brightness, contrast, and saturation,
+    # and a 'hue_delta' of 18 - we divide by 255 because PyTorch needs a normalized value
+    adjust_factors = torch.cat([torch.empty((batch_size, 3)).uniform_(0.5, 1.5),
+                                torch.empty((batch_size, 1)).uniform_(-18 / 255., 18 / 255.)], dim=1)  # (N, 4)
+
+    new_images = images.clone()
+    for step in range(4):
+        for d, distortion in enumerate(distortions):
+            selected = ((order[:, step] == d) & apply[:, d]).nonzero(as_tuple=True)[0]
+            if selected.numel() == 0:
+                continue
+            selected_images = selected.to(images.device)
+            new_images[selected_images] = distortion(new_images[selected_images],
+                                                     adjust_factors[selected, d].to(images.device))
+
+    return new_images
+
+
+def random_crop_batch(boxes, object_mask, canvas_sizes, original_sizes, n_rounds=4, max_trials=50):
+    """
+    Choose a random crop for each image in a batch, in the manner of 'random_crop', with all trials checked at once.
+
+    Instead of retrying until a crop succeeds, 'n_rounds' choices of minimum overlap with 'max_trials' crops each are
+    drawn up-front for every image, and the first successful one is kept. An image is not cropped if all of them fail,
+    which happens with negligible probability.
+
+    :param boxes: bounding boxes in fractional coordinates of the expanded canvases, a tensor of dimensions (N, n_max_objects, 4)
+    :param object_mask: which of the boxes are real objects rather than padding, a tensor of dimensions (N, n_max_objects)
+    :param canvas_sizes: size of each (square) canvas, in units of its original image, a tensor of dimensions (N)
+    :param original_sizes: (height, width) of each original image in pixels, a tensor of dimensions (N, 2)
+    :param n_rounds: number of choices of minimum overlap drawn for each image
+    :param max_trials: number of crops tried for each choice of minimum overlap
+    :return: crops in boundary coordinates, a tensor of dimensions (N, 4)
+    """
+    batch_size = boxes.size(0)
+    device = boxes.device
+    canvas_sizes = canvas_sizes.view(-1, 1, 1)  # (N, 1, 1)
+
+    # Randomly draw the values for minimum overlap, where 'nan' refers to no cropping
+    min_overlap_choices = torch.FloatTensor([0., .1, .3, .5, .7, .9, float('nan')]).to(device)
+    min_overlaps = min_overlap_choices[torch.randint(len(min_overlap_choices), (batch_size, n_rounds), device=device)]
+
+    # Crop dimensions must be in [0.3, 1] of original dimensions, with an aspect ratio in [0.5, 2] in pixels
+    scale_h = torch.empty((batch_size, n_rounds, max_trials), device=device).uniform_(0.3, 1)  # (N, n_rounds, max_trials)
+    scale_w = torch.empty((batch_size, n_rounds, max_trials), device=device).uniform_(0.3, 1)  # (N, n_rounds, max_trials)
+    original_sizes = original_sizes.to(device).float()
+    aspect_ratio = (scale_h * original_sizes[:, 0].view(-1, 1, 1)) / (scale_w * original_sizes[:, 1].view(-1, 1, 1))
+    new_h = scale_h * canvas_sizes
+    new_w = scale_w * canvas_sizes
+
+    # Crop coordinates (origin at top-left of canvas)
+    left = torch.rand((batch_size, n_rounds, max_trials), device=device) * (canvas_sizes - new_w)
+    top = torch.rand((batch_size, n_rounds, max_trials), device=device) * (canvas_sizes - new_h)
+    crops = torch.stack([left, top, left + new_w, top + new_h], dim=3)  # (N, n_rounds, max_trials, 4)
+
+    # Calculate Jaccard overlap between the crops and the bounding boxes of their image
+    flat_crops = crops.view(batch_size, -1, 4)  # (N, n_rounds * max_trials, 4)
+    intersection_w = torch.min(flat_crops[:, :, 2].unsqueeze(2), boxes[:, :, 2].unsqueeze(1)) - torch.max(
+        flat_crops[:, :, 0].unsqueeze(2), boxes[:, :, 0].unsqueeze(1))
+    intersection_h = torch.min(flat_crops[:, :, 3].unsqueeze(2), boxes[:, :, 3].unsqueeze(1)) - torch.max(
+        flat_crops[:, :, 1].unsqueeze(2), boxes[:, :, 1].unsqueeze(1))
+    intersection = intersection_w.clamp(min=0) * intersection_h.clamp(min=0)  # (N, n_rounds * max_trials, n_max_objects)
+    areas_crops = (new_w * new_h).view(batch_size, -1, 1)
+    areas_boxes = ((boxes[:, :, 2] - boxes[:, :, 0]) * (boxes[:, :, 3] - boxes[:, :, 1])).unsqueeze(1)
+    overlap = intersection / (areas_crops + areas_boxes - intersection)
+    overlap = overlap.masked_fill(~object_mask.unsqueeze(1), -1.)
+    overlap = overlap.max(dim=2)[0].view(batch_size, n_rounds, max_trials)  # (N, n_rounds, max_trials)
+
+    # Find bounding boxes whose centers are in the crops
+    bb_centers = (boxes[:, :, :2] + boxes[:, :, 2:]) / 2.  # (N, n_max_objects, 2)
+    centers_in_crop = (bb_centers[:, :, 0].unsqueeze(1) > flat_crops[:, :, 0].unsqueeze(2)) & (
+            bb_centers[:, :, 0].unsqueeze(1) < flat_crops[:, :, 2].unsqueeze(2)) & (
+                              bb_centers[:, :, 1].unsqueeze(1) > flat_crops[:, :, 1].unsqueeze(2)) & (
+                              bb_centers[:, :, 1].unsqueeze(1) < flat_crops[:, :, 3].unsqueeze(2))
+    any_center_in_crop = (centers_in_crop & object_mask.unsqueeze(1)).any(dim=2).view(batch_size, n_rounds, max_trials)
+
+    # A crop succeeds if its aspect ratio is fine, it overlaps some box enough, and it contains the center of some box
+    success = (aspect_ratio > 0.5) & (aspect_ratio < 2) & (overlap >= min_overlaps.unsqueeze(2)) & any_center_in_crop
+    # Choosing not to crop always succeeds, at the first trial of its round
+    no_crop = torch.isnan(min_overlaps)  # (N, n_rounds)
+    success[:, :, 0] |= no_crop
+
+    # Keep the first success of each image, in the order the trials would have been made
+    success = success.view(batch_size, -1)  # (N, n_rounds * max_trials)
+    first = success.int().argmax(dim=1)  # (N)
+    uncropped = ~success.any(dim=1) | no_crop.view(batch_size, -1).repeat_interleave(max_trials, dim=1).gather(
+        1, first.unsqueeze(1)).squeeze(1)  # (N)
+
+    crops = flat_crops[torch.arange(batch_size, device=device), first]  # (N, 4)
+    full = torch.cat([torch.zeros_like(canvas_sizes.view(-1, 1)).expand(-1, 2), canvas_sizes.view(-1, 1).expand(-1, 2)],
+                     dim=1)  # (N, 4)
+    return torch.where(uncropped.unsqueeze(1), full, crops)
+
+
+def batch_transform(images, boxes, labels, difficulties, original_sizes, dims=(300, 300)):
+    """
+    Apply the training transformations of 'transform' to a whole batch of images at once, as tensor ops.
+
+    Photometric distortions are applied to each image in turn with its own parameters. Expanding, cropping, flipping and
+    resizing are then combined into a single affine transformation per image, so that the whole batch is resampled
+    once. This runs after collation, on whichever device the images are on, instead of in the DataLoader workers.
+
+    :param images: images, a uint8 tensor of dimensions (N, 3, H, W), see 'PascalVOCDataset' with batch_augment=True -
+        these are resampled once, so H and W should be larger than dims for crops to keep their detail
+    :param boxes: bounding boxes in fractional coordinates, a list of N tensors of dimensions (n_objects, 4)
+    :param labels: labels of objects, a list of N tensors of dimensions (n_objects)
+    :param difficulties: difficulties of detection of these objects, a list of N tensors of dimensions (n_objects)
+    :param original_sizes: (height, width) of the images before they were resized to be collated, a tensor of dimensions (N, 2)
+    :param dims: (height, width) of the output images, (300, 300) for the SSD300
+    :return: normalized images of dimensions (N, 3, dims[0], dims[1]), and lists of transformed boxes, labels, difficulties
+    """
+    batch_size = images.size(0)
+    device = images.device
+
+    # Mean and standard deviation of ImageNet data that our base VGG from torchvision was trained on
+    mean = torch.FloatTensor([0.485, 0.456, 0.406]).to(device).view(1, 3, 1, 1)
+    std = torch.FloatTensor([0.229, 0.224, 0.225]).to(device).view(1, 3, 1, 1)
+
+    # A series of photometric distortions in random order, each with 50% chance of occurrence, as in Caffe repo
+    new_images = photometric_distort_batch(images.float().div_(255))
+
+    # Expand images (zoom out) with a 50% chance, onto canvases of 'canvas_sizes' times their original size,
+    # with the original images at 'offsets' - in units of the original images
+    expanded = torch.rand(batch_size, device=device) < 0.5  # (N)
+    canvas_sizes = torch.where(expanded, torch.empty(batch_size, device=device).uniform_(1, 4),
+                               torch.ones(batch_size, device=device))  # (N)
+    offsets = torch.rand((batch_size, 2), device=device) * (canvas_sizes.unsqueeze(1) - 1)  # (N, 2)
+
+    # Pad boxes, and move them to their coordinates on the canvases
+    n_objects = [b.size(0) for b in boxes]
+    padded_boxes = pad_sequence(boxes, batch_first=True).to(device) + offsets.repeat(1, 2).unsqueeze(1)
+    object_mask = torch.arange(padded_boxes.size(1), device=device).unsqueeze(0) < torch.LongTensor(n_objects).to(
+        device).unsqueeze(1)  # (N, n_max_objects)
+
+    # Randomly crop images (zoom in)
+    crops = random_crop_batch(padded_boxes, object_mask, canvas_sizes, original_sizes)  # (N, 4)
+    crop_sizes = crops[:, 2:] - crops[:, :2]  # (N, 2)
+    cropped = (crops[:, :2] != 0).any(dim=1) | (crop_sizes != canvas_sizes.unsqueeze(1)).any(dim=1)  # (N)
+
+    # Flip images with a 50% chance
+    flipped = torch.rand(batch_size, device=device) < 0.5  # (N)
+
+    # Resample the images - each output pixel maps to a point on the crop, i.e. on the canvas, i.e. on the image
+    # Coordinates are normalized to [-1, 1] over the output and the original image, as 'affine_grid' expects
+    # Pixels outside of the original image are filled with the mean of ImageNet data that our base VGG was trained on
+    theta = torch.zeros((batch_size, 2, 3), device=device)
+    theta[:, 0, 0] = torch.where(flipped, -crop_sizes[:, 0], crop_sizes[:, 0])
+    theta[:, 1, 1] = crop_sizes[:, 1]
+    theta[:, :, 2] = 2 * (crops[:, :2] - offsets) + crop_sizes - 1
+    grid = F.affine_grid(theta, [batch_size, 3, dims[0], dims[1]], align_corners=False)
+
+    # Images shrunk by 2 ** k or more are sampled from images average-pooled by 2 ** k, as bilinear sampling alone
+    # would alias them, where 'transform' resizes with PIL's antialiasing
+    steps = torch.min(crop_sizes[:, 0] * images.size(3) / dims[1], crop_sizes[:, 1] * images.size(2) / dims[0])  # (N)
+    levels = steps.log2().floor().clamp(min=0).long()  # (N)
+    source = new_images - mean
+    new_images = torch.empty((batch_size, 3, dims[0], dims[1]), device=device)
+    for level in levels.unique().tolist():
+        i = levels == level
+        new_images[i] = F.grid_sample(F.avg_pool2d(source[i], 2 ** level) if level else source[i], grid[i],
+                                      mode='bilinear', padding_mode='zeros', align_corners=False)
+    new_images += mean  # (N, 3, dims[0], dims[1])
+
+    # Normalize by mean and standard deviation of ImageNet data that our base VGG was trained on
+    new_images = (new_images - mean) / std
+
+    # Transform boxes the same way, keeping only those whose centers are in the crop
+    new_boxes = list()
+    new_labels = list()
+    new_difficulties = list()
+    bb_centers = (padded_boxes[:, :, :2] + padded_boxes[:, :, 2:]) / 2.  # (N, n_max_objects, 2)
+    in_crop = ((bb_centers > crops[:, :2].unsqueeze(1)) & (bb_centers < crops[:, 2:].unsqueeze(1))).all(dim=2)
+    keep = object_mask & (in_crop | ~cropped.unsqueeze(1))  # (N, n_max_objects)
+    clipped = torch.max(torch.min(padded_boxes, crops[:, 2:].repeat(1, 2).unsqueeze(1)),
+                        crops[:, :2].repeat(1, 2).unsqueeze(1))  # (N, n_max_objects, 4)
+    fractional = (clipped - crops[:, :2].repeat(1, 2).unsqueeze(1)) / crop_sizes.repeat(1, 2).unsqueeze(1)
+    mirrored = torch.stack([1 - fractional[:, :, 2], fractional[:, :, 1], 1 - fractional[:, :, 0], fractional[:, :, 3]],
+                           dim=2)
+    fractional = torch.where(flipped.view(-1, 1, 1), mirrored, fractional)  # (N, n_max_objects, 4)
+    keep = keep.to('cpu')
+    for i in range(batch_size):
+        kept = keep[i, :n_objects[i]]
+        new_boxes.append(fractional[i, :n_objects[i]][kept.to(device)])
+        new_labels.append(labels[i][kept].to(device))
+        new_difficulties.append(difficulties[i][kept].to(device))
+
+    return new_images, new_boxes, new_labels, new_difficulties
+
+
 def adjust_learning_rate(optimizer, scale):
     """
     Scale learning rate by a specified factor.
@@ -669,19 +938,37 @@ def accuracy(scores, targets, k):
     return correct_total.item() * (100.0 / batch_size)
 
 
-def save_checkpoint(epoch, model, optimizer):
+def save_checkpoint(epoch, model, optimizer, iteration=None, batch=0, sampler=None, scaler=None,
+                    filename='checkpoint_ssd300.pth.tar'):
     """
     Save model checkpoint.
 
-    :param epoch: epoch number
+    Model and optimizer are saved as state dicts, along with where training is at, so that it can be resumed from the
+    middle of an epoch. See 'load_checkpoint' in model.py to load it.
+
+    :param epoch: epoch number that training is in
     :param model: model
     :param optimizer: optimizer
+    :param iteration: number of iterations (optimizer steps) done so far
+    :param batch: number of batches of this epoch done so far
+    :param sampler: sampler of the DataLoader, whose state is saved if it has a 'state_dict' method
+    :param scaler: gradient scaler used with mixed precision, if any
+    :param filename: path to save the checkpoint to
     """
     state = {'epoch': epoch,
-             'model': model,
-             'optimizer': optimizer}
-    filename = 'checkpoint_ssd300.pth.tar'
-    torch.save(state, filename)
+             'iteration': iteration,
+             'batch': batch,
+             'n_classes': model.n_classes,
+             'model': model.state_dict(),
+             'optimizer': optimizer.state_dict()}
+    if sampler is not None and hasattr(sampler, 'state_dict'):
+        state['sampler'] = sampler.state_dict()
+    if scaler is not None:
+        state['scaler'] = scaler.state_dict()
+
+    # Write to a temporary file first, so that being interrupted while saving doesn't lose the previous checkpoint
+    torch.save(state, filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
 
 
 class AverageMeter(object):
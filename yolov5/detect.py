@@ -4,11 +4,14 @@ Run inference on images, videos, directories, streams, etc.
 
 Usage:
     $ python path/to/detect.py --source path/to/img.jpg --weights yolov5s.pt --img 640
+    $ python path/to/detect.py --source path/to/img.jpg --weights best-int8.pt --device cpu  # export.py torch_int8
 """
 
 import argparse
 import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cv2
@@ -22,7 +25,7 @@ if str(ROOT) not in sys.path:
     sys.path.append(str(ROOT))  # add ROOT to PATH
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
-from models.experimental import attempt_load
+from models.experimental import attempt_load, optimize_for_inference
 from utils.datasets import LoadImages, LoadStreams
 from utils.general import apply_classifier, check_img_size, check_imshow, check_requirements, check_suffix, colorstr, \
     increment_path, non_max_suppression, print_args, save_one_box, scale_coords, set_logging, \
@@ -60,11 +63,17 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
         hide_conf=False,  # hide confidences
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
+        optimize=False,  # compile model with optimize_for_inference()
+        stream_batch=None,  # max streams per batch, default all
+        stream_deadline=0.05,  # max seconds to wait for a full batch of streams
+        batch_size=1,  # images per batch, > 1 to load ahead, batch and write in the background
+        workers=8,  # loading and writing threads for batch_size > 1
         ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
     webcam = source.isnumeric() or source.endswith('.txt') or source.lower().startswith(
         ('rtsp://', 'rtmp://', 'http://', 'https://'))
+    assert not (visualize and (webcam or batch_size > 1)), '--visualize needs a file source and --batch-size 1'
 
     # Directories
     save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)  # increment run
@@ -122,24 +131,98 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
             output_details = interpreter.get_output_details()  # outputs
             int8 = input_details[0]['dtype'] == np.uint8  # is TFLite quantized uint8 model
     imgsz = check_img_size(imgsz, s=stride)  # check image size
+    optimize &= pt and not isinstance(model, torch.jit.ScriptModule)
+    auto = pt and not optimize  # minimal letterbox padding, else square imgsz inputs for one compiled shape
 
     # Dataloader
     if webcam:
         print(color.BOLD + "Results saved to: " + str(save_dir) + color.END)
         view_img = check_imshow()
         cudnn.benchmark = True  # set True to speed up constant image size inference
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt)
-        bs = len(dataset)  # batch_size
+        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=auto, batch_size=stream_batch,
+                              deadline=stream_deadline)
+        bs = len(dataset)  # number of sources, batches hold up to stream_batch of them
+        output = [ThreadPoolExecutor(1)]  # output stage, in order
 
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt)
-        bs = 1  # batch_size
-    vid_path, vid_writer = [None] * bs, [None] * bs
+        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=auto, batch_size=batch_size, workers=workers)
+        bs = len(dataset)  # number of files, batches hold up to batch_size images
+        output = [ThreadPoolExecutor(1) for _ in range(workers)]  # output stage, in order per file
+    batched = webcam or batch_size > 1  # batches from dataset.index sources/files, written by the output stage
+    vid_path, vid_writer, pending = [None] * bs, [None] * bs, deque()
+    if optimize:  # compile or load the full batch shape now, instead of on the first batch
+        model = optimize_for_inference(model, imgsz, min(stream_batch or bs, bs) if webcam else batch_size)
+
+    def write(i, p, s, im0, frame, det, shape, dt_inf, mode, fps=30, stamp=None):
+        # Annotate and save predictions det for image im0 of (letterboxed) shape, source/file i, return it for show()
+        p = Path(p)  # to Path
+        save_path = str(save_dir / p.name)  # img.jpg
+        txt_path = str(save_dir / 'labels' / p.stem) + ('' if mode == 'image' else f'_{frame}')  # img.txt
+        lines = []  # txt labels
+        s += '%gx%g ' % shape  # print string
+        gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+        imc = im0.copy() if save_crop else im0  # for save_crop
+        annotator = Annotator(im0, line_width=line_thickness, example=str(names))
+        if len(det):
+            # Rescale boxes from img_size to im0 size
+            det[:, :4] = scale_coords(shape, det[:, :4], im0.shape).round()
+
+            # Print results
+            for c in det[:, -1].unique():
+                n = (det[:, -1] == c).sum()  # detections per class
+                s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
+
+            # Write results
+            for *xyxy, conf, cls in reversed(det):
+                if save_txt:  # Write to file
+                    xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
+                    line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
+                    lines.append(('%g ' * len(line)).rstrip() % line + '\n')
+
+                if save_img or save_crop or view_img:  # Add bbox to image
+                    c = int(cls)  # integer class
+                    label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
+                    annotator.box_label(xyxy, label, color=colors(c, True))
+                    if save_crop:
+                        save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
+            if lines:
+                with open(txt_path + '.txt', 'a') as f:
+                    f.writelines(lines)
+
+        # Print time (inference-only)
+        print(f'{s}Done. ({dt_inf:.3f}s)')
+
+        im0 = annotator.result()
+
+        # Save results (image with detections)
+        if save_img:
+            if mode == 'image':
+                cv2.imwrite(save_path, im0)
+            else:  # 'video' or 'stream'
+                if vid_path[i] != save_path:  # new video
+                    vid_path[i] = save_path
+                    if isinstance(vid_writer[i], cv2.VideoWriter):
+                        vid_writer[i].release()  # release previous video writer
+                    if mode == 'stream':
+                        save_path += '.mp4'
+                    h, w = im0.shape[:2]
+                    vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+                vid_writer[i].write(im0)
+        if stamp is not None:
+            dataset.done(i, stamp)
+        return p, im0
+
+    def show(p, im0):
+        # Stream results, on the main thread as HighGUI windows require on several backends (Qt, Cocoa)
+        if view_img:
+            cv2.imshow(str(p), im0)
+            if cv2.waitKey(1) == ord('q') and webcam:  # 1 millisecond, q to quit streams
+                dataset.close()
 
     # Run inference
     if pt and device.type != 'cpu':
         model(torch.zeros(1, 3, *imgsz).to(device).type_as(next(model.parameters())))  # run once
-    dt, seen = [0.0, 0.0, 0.0], 0
+    dt, seen, t0 = [0.0, 0.0, 0.0], 0, time_sync()
     for path, img, im0s, vid_cap in dataset:
         t1 = time_sync()
         if onnx:
@@ -195,76 +278,40 @@ def run(weights=ROOT / 'yolov5s.pt',  # model.pt path(s)
         if classify:
             pred = apply_classifier(pred, modelc, img, im0s)
 
-        # Process predictions
+        # Process predictions, when batched on the output stage, off the inference thread and in order per source/file
         for i, det in enumerate(pred):  # per image
             seen += 1
-            if webcam:  # batch_size >= 1
-                p, s, im0, frame = path[i], f'{i}: ', im0s[i].copy(), dataset.count
+            if batched:  # batch_size >= 1
+                j, p, im0, frame = dataset.index[i], path[i], im0s[i], dataset.frame[i]
+                s = f'{i}: ' if webcam else f'{dataset.mode} {j + 1}/{dataset.nf} {p}: '
+                pending.append(output[j % len(output)].submit(write, j, p, s, im0.copy() if webcam else im0, frame,
+                                                              det.cpu(), img.shape[2:], t3 - t2, dataset.mode,
+                                                              dataset.fps[j], dataset.stamps[i] if webcam else None))
+                while pending and (len(pending) > 2 * len(pred) or pending[0].done()):  # bound the output backlog
+                    show(*pending.popleft().result())  # in order, raising any output errors
             else:
                 p, s, im0, frame = path, '', im0s.copy(), getattr(dataset, 'frame', 0)
-
-            p = Path(p)  # to Path
-            save_path = str(save_dir / p.name)  # img.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # img.txt
-            s += '%gx%g ' % img.shape[2:]  # print string
-            gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-            imc = im0.copy() if save_crop else im0  # for save_crop
-            annotator = Annotator(im0, line_width=line_thickness, example=str(names))
-            if len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
-
-                # Print results
-                for c in det[:, -1].unique():
-                    n = (det[:, -1] == c).sum()  # detections per class
-                    s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-
-                # Write results
-                for *xyxy, conf, cls in reversed(det):
-                    if save_txt:  # Write to file
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-                    if save_img or save_crop or view_img:  # Add bbox to image
-                        c = int(cls)  # integer class
-                        label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
-                        annotator.box_label(xyxy, label, color=colors(c, True))
-                        if save_crop:
-                            save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
-
-            # Print time (inference-only)
-            print(f'{s}Done. ({t3 - t2:.3f}s)')
-
-            # Stream results
-            im0 = annotator.result()
-            if view_img:
-                cv2.imshow(str(p), im0)
-                cv2.waitKey(1)  # 1 millisecond
-
-            # Save results (image with detections)
-            if save_img:
-                if dataset.mode == 'image':
-                    cv2.imwrite(save_path, im0)
-                else:  # 'video' or 'stream'
-                    if vid_path[i] != save_path:  # new video
-                        vid_path[i] = save_path
-                        if isinstance(vid_writer[i], cv2.VideoWriter):
-                            vid_writer[i].release()  # release previous video writer
-                        if vid_cap:  # video
-                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        else:  # stream
-                            fps, w, h = 30, im0.shape[1], im0.shape[0]
-                            save_path += '.mp4'
-                        vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                    vid_writer[i].write(im0)
+                fps = vid_cap.get(cv2.CAP_PROP_FPS) if vid_cap else 30
+                show(*write(i, p, s, im0, frame, det, img.shape[2:], t3 - t2, dataset.mode, fps))
 
     # Print results
+    for x in pending:
+        show(*x.result())
+    for x in output:
+        x.shutdown()
+    for x in vid_writer:
+        if isinstance(x, cv2.VideoWriter):
+            x.release()
+    if webcam:
+        for x in dataset.stats():
+            print(f"{x['source']}: {x['served']}/{x['read']} frames served, {x['dropped']} dropped, "
+                  f"latency {x['latency'] * 1E3:.1f}ms mean, {x['latency95'] * 1E3:.1f}ms 95%")
+        if view_img:
+            cv2.destroyAllWindows()
     t = tuple(x / seen * 1E3 for x in dt)  # speeds per image
     print(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t)
+    t = time_sync() - t0
+    print(f"Throughput: {seen / t:.1f} images/s overall ({t:.1f}s{', pipelined' if batched else ''})")
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         print(f"Results saved to {colorstr('bold', save_dir)}{s}")
@@ -299,6 +346,11 @@ def parse_opt():
     parser.add_argument('--hide-conf', default=False, action='store_true', help='hide confidences')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    parser.add_argument('--optimize', action='store_true', help='compile model to cached channels_last TorchScript')
+    parser.add_argument('--stream-batch', type=int, default=None, help='max streams per batch, default all')
+    parser.add_argument('--stream-deadline', type=float, default=0.05, help='max seconds to wait for a stream batch')
+    parser.add_argument('--batch-size', type=int, default=1, help='images per batch, > 1 to pipeline loading/writing')
+    parser.add_argument('--workers', type=int, default=8, help='loading and writing threads for --batch-size > 1')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(FILE.stem, opt)
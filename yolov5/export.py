@@ -5,9 +5,11 @@ TensorFlow exports authored by https://github.com/zldrobit
 
 Usage:
     $ python path/to/export.py --weights yolov5s.pt --include torchscript onnx coreml saved_model pb tflite tfjs
+    $ python path/to/export.py --weights best.pt --include torch_int8 --data data/lego_data.yaml  # static INT8
 
 Inference:
     $ python path/to/detect.py --weights yolov5s.pt
+                                         yolov5s-int8.pt  (CPU, --device cpu)
                                          yolov5s.onnx  (must export with --dynamic)
                                          yolov5s_saved_model
                                          yolov5s.pb
@@ -21,6 +23,7 @@ TensorFlow.js:
 """
 
 import argparse
+import math
 import os
 import subprocess
 import sys
@@ -38,10 +41,10 @@ if str(ROOT) not in sys.path:
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 from models.common import Conv
-from models.experimental import attempt_load
+from models.experimental import attempt_load, quantize_static
 from models.yolo import Detect
 from utils.activations import SiLU
-from utils.datasets import LoadImages
+from utils.datasets import LoadImages, create_dataloader
 from utils.general import colorstr, check_dataset, check_img_size, check_requirements, file_size, print_args, \
     set_logging, url2file
 from utils.torch_utils import select_device
@@ -61,6 +64,25 @@ def export_torchscript(model, im, file, optimize, prefix=colorstr('TorchScript:'
         print(f'{prefix} export failure: {e}')
 
 
+def export_torch_int8(file, data, imgsz, batch_size, ncalib, prefix=colorstr('PyTorch INT8:')):
+    # YOLOv5 PyTorch static INT8 export, a checkpoint for attempt_load() and detect.py on CPU
+    try:
+        print(f'\n{prefix} starting export with torch {torch.__version__}...')
+        f = str(file).replace('.pt', '-int8.pt')
+
+        model = attempt_load(file, map_location='cpu')  # FP32 model, without export activations
+        gs = int(max(model.stride))  # grid size (max stride)
+        dataloader = create_dataloader(check_dataset(data)['train'], max(imgsz), batch_size, gs, pad=0.5, rect=True,
+                                       prefix=colorstr('calibration: '))[0]  # calibration data
+        quantize_static(model, dataloader, math.ceil(ncalib / batch_size))  # ncalib images, as for TFLite
+        torch.save({'epoch': -1, 'model': model}, f)
+
+        print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB)')
+        return f
+    except Exception as e:
+        print(f'\n{prefix} export failure: {e}')
+
+
 def export_onnx(model, im, file, opset, train, dynamic, simplify, prefix=colorstr('ONNX:')):
     # YOLOv5 ONNX export
     try:
@@ -257,6 +279,7 @@ def run(data=ROOT / 'data/coco128.yaml',  # 'dataset.yaml path'
         train=False,  # model.train() mode
         optimize=False,  # TorchScript: optimize for mobile
         int8=False,  # CoreML/TF INT8 quantization
+        ncalib=100,  # TF/PyTorch INT8: number of calibration images
         dynamic=False,  # ONNX/TF: dynamic axes
         simplify=False,  # ONNX: simplify model
         opset=12,  # ONNX: opset version
@@ -306,6 +329,8 @@ def run(data=ROOT / 'data/coco128.yaml',  # 'dataset.yaml path'
         export_onnx(model, im, file, opset, train, dynamic, simplify)
     if 'coreml' in include:
         export_coreml(model, im, file)
+    if 'torch_int8' in include:
+        export_torch_int8(file, data, imgsz, batch_size, ncalib)
 
     # TensorFlow Exports
     if any(tf_exports):
@@ -317,7 +342,7 @@ def run(data=ROOT / 'data/coco128.yaml',  # 'dataset.yaml path'
         if pb or tfjs:  # pb prerequisite to tfjs
             export_pb(model, im, file)
         if tflite:
-            export_tflite(model, im, file, int8=int8, data=data, ncalib=100)
+            export_tflite(model, im, file, int8=int8, data=data, ncalib=ncalib)
         if tfjs:
             export_tfjs(model, im, file)
 
@@ -339,6 +364,7 @@ def parse_opt():
     parser.add_argument('--train', action='store_true', help='model.train() mode')
     parser.add_argument('--optimize', action='store_true', help='TorchScript: optimize for mobile')
     parser.add_argument('--int8', action='store_true', help='CoreML/TF INT8 quantization')
+    parser.add_argument('--ncalib', type=int, default=100, help='TF/PyTorch INT8: calibration images')
     parser.add_argument('--dynamic', action='store_true', help='ONNX/TF: dynamic axes')
     parser.add_argument('--simplify', action='store_true', help='ONNX: simplify model')
     parser.add_argument('--opset', type=int, default=13, help='ONNX: opset version')
@@ -348,7 +374,7 @@ def parse_opt():
     parser.add_argument('--conf-thres', type=float, default=0.25, help='TF.js NMS: confidence threshold')
     parser.add_argument('--include', nargs='+',
                         default=['torchscript', 'onnx'],
-                        help='available formats are (torchscript, onnx, coreml, saved_model, pb, tflite, tfjs)')
+                        help='formats are (torchscript, onnx, coreml, torch_int8, saved_model, pb, tflite, tfjs)')
     opt = parser.parse_args()
     print_args(FILE.stem, opt)
     return opt
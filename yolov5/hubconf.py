@@ -10,7 +10,7 @@ Usage:
 import torch
 
 
-def _create(name, pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None):
+def _create(name, pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None, optimize=False):
     """Creates a specified YOLOv5 model
 
     Arguments:
@@ -21,6 +21,7 @@ def _create(name, pretrained=True, channels=3, classes=80, autoshape=True, verbo
         autoshape (bool): apply YOLOv5 .autoshape() wrapper to model
         verbose (bool): print all information to screen
         device (str, torch.device, None): device to use for model parameters
+        optimize (bool): compile the model with optimize_for_inference(), cached TorchScript for faster inference
 
     Returns:
         YOLOv5 pytorch model
@@ -28,7 +29,7 @@ def _create(name, pretrained=True, channels=3, classes=80, autoshape=True, verbo
     from pathlib import Path
 
     from models.yolo import Model
-    from models.experimental import attempt_load
+    from models.experimental import attempt_load, optimize_for_inference
     from utils.general import check_requirements, set_logging
     from utils.downloads import attempt_download
     from utils.torch_utils import select_device
@@ -55,6 +56,8 @@ def _create(name, pretrained=True, channels=3, classes=80, autoshape=True, verbo
                 model.load_state_dict(csd, strict=False)  # load
                 if len(ckpt['model'].names) == classes:
                     model.names = ckpt['model'].names  # set class names attribute
+        if optimize:
+            model = optimize_for_inference(model.to(device))  # fused, frozen, channels_last TorchScript
         if autoshape:
             model = model.autoshape()  # for file/URI/PIL/cv2/np inputs and NMS
         return model.to(device)
@@ -65,59 +68,59 @@ def _create(name, pretrained=True, channels=3, classes=80, autoshape=True, verbo
         raise Exception(s) from e
 
 
-def custom(path='path/to/model.pt', autoshape=True, verbose=True, device=None):
+def custom(path='path/to/model.pt', autoshape=True, verbose=True, device=None, optimize=False):
     # YOLOv5 custom or local model
-    return _create(path, autoshape=autoshape, verbose=verbose, device=device)
+    return _create(path, autoshape=autoshape, verbose=verbose, device=device, optimize=optimize)
 
 
-def yolov5n(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None):
+def yolov5n(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None, optimize=False):
     # YOLOv5-nano model https://github.com/ultralytics/yolov5
-    return _create('yolov5n', pretrained, channels, classes, autoshape, verbose, device)
+    return _create('yolov5n', pretrained, channels, classes, autoshape, verbose, device, optimize)
 
 
-def yolov5s(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None):
+def yolov5s(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None, optimize=False):
     # YOLOv5-small model https://github.com/ultralytics/yolov5
-    return _create('yolov5s', pretrained, channels, classes, autoshape, verbose, device)
+    return _create('yolov5s', pretrained, channels, classes, autoshape, verbose, device, optimize)
 
 
-def yolov5m(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None):
+def yolov5m(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None, optimize=False):
     # YOLOv5-medium model https://github.com/ultralytics/yolov5
-    return _create('yolov5m', pretrained, channels, classes, autoshape, verbose, device)
+    return _create('yolov5m', pretrained, channels, classes, autoshape, verbose, device, optimize)
 
 
-def yolov5l(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None):
+def yolov5l(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None, optimize=False):
     # YOLOv5-large model https://github.com/ultralytics/yolov5
-    return _create('yolov5l', pretrained, channels, classes, autoshape, verbose, device)
+    return _create('yolov5l', pretrained, channels, classes, autoshape, verbose, device, optimize)
 
 
-def yolov5x(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None):
+def yolov5x(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None, optimize=False):
     # YOLOv5-xlarge model https://github.com/ultralytics/yolov5
-    return _create('yolov5x', pretrained, channels, classes, autoshape, verbose, device)
+    return _create('yolov5x', pretrained, channels, classes, autoshape, verbose, device, optimize)
 
 
-def yolov5n6(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None):
+def yolov5n6(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None, optimize=False):
     # YOLOv5-nano-P6 model https://github.com/ultralytics/yolov5
-    return _create('yolov5n6', pretrained, channels, classes, autoshape, verbose, device)
+    return _create('yolov5n6', pretrained, channels, classes, autoshape, verbose, device, optimize)
 
 
-def yolov5s6(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None):
+def yolov5s6(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None, optimize=False):
     # YOLOv5-small-P6 model https://github.com/ultralytics/yolov5
-    return _create('yolov5s6', pretrained, channels, classes, autoshape, verbose, device)
+    return _create('yolov5s6', pretrained, channels, classes, autoshape, verbose, device, optimize)
 
 
-def yolov5m6(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None):
+def yolov5m6(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None, optimize=False):
     # YOLOv5-medium-P6 model https://github.com/ultralytics/yolov5
-    return _create('yolov5m6', pretrained, channels, classes, autoshape, verbose, device)
+    return _create('yolov5m6', pretrained, channels, classes, autoshape, verbose, device, optimize)
 
 
-def yolov5l6(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None):
+def yolov5l6(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None, optimize=False):
     # YOLOv5-large-P6 model https://github.com/ultralytics/yolov5
-    return _create('yolov5l6', pretrained, channels, classes, autoshape, verbose, device)
+    return _create('yolov5l6', pretrained, channels, classes, autoshape, verbose, device, optimize)
 
 
-def yolov5x6(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None):
+def yolov5x6(pretrained=True, channels=3, classes=80, autoshape=True, verbose=True, device=None, optimize=False):
     # YOLOv5-xlarge-P6 model https://github.com/ultralytics/yolov5
-    return _create('yolov5x6', pretrained, channels, classes, autoshape, verbose, device)
+    return _create('yolov5x6', pretrained, channels, classes, autoshape, verbose, device, optimize)
 
 
 if __name__ == '__main__':
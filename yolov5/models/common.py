@@ -5,6 +5,7 @@ Common modules
 
 import logging
 import math
+import threading
 import warnings
 from copy import copy
 from pathlib import Path
@@ -284,6 +285,7 @@ class AutoShape(nn.Module):
     def __init__(self, model):
         super().__init__()
         self.model = model.eval()
+        self.pinned = {}  # reusable host input batch buffers by (thread, dtype), pinned on CUDA
 
     def autoshape(self):
         LOGGER.info('AutoShape already enabled, skipping... ')  # model already converted to model.autoshape()
@@ -297,8 +299,16 @@ class AutoShape(nn.Module):
         m.grid = list(map(fn, m.grid))
         if isinstance(m.anchor_grid, list):
             m.anchor_grid = list(map(fn, m.anchor_grid))
+        self.pinned = {}  # device may have changed
         return self
 
+    def _buffer(self, shape, dtype, pin=False):
+        # Host BHWC batch buffer of shape, grown as needed and reused across calls of the same thread
+        n, k = int(np.prod(shape)), (threading.get_ident(), dtype)  # concurrent calls do not share a buffer
+        if k not in self.pinned or self.pinned[k].numel() < n:
+            self.pinned[k] = torch.empty(n, dtype=dtype, pin_memory=pin)
+        return self.pinned[k][:n].view(shape)
+
     @torch.no_grad()
     def forward(self, imgs, size=640, augment=False, profile=False):
         # Inference from various sources. For height=640, width=1280, RGB images example inputs are:
@@ -307,14 +317,19 @@ class AutoShape(nn.Module):
         #   OpenCV:          = cv2.imread('image.jpg')[:,:,::-1]  # HWC BGR to RGB x(640,1280,3)
         #   PIL:             = Image.open('image.jpg') or ImageGrab.grab()  # HWC x(640,1280,3)
         #   numpy:           = np.zeros((640,1280,3))  # HWC
+        #   uint8 batch:     = np.zeros((16,640,1280,3), np.uint8) or torch.zeros(16,640,1280,3, dtype=torch.uint8)
         #   torch:           = torch.zeros(16,3,320,640)  # BCHW (scaled to size=640, 0-1 values)
         #   multiple:        = [Image.open('image1.jpg'), Image.open('image2.jpg'), ...]  # list of images
 
         t = [time_sync()]
         p = next(self.model.parameters())  # for device and type
-        if isinstance(imgs, torch.Tensor):  # torch
-            with amp.autocast(enabled=p.device.type != 'cpu'):
-                return self.model(imgs.to(p.device).type_as(p), augment, profile)  # inference
+        if isinstance(imgs, torch.Tensor):
+            if imgs.dtype != torch.uint8:  # torch
+                with amp.autocast(enabled=p.device.type != 'cpu'):
+                    return self.model(imgs.to(p.device).type_as(p), augment, profile)  # inference
+            imgs = imgs.cpu().numpy()  # uint8 HWC or BHWC, no copy on CPU
+        if isinstance(imgs, np.ndarray) and imgs.ndim == 4:
+            imgs = list(imgs)  # BHWC batch to list of HWC views
 
         # Pre-process
         n, imgs = (len(imgs), imgs) if isinstance(imgs, list) else (1, [imgs])  # number of images, list of images
@@ -326,6 +341,8 @@ class AutoShape(nn.Module):
                 im = np.asarray(exif_transpose(im))
             elif isinstance(im, Image.Image):  # PIL Image
                 im, f = np.asarray(exif_transpose(im)), getattr(im, 'filename', f) or f
+            elif isinstance(im, torch.Tensor):  # uint8 HWC
+                im = im.cpu().numpy()
             files.append(Path(f).with_suffix('.jpg').name)
             if im.shape[0] < 5:  # image in CHW
                 im = im.transpose((1, 2, 0))  # reverse dataloader .transpose(2, 0, 1)
@@ -336,10 +353,12 @@ class AutoShape(nn.Module):
             shape1.append([y * g for y in s])
             imgs[i] = im if im.data.contiguous else np.ascontiguousarray(im)  # update
         shape1 = [make_divisible(x, int(self.stride.max())) for x in np.stack(shape1, 0).max(0)]  # inference shape
-        x = [letterbox(im, new_shape=shape1, auto=False)[0] for im in imgs]  # pad
-        x = np.stack(x, 0) if n > 1 else x[0][None]  # stack
-        x = np.ascontiguousarray(x.transpose((0, 3, 1, 2)))  # BHWC to BCHW
-        x = torch.from_numpy(x).to(p.device).type_as(p) / 255.  # uint8 to fp16/32
+        dtype = torch.uint8 if all(im.dtype == np.uint8 for im in imgs) else torch.float32
+        x = self._buffer((n, *shape1, 3), dtype, pin=p.device.type == 'cuda')  # BHWC
+        for im, b in zip(imgs, x.numpy()):
+            letterbox(im, new_shape=shape1, auto=False, out=b)  # resize and pad into batch buffer
+        x = x.to(p.device, non_blocking=True).permute(0, 3, 1, 2).type_as(p)  # send the buffer as is, BHWC to BCHW view
+        x /= 255  # uint8 to fp16/32, 0 - 255 to 0.0 - 1.0
         t.append(time_sync())
 
         with amp.autocast(enabled=p.device.type != 'cpu'):
@@ -444,6 +463,26 @@ class Detections:
             setattr(new, k, [pd.DataFrame(x, columns=c) for x in a])
         return new
 
+    def numpy(self):
+        # return detections as structured numpy arrays with the pandas() columns, i.e. results.numpy().xyxy[0]['name']
+        new = copy(self)  # return copy
+        names = np.array(self.names)  # fixed width str
+        ca = 'xmin', 'ymin', 'xmax', 'ymax', 'confidence'  # xyxy columns
+        cb = 'xcenter', 'ycenter', 'width', 'height', 'confidence'  # xywh columns
+        for k, c in zip(['xyxy', 'xyxyn', 'xywh', 'xywhn'], [ca, ca, cb, cb]):
+            dtype = np.dtype([(x, np.float32) for x in c] + [('class', np.int32), ('name', names.dtype)])
+            a = []
+            for x in getattr(self, k):
+                x = x.float().cpu().numpy()
+                y = np.empty(len(x), dtype)
+                for i, f in enumerate(c):
+                    y[f] = x[:, i]
+                y['class'] = x[:, 5]
+                y['name'] = names[y['class']]
+                a.append(y)
+            setattr(new, k, a)
+        return new
+
     def tolist(self):
         # return a list of Detections objects, i.e. 'for result in results.tolist():'
         x = [Detections([self.imgs[i]], [self.pred[i]], self.names, self.s) for i in range(self.n)]
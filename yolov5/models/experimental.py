@@ -3,12 +3,22 @@
 Experimental modules
 """
 
+import hashlib
+import inspect
+import os
+import warnings
+from copy import deepcopy
+from pathlib import Path
+
 import numpy as np
 import torch
 import torch.nn as nn
 
 from models.common import Conv
 from utils.downloads import attempt_download
+from utils.general import user_config_dir
+
+TORCHSCRIPT_CACHE = Path(os.getenv('YOLOV5_TORCHSCRIPT_CACHE', user_config_dir() / 'torchscript'))  # compiled models
 
 
 class CrossConv(nn.Module):
@@ -117,3 +127,201 @@ def attempt_load(weights, map_location=None, inplace=True, fuse=True):
             setattr(model, k, getattr(model[-1], k))
         model.stride = model[torch.argmax(torch.tensor([m.stride.max() for m in model])).int()].stride  # max stride
         return model  # return ensemble
+
+
+class Compiled:
+    # Frozen channels_last TorchScript modules of a model, traced per input shape and cached on disk as
+    # <dir>/<key>_<shape>_<dtype>_<device>_torch<version>.torchscript, where key is the model weights hash.
+    # The directory keeps the max_files most recently used modules
+    max_files = 32  # compiled modules kept on disk
+
+    def __init__(self, model, key, cache_dir=TORCHSCRIPT_CACHE, max_shapes=8):
+        self.model, self.key, self.dir, self.max_shapes = model, key, Path(cache_dir), max_shapes
+        self.modules = {}  # (shape, dtype, device): ScriptModule
+
+    def __call__(self, x):
+        k = tuple(x.shape), x.dtype, x.device
+        if k not in self.modules:
+            if len(self.modules) >= self.max_shapes:  # i.e. many rect shapes, run eager
+                return self.model._forward_once(x)
+            self.modules[k] = self.load(x)
+        return self.modules[k](x.contiguous(memory_format=torch.channels_last))
+
+    def file(self, x):
+        dtype = str(x.dtype).replace('torch.', '')
+        return self.dir / f"{self.key}_{'x'.join(map(str, x.shape))}_{dtype}_{x.device.type}_torch{torch.__version__}" \
+                          f".torchscript"
+
+    def load(self, x):
+        # Load the module for input x from cache, else trace, freeze and save it
+        f = self.file(x)
+        if f.exists():
+            try:
+                ts = torch.jit.load(str(f), map_location=x.device)
+                os.utime(f)  # most recently used
+                return ts
+            except Exception as e:
+                print(f'WARNING: {f} could not be loaded ({e}), compiling again')
+        x = x.contiguous(memory_format=torch.channels_last)
+        with warnings.catch_warnings(), torch.no_grad():
+            warnings.simplefilter('ignore')  # suppress jit trace warning
+            ts = torch.jit.freeze(torch.jit.trace(self.model, x, strict=False).eval())
+        f.parent.mkdir(parents=True, exist_ok=True)
+        tmp = f.with_suffix(f'.{os.getpid()}.tmp')
+        torch.jit.save(ts, str(tmp))
+        tmp.replace(f)  # atomic, for concurrent processes
+        self.prune()
+        return ts
+
+    def prune(self):
+        # Delete all but the max_files most recently used modules in the cache directory
+        files = sorted(self.dir.glob('*.torchscript'), key=lambda f: f.stat().st_mtime, reverse=True)
+        for f in files[self.max_files:]:
+            try:
+                f.unlink()
+            except OSError:  # i.e. deleted by another process
+                pass
+
+    def __getstate__(self):
+        return {**self.__dict__, 'modules': {}}  # ScriptModules are not picklable, recompile or load from cache
+
+
+def weights_hash(model):
+    # Return SHA-256 hex digest of model state_dict names and values
+    h = hashlib.sha256()
+    for k, v in model.state_dict().items():
+        if isinstance(v, torch.Tensor):  # i.e. not packed params metadata of quantized layers
+            h.update(k.encode())
+            h.update(v.detach().cpu().flatten().view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def optimize_for_inference(model, imgsz=None, batch_size=1, cache_dir=TORCHSCRIPT_CACHE):
+    """ Compile a Model for inference: Conv+BN fused, channels_last, frozen TorchScript. Modules are traced on the
+    first call per input shape and cached on disk, keyed by weights hash, input shape and PyTorch version, so that
+    later runs load them instead of tracing again. For INT8 see quantize_static()
+    Usage: model = optimize_for_inference(attempt_load('yolov5s.pt'), imgsz=640)
+    Arguments
+        model:          Model, i.e. from attempt_load(). Already on its inference device and dtype
+        imgsz:          Inference size (pixels) int or (h, w) to compile at once, else on first call
+        batch_size:     Batch size to compile at once
+        cache_dir:      Directory of compiled modules
+    Returns
+        model, called as before
+    """
+    if isinstance(model, Ensemble):
+        print('WARNING: optimize_for_inference() does not support ensembles, skipping')
+        return model
+    if getattr(model, 'quantized', None):
+        print('WARNING: optimize_for_inference() does not support quantize_static() models, skipping')
+        return model
+    model.eval()
+    if any(hasattr(m, 'bn') for m in model.modules() if isinstance(m, Conv)):
+        model.fuse()
+    p = next(model.parameters())
+    for m in model.modules():
+        if isinstance(m, nn.Conv2d):
+            m.weight.data = m.weight.data.contiguous(memory_format=torch.channels_last)
+    model.compiled = Compiled(model, weights_hash(model)[:16], cache_dir)
+    if imgsz:
+        imgsz = (imgsz, imgsz) if isinstance(imgsz, int) else imgsz
+        model(torch.zeros(batch_size, 3, *imgsz, device=p.device, dtype=p.dtype))  # compile or load
+    return model
+
+
+def profile_optimize_for_inference(weights='yolov5s.pt', imgsz=640, batch_sizes=(1, 8), n=10, cache_dir=None):
+    """ Profile optimize_for_inference() vs the eager fused model: cold start compile and cached load times,
+    steady-state latency and max output difference
+    Usage: from models.experimental import *; profile_optimize_for_inference('yolov5s.pt')
+    Arguments
+        weights:        Model weights, or model yaml for random weights
+        imgsz:          Inference size (pixels)
+        batch_sizes:    Batch sizes to profile
+        n:              Number of timed steps per batch size
+        cache_dir:      Directory of compiled modules, temporary if None
+    """
+    import tempfile
+
+    from models.yolo import Model
+    from utils.general import check_yaml
+    from utils.torch_utils import time_sync
+
+    def load():
+        return attempt_load(weights, map_location='cpu') if str(weights).endswith('.pt') else \
+            Model(check_yaml(weights)).fuse().eval()
+
+    torch.manual_seed(0)
+    tmp = tempfile.TemporaryDirectory()
+    cache_dir = cache_dir or tmp.name
+    eager, results = load(), []
+    print(f"{'batch':>6}{'compile (s)':>13}{'load (s)':>10}{'eager (ms)':>12}{'optimized':>11}{'max diff':>10}")
+    for bs in batch_sizes:
+        x = torch.rand(bs, 3, imgsz, imgsz)
+        ts = []
+        for _ in range(2):  # cold start then cached load, in a new model each
+            model = load()
+            t = time_sync()
+            optimize_for_inference(model, imgsz, bs, cache_dir=cache_dir)
+            ts.append(time_sync() - t)
+        dt = []
+        with torch.no_grad():
+            for m in eager, model:
+                m(x)  # warmup
+                t = time_sync()
+                for _ in range(n):
+                    m(x)
+                dt.append((time_sync() - t) / n * 1E3)
+            diff = (model(x)[0] - eager(x)[0]).abs().max().item()
+        results.append((bs, *ts, *dt, diff))
+        print(f'{bs:>6}{ts[0]:>13.2f}{ts[1]:>10.2f}{dt[0]:>12.1f}{dt[1]:>11.1f}{diff:>10.2g}')
+    tmp.cleanup()
+    return results
+
+
+class Features(nn.Module):
+    # Model layers before Detect(), returns the Detect() input feature maps. Traced by quantize_static()
+    def __init__(self, model):
+        super().__init__()
+        self.model, self.save, self.f = model.model[:-1], model.save, model.model[-1].f
+
+    def forward(self, x):
+        y = []  # outputs
+        for m in self.model:
+            if m.f != -1:  # if not from previous layer
+                x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
+            x = m(x)  # run
+            y.append(x if m.i in self.save else None)  # save output
+        return [y[j] for j in self.f]
+
+
+def quantize_static(model, dataloader, ncalib=100):
+    """ Post-training static INT8 quantization (PyTorch FX, CPU) of a Model backbone and neck. Activation ranges are
+    calibrated on ncalib batches of dataloader. Detect() stays FP32 for box decoding, and the FP32 layers are kept for
+    training, augmented inference and non-CPU devices
+    Usage: model = quantize_static(attempt_load('best.pt'), create_dataloader(...)[0]); torch.save({'model': model}, f)
+    Arguments
+        model:          Model, i.e. from attempt_load()
+        dataloader:     LoadImagesAndLabels dataloader of calibration images
+        ncalib:         Number of calibration batches
+    Returns
+        model, with the INT8 GraphModule as model.quantized
+    """
+    from torch.quantization import get_default_qconfig
+    from torch.quantization.quantize_fx import convert_fx, prepare_fx
+    from tqdm import tqdm
+
+    assert not isinstance(model, Ensemble), 'quantize_static() does not support ensembles'
+    model = model.cpu().float().eval()
+    model.quantized = None  # calibrate the FP32 layers
+    s = int(model.stride.max())
+    qconfig = {'': get_default_qconfig(torch.backends.quantized.engine)}  # fbgemm (x86) or qnnpack (ARM)
+    kwargs = {'example_inputs': (torch.zeros(1, 3, s, s),)} if \
+        'example_inputs' in inspect.signature(prepare_fx).parameters else {}  # torch>=1.13
+    prepared = prepare_fx(Features(deepcopy(model)).eval(), qconfig, **kwargs)
+    with torch.no_grad():
+        for i, (img, *_) in enumerate(tqdm(dataloader, desc='Calibrating', total=min(ncalib, len(dataloader)))):
+            if i == ncalib:
+                break
+            prepared(img.float() / 255.0)  # uint8 to 0.0 - 1.0
+    model.quantized = convert_fx(prepared)
+    return model
@@ -8,6 +8,7 @@ Usage:
 
 import argparse
 import sys
+from collections import OrderedDict
 from copy import deepcopy
 from pathlib import Path
 
@@ -36,6 +37,7 @@ LOGGER = logging.getLogger(__name__)
 class Detect(nn.Module):
     stride = None  # strides computed during build
     onnx_dynamic = False  # ONNX export parameter
+    cache = 32  # number of (grid, anchor_grid) pairs kept in the LRU cache
 
     def __init__(self, nc=80, anchors=(), ch=(), inplace=True):  # detection layer
         super().__init__()
@@ -50,27 +52,63 @@ class Detect(nn.Module):
         self.inplace = inplace  # use in-place ops (e.g. slice assignment)
 
     def forward(self, x):
-        z = []  # inference output
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
+        if self.training:
+            return x
 
-            if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4] or self.onnx_dynamic:
-                    self.grid[i], self.anchor_grid[i] = self._make_grid(nx, ny, i)
-
-                y = x[i].sigmoid()
-                if self.inplace:
-                    y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
-                else:  # for YOLOv5 on AWS Inferentia https://github.com/ultralytics/yolov5/pull/2953
-                    xy = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    wh = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
-                    y = torch.cat((xy, wh, y[..., 4:]), -1)
-                z.append(y.view(bs, -1, self.no))
-
-        return x if self.training else (torch.cat(z, 1), x)
+        # Inference
+        if self.inplace and not (self.onnx_dynamic or torch.jit.is_tracing() or x[0].requires_grad):
+            return self._decode(x), x  # fused decode, not traceable or differentiable
+        z = []  # inference output
+        for i in range(self.nl):
+            bs, _, ny, nx, _ = x[i].shape
+            if self.grid[i].shape[2:4] != x[i].shape[2:4] or self.onnx_dynamic:
+                self.grid[i], self.anchor_grid[i] = self._make_grid(nx, ny, i)
+
+            y = x[i].sigmoid()
+            if self.inplace:
+                y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
+                y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+            else:  # for YOLOv5 on AWS Inferentia https://github.com/ultralytics/yolov5/pull/2953
+                xy = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
+                wh = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                y = torch.cat((xy, wh, y[..., 4:]), -1)
+            z.append(y.view(bs, -1, self.no))
+        return torch.cat(z, 1), x
+
+    def _decode(self, x):
+        # Decode all layers in place into one preallocated (bs, n, no) output, no per-layer outputs or torch.cat()
+        n = [xi[0].numel() // self.no for xi in x]  # outputs per image per layer
+        z = torch.empty((x[0].shape[0], sum(n), self.no), dtype=x[0].dtype, device=x[0].device)
+        for i, y in enumerate(z.split(n, 1)):
+            y = y.view(x[i].shape)  # (bs,3,ny,nx,no) view of z
+            grid, anchor_grid = self._get_grid(i, x[i])
+            torch.sigmoid(x[i], out=y)
+            y[..., 0:2].mul_(2.).sub_(0.5).add_(grid).mul_(self.stride[i])  # xy
+            y[..., 2:4].mul_(2).pow_(2).mul_(anchor_grid)  # wh
+        return z
+
+    def _get_grid(self, i, x):
+        # (grid, anchor_grid) for layer i and output x from an LRU cache keyed by (layer, ny, nx, dtype, device)
+        grids = self.__dict__.setdefault('grids', OrderedDict())  # created here for models loaded from checkpoints
+        k = i, *x.shape[2:4], x.dtype, x.device
+        if k in grids:
+            grids.move_to_end(k)
+        else:
+            grids[k] = tuple(g.to(x) for g in self._make_grid(k[2], k[1], i))  # x dtype and device
+            if len(grids) > self.cache:
+                grids.popitem(last=False)  # least recently used
+        self.grid[i], self.anchor_grid[i] = grids[k]
+        return grids[k]
+
+    def __getstate__(self):
+        # Do not pickle or deepcopy cached grids into checkpoints and EMA copies
+        state = self.__dict__.copy()
+        state.pop('grids', None)
+        return state
 
     def _make_grid(self, nx=20, ny=20, i=0):
         d = self.anchors[i].device
@@ -123,6 +161,10 @@ class Model(nn.Module):
     def forward(self, x, augment=False, profile=False, visualize=False):
         if augment:
             return self._forward_augment(x)  # augmented inference, None
+        if getattr(self, 'quantized', None) and x.device.type == 'cpu' and not (profile or visualize or self.training):
+            return self.model[-1](self.quantized(x))  # INT8 backbone and neck from quantize_static()
+        if getattr(self, 'compiled', None) and not (profile or visualize or self.training or torch.jit.is_tracing()):
+            return self.compiled(x)  # TorchScript from optimize_for_inference()
         return self._forward_once(x, profile, visualize)  # single-scale inference, train
 
     def _forward_augment(self, x):
@@ -0,0 +1,59 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Parity test of ComputeLoss.build_targets(), all detection layers at once, against build_targets_layers(), the original
+one layer at a time implementation
+
+Usage:
+    $ python -m pytest path/to/test_loss.py
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+import yaml
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from models.yolo import Model  # noqa: E402
+from utils.loss import ComputeLoss  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def loss():
+    model = Model(ROOT / 'models/yolov5s.yaml', nc=6)  # Lego classes
+    with open(ROOT / 'data/hyps/hyp.scratch.yaml', errors='ignore') as f:
+        model.hyp = yaml.safe_load(f)
+    return ComputeLoss(model)
+
+
+def targets(bs, nt, nc=6, seed=0):
+    # Synthetic (image, class, x, y, w, h) normalized labels, in image order as the dataloader collates them
+    gen = torch.Generator().manual_seed(seed)
+    return torch.cat((torch.randint(0, bs, (nt, 1), generator=gen).sort(0)[0].float(),  # image
+                      torch.randint(0, nc, (nt, 1), generator=gen).float(),  # class
+                      torch.rand(nt, 2, generator=gen),  # xy
+                      torch.rand(nt, 2, generator=gen) ** 2 * 0.8 + 0.005), 1)  # wh
+
+
+@pytest.mark.parametrize('bs, nt, img_size', [(16, 0, 640), (16, 1, 640), (16, 128, 640), (64, 600, 640),
+                                              (8, 40, 320), (4, 20, (640, 480))])
+def test_build_targets_parity(loss, bs, nt, img_size):
+    h, w = (img_size, img_size) if isinstance(img_size, int) else img_size
+    p = [torch.zeros(bs, loss.na, h // s, w // s, loss.nc + 5) for s in (8, 16, 32)]  # P3-P5 predictions
+    for seed in range(3):  # several label sets through the same ComputeLoss, i.e. reused buffers
+        t = targets(bs, nt, loss.nc, seed)
+        tcls, tbox, indices, anch = loss.build_targets(p, t.clone())
+        tcls_ref, tbox_ref, indices_ref, anch_ref = loss.build_targets_layers(p, t.clone())
+        assert len(tcls) == len(tbox) == len(indices) == len(anch) == loss.nl
+        for i in range(loss.nl):  # same values in the same order, per layer
+            assert torch.equal(tcls[i], tcls_ref[i])
+            assert torch.equal(tbox[i], tbox_ref[i])
+            assert torch.equal(anch[i], anch_ref[i])
+            assert len(indices[i]) == len(indices_ref[i]) == 4  # image, anchor, grid y, grid x
+            for u, v in zip(indices[i], indices_ref[i]):
+                assert torch.equal(u, v)
@@ -0,0 +1,107 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Parity tests of the grouped interp(), compute_ap_groups() and ap_per_class() against np.interp(), compute_ap() and the
+original per-class ap_per_class()
+
+Usage:
+    $ python -m pytest path/to/test_metrics.py
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from utils.metrics import ap_per_class, compute_ap, compute_ap_groups, interp  # noqa: E402
+
+
+def ap_per_class_reference(tp, conf, pred_cls, target_cls):
+    # Original ap_per_class(), one class at a time, kept as the reference
+    i = np.argsort(-conf)
+    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
+    unique_classes = np.unique(target_cls)
+    nc = unique_classes.shape[0]
+    px = np.linspace(0, 1, 1000)
+    ap, p, r = np.zeros((nc, tp.shape[1])), np.zeros((nc, 1000)), np.zeros((nc, 1000))
+    for ci, c in enumerate(unique_classes):
+        i = pred_cls == c
+        n_l = (target_cls == c).sum()  # number of labels
+        n_p = i.sum()  # number of predictions
+        if n_p == 0 or n_l == 0:
+            continue
+        fpc = (1 - tp[i]).cumsum(0)
+        tpc = tp[i].cumsum(0)
+        recall = tpc / (n_l + 1e-16)
+        r[ci] = np.interp(-px, -conf[i], recall[:, 0], left=0)
+        precision = tpc / (tpc + fpc)
+        p[ci] = np.interp(-px, -conf[i], precision[:, 0], left=1)
+        for j in range(tp.shape[1]):
+            ap[ci, j], _, _ = compute_ap(recall[:, j], precision[:, j])
+    f1 = 2 * p * r / (p + r + 1e-16)
+    i = f1.mean(0).argmax()
+    return p[:, i], r[:, i], ap, f1[:, i], unique_classes.astype('int32')
+
+
+def stats(n, nc=6, decimals=None, seed=0):
+    # Synthetic val.py statistics. Class nc has predictions but no labels, class nc - 1 labels but no predictions.
+    # Confidences rounded to decimals have many duplicates
+    rng = np.random.default_rng(seed)
+    iou = rng.random(n) * rng.integers(0, 2, n)  # IoU of each prediction with its best label, 0 if none
+    tp = iou[:, None] > np.linspace(0.5, 0.95, 10)  # (n, 10) for mAP@0.5:0.95
+    conf = rng.random(n).astype(np.float32)
+    if decimals is not None:
+        conf = conf.round(decimals)
+    pred_cls = rng.choice([*range(nc - 1), nc], n).astype(np.float32)
+    target_cls = rng.integers(0, nc, max(n // 3, nc)).astype(np.float32)
+    target_cls[:nc] = range(nc)  # every class 0 to nc - 1 has labels
+    return tp, conf, pred_cls, target_cls
+
+
+@pytest.mark.parametrize('n, decimals', [(1, None), (50, None), (5000, None), (5000, 2), (5000, 0), (120000, None),
+                                         (120000, 3)])  # 120000 predictions and 10 IoUs take the grouped path
+def test_ap_per_class_parity(n, decimals):
+    x = stats(n, decimals=decimals)
+    for a, b in zip(ap_per_class(*x, names={}), ap_per_class_reference(*x)):
+        np.testing.assert_allclose(a, b, rtol=0, atol=1e-12)
+
+
+def test_interp_parity():
+    rng = np.random.default_rng(0)
+    n = [0, 1, 2, 7, 30, 0, 100]  # data points per group, including groups without any
+    gp = np.repeat(np.arange(len(n)), n)
+    xp = np.concatenate([np.sort(rng.integers(0, 10, k)) / 10 for k in n])  # duplicate xp
+    fp = rng.random(len(xp))
+    for x in np.linspace(-0.5, 1.5, 41), np.arange(0, 10) / 10:  # between, outside, and exactly at data points
+        gx = np.repeat(np.arange(len(n)), len(x))
+        xs = np.tile(x, len(n))
+        for left, right in (None, None), (0, 1):
+            y = interp(xs, gx, xp, fp, gp, left=left, right=right).reshape(len(n), -1)
+            for g, k in enumerate(n):
+                if k:
+                    np.testing.assert_array_equal(y[g], np.interp(x, xp[gp == g], fp[gp == g], left=left, right=right))
+                else:
+                    assert np.isnan(y[g]).all()  # no data points
+
+
+def test_compute_ap_groups_parity():
+    rng = np.random.default_rng(0)
+    n = [0, 1, 5, 64, 1000, 3]  # points per curve, including a curve without any
+    curves = []
+    for k in n:
+        tp = rng.integers(0, 2, k)
+        tpc = tp.cumsum()
+        curves.append((tpc / (tpc[-1] + 1 if k else 1), tpc / np.arange(1, k + 1)))  # recall, precision
+    curves.append((np.full(4, 0.5), np.full(4, 0.5)))  # duplicate points
+    g = np.repeat(np.arange(len(curves)), [len(r) for r, _ in curves])
+    ap, mpre, mrec, gm = compute_ap_groups(*(np.concatenate(x) for x in zip(*curves)), g, len(curves))
+    for i, (recall, precision) in enumerate(curves):
+        ap_ref, mpre_ref, mrec_ref = compute_ap(recall, precision)
+        np.testing.assert_array_equal(mpre[gm == i], mpre_ref)
+        np.testing.assert_array_equal(mrec[gm == i], mrec_ref)
+        np.testing.assert_allclose(ap[i], ap_ref, rtol=0, atol=1e-12)
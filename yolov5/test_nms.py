@@ -0,0 +1,110 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Parity test of the batched non_max_suppression() against the original per-image loop
+
+Usage:
+    $ python -m pytest path/to/test_nms.py
+"""
+
+import sys
+import time
+from pathlib import Path
+
+import pytest
+import torch
+import torchvision
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from utils.general import non_max_suppression, xywh2xyxy  # noqa: E402
+
+
+def non_max_suppression_reference(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                                  multi_label=False, labels=(), max_det=300):
+    # Original non_max_suppression(), one image at a time in float32, kept as the reference
+    nc = prediction.shape[2] - 5  # number of classes
+    xc = prediction[..., 4] > conf_thres  # candidates
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
+    time_limit = 10.0  # seconds to quit after
+    multi_label &= nc > 1  # multiple labels per box
+
+    t = time.time()
+    output = [torch.zeros((0, 6), device=prediction.device)] * prediction.shape[0]
+    for xi, x in enumerate(prediction):  # image index, image inference
+        x = x[xc[xi]]  # confidence
+        if labels and len(labels[xi]):
+            l = labels[xi]
+            v = torch.zeros((len(l), nc + 5), device=x.device)
+            v[:, :4] = l[:, 1:5]  # box
+            v[:, 4] = 1.0  # conf
+            v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
+            x = torch.cat((x, v), 0)
+        if not x.shape[0]:
+            continue
+        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+        box = xywh2xyxy(x[:, :4])
+        if multi_label:
+            i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+            x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
+        else:  # best class only
+            conf, j = x[:, 5:].max(1, keepdim=True)
+            x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
+        if classes is not None:
+            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
+        n = x.shape[0]  # number of boxes
+        if not n:
+            continue
+        elif n > max_nms:  # excess boxes
+            x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
+        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
+        if i.shape[0] > max_det:  # limit detections
+            i = i[:max_det]
+        output[xi] = x[i]
+        if (time.time() - t) > time_limit:
+            break  # time limit exceeded
+    return output
+
+
+def predictions(bs, nc=6, img_size=640, seed=0):
+    # Synthetic YOLOv5 outputs. Coordinates are continuous, so IoUs exactly at the threshold, which float64 NMS may
+    # resolve differently from the original float32 NMS, do not occur
+    gen = torch.Generator().manual_seed(seed)
+    na = sum(3 * (img_size // s) ** 2 for s in (8, 16, 32))  # number of anchors
+    p = torch.rand(bs, na, nc + 5, generator=gen)
+    p[..., :2] *= img_size  # xy
+    p[..., 2:4] = p[..., 2:4] * img_size / 4 + 4  # wh
+    p[..., 4] **= 60  # few confident objects
+    p[..., 5:] **= 200  # and classes
+    return p
+
+
+@pytest.mark.parametrize('bs', [1, 8, 32])
+@pytest.mark.parametrize('kwargs', [dict(conf_thres=0.001, iou_thres=0.6, multi_label=True),  # val.py
+                                    dict(conf_thres=0.25, iou_thres=0.45, max_det=1000),  # detect.py
+                                    dict(conf_thres=0.25, iou_thres=0.45, agnostic=True, classes=[0, 2])],
+                         ids=['val', 'detect', 'agnostic-classes'])
+def test_nms_parity(bs, kwargs):
+    p = predictions(bs)
+    y = non_max_suppression(p.clone(), **kwargs)
+    y_ref = non_max_suppression_reference(p.clone(), **kwargs)
+    assert len(y) == len(y_ref) == bs
+    for a, b in zip(y, y_ref):
+        assert torch.equal(a, b)
+
+
+def test_nms_parity_labels():
+    # val.py --save-hybrid, apriori labels (cls, xywh) per image
+    p = predictions(4)
+    gen = torch.Generator().manual_seed(1)
+    labels = [torch.cat((torch.randint(0, 6, (n, 1), generator=gen).float(),
+                         torch.rand(n, 2, generator=gen) * 640,
+                         torch.rand(n, 2, generator=gen) * 160 + 4), 1) for n in (3, 0, 5, 1)]
+    kwargs = dict(conf_thres=0.001, iou_thres=0.6, multi_label=True, labels=labels)
+    for a, b in zip(non_max_suppression(p.clone(), **kwargs), non_max_suppression_reference(p.clone(), **kwargs)):
+        assert torch.equal(a, b)
@@ -89,8 +89,9 @@ def replicate(im, labels):
     return im, labels
 
 
-def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
-    # Resize and pad image while meeting stride-multiple constraints
+def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32,
+              out=None):
+    # Resize and pad image while meeting stride-multiple constraints, into the preallocated HWC array out if given
     shape = im.shape[:2]  # current shape [height, width]
     if isinstance(new_shape, int):
         new_shape = (new_shape, new_shape)
@@ -114,10 +115,19 @@ def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleF
     dw /= 2  # divide padding into 2 sides
     dh /= 2
 
-    if shape[::-1] != new_unpad:  # resize
-        im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
     top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
     left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    if out is not None:  # resize straight into out and fill only the border, no intermediate copies
+        h, w = new_unpad[1], new_unpad[0]
+        assert out.shape[:2] == (top + h + bottom, left + w + right), f'out shape {out.shape} != letterbox shape'
+        x = out[top:top + h, left:left + w]
+        y = cv2.resize(im, new_unpad, dst=x, interpolation=cv2.INTER_LINEAR) if shape[::-1] != new_unpad else im
+        if y is not x:  # not resized, or dst not reusable (i.e. dtype mismatch)
+            x[:] = y
+        out[:top], out[top + h:], out[top:top + h, :left], out[top:top + h, left + w:] = color, color, color, color
+        return out, ratio, (dw, dh)
+    if shape[::-1] != new_unpad:  # resize
+        im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
     im = cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
     return im, ratio, (dw, dh)
 
@@ -129,11 +139,42 @@ def random_perspective(im, targets=(), segments=(), degrees=10, translate=.1, sc
 
     height = im.shape[0] + border[0] * 2  # shape(h,w,c)
     width = im.shape[1] + border[1] * 2
+    M, s = random_perspective_matrix(im.shape, degrees, translate, scale, shear, perspective, border)
+
+    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
+        if perspective:
+            im = cv2.warpPerspective(im, M, dsize=(width, height), borderValue=(114, 114, 114))
+        else:  # affine
+            im = cv2.warpAffine(im, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+
+    # Visualize
+    # import matplotlib.pyplot as plt
+    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
+    # ax[0].imshow(im[:, :, ::-1])  # base
+    # ax[1].imshow(im2[:, :, ::-1])  # warped
+
+    return im, warp_labels(targets, segments, M, s, width, height, perspective)
+
+
+def random_perspective_mosaic(tiles, shape, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10,
+                              perspective=0.0, border=(0, 0)):
+    # random_perspective() of a mosaic of shape(h,w) given as tiles (see warp_tiles()), without assembling the mosaic
+    height = shape[0] + border[0] * 2
+    width = shape[1] + border[1] * 2
+    M, s = random_perspective_matrix(shape, degrees, translate, scale, shear, perspective, border)
+    im = warp_tiles(tiles, M, dsize=(width, height), perspective=perspective)
+    return im, warp_labels(targets, segments, M, s, width, height, perspective)
+
+
+def random_perspective_matrix(shape, degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0, border=(0, 0)):
+    # Returns random 3x3 perspective matrix M for an image of shape(h,w), and its scale s
+    height = shape[0] + border[0] * 2
+    width = shape[1] + border[1] * 2
 
     # Center
     C = np.eye(3)
-    C[0, 2] = -im.shape[1] / 2  # x translation (pixels)
-    C[1, 2] = -im.shape[0] / 2  # y translation (pixels)
+    C[0, 2] = -shape[1] / 2  # x translation (pixels)
+    C[1, 2] = -shape[0] / 2  # y translation (pixels)
 
     # Perspective
     P = np.eye(3)
@@ -160,19 +201,11 @@ def random_perspective(im, targets=(), segments=(), degrees=10, translate=.1, sc
 
     # Combined rotation matrix
     M = T @ S @ R @ P @ C  # order of operations (right to left) is IMPORTANT
-    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
-        if perspective:
-            im = cv2.warpPerspective(im, M, dsize=(width, height), borderValue=(114, 114, 114))
-        else:  # affine
-            im = cv2.warpAffine(im, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+    return M, s
 
-    # Visualize
-    # import matplotlib.pyplot as plt
-    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
-    # ax[0].imshow(im[:, :, ::-1])  # base
-    # ax[1].imshow(im2[:, :, ::-1])  # warped
 
-    # Transform label coordinates
+def warp_labels(targets, segments, M, s, width, height, perspective=0.0):
+    # Transform label coordinates by perspective matrix M of scale s, into an image of size width x height
     n = len(targets)
     if n:
         use_segments = any(x.any() for x in segments)
@@ -208,7 +241,57 @@ def random_perspective(im, targets=(), segments=(), degrees=10, translate=.1, sc
         targets = targets[i]
         targets[:, 1:5] = new[i]
 
-    return im, targets
+    return targets
+
+
+def mosaic_canvas(tiles, shape):
+    # Assemble mosaic of shape(h,w) from tiles (see warp_tiles())
+    im = np.full((*shape, tiles[0][0].shape[2]), 114, dtype=np.uint8)
+    for t, (x1, y1, x2, y2), (padw, padh) in tiles:
+        if x2 > x1 and y2 > y1:  # in mosaic
+            im[y1 + padh:y2 + padh, x1 + padw:x2 + padw] = t[y1:y2, x1:x2]
+    return im
+
+
+def warp_tiles(tiles, M, dsize, perspective=0.0):
+    # Warp mosaic tiles by perspective matrix M into an image of dsize(w,h), as if warping the assembled mosaic
+    # tiles = [(im, (x1, y1, x2, y2) region of im in the mosaic, (padw, padh) offset of im in the mosaic)], later
+    # tiles on top. Each tile is only warped onto the output pixels it covers, so the mosaic is never assembled
+    w, h = dsize
+    out = np.full((h, w, tiles[0][0].shape[2]), 114, dtype=np.uint8)
+    for t, (x1, y1, x2, y2), (padw, padh) in tiles:
+        if x2 <= x1 or y2 <= y1:  # not in mosaic
+            continue
+
+        # Take a 1 pixel margin where the image has one, to interpolate across the seams between tiles
+        x1, y1, x2, y2 = max(x1 - 1, 0), max(y1 - 1, 0), min(x2 + 1, t.shape[1]), min(y2 + 1, t.shape[0])
+
+        # Output pixels covered by the tile, from its warped corners
+        xy = np.array([[x1, y1, 1], [x2, y1, 1], [x1, y2, 1], [x2, y2, 1]], dtype=np.float64)
+        xy[:, :2] += (padw, padh)
+        xy = xy @ M.T
+        xy = xy[:, :2] / xy[:, 2:3] if perspective else xy[:, :2]
+        ox1, oy1 = np.floor(xy.min(0)).clip(0, (w, h)).astype(int)
+        ox2, oy2 = np.ceil(xy.max(0)).clip(0, (w, h)).astype(int)
+        if ox2 <= ox1 or oy2 <= oy1:  # not in output
+            continue
+
+        # Composite of: tile region to mosaic, M, output to covered pixels
+        T = np.eye(3)
+        T[:2, 2] = x1 + padw, y1 + padh
+        To = np.eye(3)
+        To[:2, 2] = -ox1, -oy1
+        Mt = To @ M @ T
+
+        # Warp in place onto the covered pixels only, leaving those outside of the tile as they are
+        patch = out[oy1:oy2, ox1:ox2]  # view
+        if perspective:
+            cv2.warpPerspective(t[y1:y2, x1:x2], Mt, dsize=(ox2 - ox1, oy2 - oy1), dst=patch,
+                                borderMode=cv2.BORDER_TRANSPARENT)
+        else:  # affine
+            cv2.warpAffine(t[y1:y2, x1:x2], Mt[:2], dsize=(ox2 - ox1, oy2 - oy1), dst=patch,
+                           borderMode=cv2.BORDER_TRANSPARENT)
+    return out
 
 
 def copy_paste(im, labels, segments, p=0.5):
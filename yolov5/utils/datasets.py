@@ -3,6 +3,7 @@
 Dataloaders and dataset utils
 """
 
+import atexit
 import glob
 import hashlib
 import json
@@ -10,11 +11,14 @@ import logging
 import os
 import random
 import shutil
+import tempfile
 import time
-from itertools import repeat
+from collections import deque
+from itertools import islice, repeat
 from multiprocessing.pool import ThreadPool, Pool
 from pathlib import Path
-from threading import Thread
+from queue import Queue
+from threading import Condition, Thread
 from zipfile import ZipFile
 
 import cv2
@@ -26,8 +30,9 @@ from PIL import Image, ExifTags
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
-from utils.augmentations import Albumentations, augment_hsv, copy_paste, letterbox, mixup, random_perspective
-from utils.general import check_dataset, check_requirements, check_yaml, clean_str, segments2boxes, \
+from utils.augmentations import Albumentations, augment_hsv, copy_paste, letterbox, mixup, mosaic_canvas, \
+    random_perspective, random_perspective_mosaic
+from utils.general import ROOT, check_dataset, check_requirements, check_yaml, clean_str, segments2boxes, \
     xywh2xyxy, xywhn2xyxy, xyxy2xywhn, xyn2xy
 from utils.torch_utils import torch_distributed_zero_first
 
@@ -51,6 +56,15 @@ def get_hash(paths):
     return h.hexdigest()  # return hash
 
 
+def get_stat(path):
+    # Returns (size, mtime) of a file, or None if it doesn't exist, to tell whether it changed since it was cached
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return None
+
+
 def exif_size(img):
     # Returns exif-corrected PIL size
     s = img.size  # (width, height)
@@ -155,9 +169,59 @@ class _RepeatSampler(object):
             yield from iter(self.sampler)
 
 
+class BatchCache:
+    """ Dataloader wrapper that keeps the batches of its first full pass and replays them afterwards, for a dataset that
+    yields the same batches every time (val_loader: rect, no augmentation, no shuffle)
+
+    Images are kept as collated letterboxed uint8, in ram, or with cache='disk' packed into one memory-mapped file
+    """
+
+    def __init__(self, loader, cache='ram'):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.disk = cache == 'disk'
+        self.file = Path(tempfile.gettempdir()) / f'yolov5_batches_{os.getpid()}_{id(self)}.cache'  # if disk
+        self.batches = None  # (img, targets, paths, shapes) per batch once cached, img as (offset, shape) if disk
+        self.data = None  # memory-mapped file
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.batches is not None:
+            for img, targets, paths, shapes in self.batches:
+                if self.disk:  # copy-on-write view of the file
+                    (offset, shape), n = img, int(np.prod(img[1]))
+                    img = torch.from_numpy(self.data[offset:offset + n].reshape(shape))
+                yield img, targets.clone(), paths, shapes  # val.run() scales targets in place
+            return
+
+        # First pass, cache while yielding
+        batches, offset, f = [], 0, None
+        if self.disk:
+            f = open(self.file, 'wb')
+            atexit.register(self.file.unlink, missing_ok=True)
+        try:
+            for img, targets, paths, shapes in self.loader:
+                if self.disk:
+                    im = np.ascontiguousarray(img.numpy())
+                    f.write(im.data)
+                    batches.append(((offset, im.shape), targets.clone(), paths, shapes))
+                    offset += im.nbytes
+                else:  # own copy, not a pinned or shared memory DataLoader buffer
+                    batches.append((img.clone(), targets.clone(), paths, shapes))
+                yield img, targets, paths, shapes
+        finally:
+            if f:
+                f.close()
+        if self.disk:
+            self.data = np.memmap(self.file, dtype=np.uint8, mode='c')
+        self.batches = batches
+
+
 class LoadImages:
     # YOLOv5 image/video dataloader, i.e. `python detect.py --source image.jpg/vid.mp4`
-    def __init__(self, path, img_size=640, stride=32, auto=True):
+    def __init__(self, path, img_size=640, stride=32, auto=True, batch_size=1, workers=NUM_THREADS):
         p = str(Path(path).resolve())  # os-agnostic absolute path
         if '*' in p:
             files = sorted(glob.glob(p, recursive=True))  # glob
@@ -179,6 +243,8 @@ class LoadImages:
         self.video_flag = [False] * ni + [True] * nv
         self.mode = 'image'
         self.auto = auto
+        self.batch_size = batch_size  # iterate batches() if > 1
+        self.workers = workers  # batches() loading threads
         if any(videos):
             self.new_video(videos[0])  # new video
         else:
@@ -188,7 +254,68 @@ class LoadImages:
 
     def __iter__(self):
         self.count = 0
-        return self
+        return self if self.batch_size == 1 else self.batches()
+
+    def batches(self):
+        # Yields batches of up to batch_size same-shape images, or frames of one video, as LoadStreams does, while
+        # worker threads read and letterbox the images of the next batches. Sets index and frame to the file index and
+        # video frame number of each image, and fps to the FPS of each video file
+        pool, queue = ThreadPool(self.workers), Queue(maxsize=2)  # double buffered
+        self.fps = [0] * self.nf
+
+        def frames():  # (file index, frame number, video frame or None to read image) in order
+            for i, path in enumerate(self.files):
+                if self.video_flag[i]:
+                    cap = cv2.VideoCapture(path)
+                    self.fps[i] = cap.get(cv2.CAP_PROP_FPS)
+                    n, (ret_val, img0) = 1, cap.read()
+                    while ret_val:
+                        yield i, n, img0
+                        n, (ret_val, img0) = n + 1, cap.read()
+                    cap.release()
+                else:
+                    yield i, 0, None
+
+        def load(i, frame, img0):
+            if img0 is None:
+                img0 = cv2.imread(self.files[i])  # BGR
+                assert img0 is not None, 'Image Not Found ' + self.files[i]
+            return i, frame, img0, letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]
+
+        def collate(batch):
+            index, frame, img0, img = zip(*batch)
+            img = np.stack(img, 0)[..., ::-1].transpose((0, 3, 1, 2))  # BGR to RGB, BHWC to BCHW
+            return list(index), list(frame), list(img0), np.ascontiguousarray(img)
+
+        def produce():
+            try:
+                pending = (pool.apply_async(load, x) for x in frames())  # submitted as taken
+                window, batch = deque(islice(pending, 2 * self.batch_size)), []  # loading ahead
+                while window:
+                    x = window.popleft().get()
+                    window.extend(islice(pending, 1))
+                    if batch and (len(batch) == self.batch_size or x[3].shape != batch[-1][3].shape or
+                                  x[0] != batch[-1][0] and self.video_flag[x[0]]):  # full, new shape or new video
+                        queue.put(collate(batch))
+                        batch = []
+                    batch.append(x)
+                if batch:
+                    queue.put(collate(batch))
+                queue.put(None)
+            except Exception as e:
+                queue.put(e)  # raise in main thread
+
+        Thread(target=produce, daemon=True).start()
+        while True:
+            batch = queue.get()
+            if isinstance(batch, Exception):
+                raise batch
+            if batch is None:
+                break
+            self.index, self.frame, img0, img = batch
+            self.mode = 'video' if self.video_flag[self.index[0]] else 'image'
+            yield [self.files[i] for i in self.index], img, img0, None
+        pool.close()
 
     def __next__(self):
         if self.count == self.nf:
@@ -281,7 +408,11 @@ class LoadWebcam:  # for inference
 
 class LoadStreams:
     # YOLOv5 streamloader, i.e. `python detect.py --source 'rtsp://example.com/media.mp4'  # RTSP, RTMP, HTTP streams`
-    def __init__(self, sources='streams.txt', img_size=640, stride=32, auto=True):
+    # Each source is read by its own thread into a ring buffer of timestamped frames. A scheduler thread batches the
+    # latest frame of up to batch_size sources, waiting at most deadline seconds for more sources once one is ready,
+    # letterboxes the batch on a thread pool and queues it, so the next batch is prepared while this one is inferred
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, auto=True, batch_size=None, deadline=0.05,
+                 buffer=4, drop=True):
         self.mode = 'stream'
         self.img_size = img_size
         self.stride = stride
@@ -296,6 +427,13 @@ class LoadStreams:
         self.imgs, self.fps, self.frames, self.threads = [None] * n, [0] * n, [0] * n, [None] * n
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
         self.auto = auto
+        self.batch_size = min(batch_size or n, n)  # max sources per batch
+        self.deadline = deadline  # max seconds to wait for a fuller batch
+        self.drop = drop  # serve the latest frame of each source and drop older ones, else serve every frame in order
+        self.buffers = [deque(maxlen=buffer) for _ in range(n)]  # ring buffers of (timestamp, frame number, image)
+        self.read, self.served, self.latency = [0] * n, [0] * n, [[] for _ in range(n)]  # stats, see stats()
+        self.cond = Condition()  # guards buffers, notified on new frames, served frames and closing
+        self.closed = False
         for i, s in enumerate(sources):  # index, source
             # Start thread to read frames from video stream
             print(f'{i + 1}/{n}: {s}... ', end='')
@@ -312,9 +450,10 @@ class LoadStreams:
             self.frames[i] = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0) or float('inf')  # infinite stream fallback
 
             _, self.imgs[i] = cap.read()  # guarantee first frame
+            self.buffers[i].append((time.time(), 1, self.imgs[i]))
+            self.read[i] = 1
             self.threads[i] = Thread(target=self.update, args=([i, cap, s]), daemon=True)
             print(f" success ({self.frames[i]} frames {w}x{h} at {self.fps[i]:.2f} FPS)")
-            self.threads[i].start()
         print('')  # newline
 
         # check for common shapes
@@ -323,22 +462,77 @@ class LoadStreams:
         if not self.rect:
             print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
 
+        # Start readers, then the scheduler feeding a queue of one prepared batch
+        self.pool = ThreadPool(min(NUM_THREADS, self.batch_size))  # letterbox workers
+        self.queue = Queue(maxsize=1)
+        for t in self.threads:
+            t.start()
+        self.scheduler = Thread(target=self.schedule, daemon=True)
+        self.scheduler.start()
+
     def update(self, i, cap, stream):
         # Read stream `i` frames in daemon thread
-        n, f, read = 0, self.frames[i], 1  # frame number, frame array, inference every 'read' frame
-        while cap.isOpened() and n < f:
+        n, f, read = 1, self.frames[i], 1  # frame number, frame array, inference every 'read' frame
+        buffer = self.buffers[i]
+        while cap.isOpened() and n < f and not self.closed:
             n += 1
             # _, self.imgs[index] = cap.read()
             cap.grab()
             if n % read == 0:
                 success, im = cap.retrieve()
                 if success:
-                    self.imgs[i] = im
+                    with self.cond:
+                        while not self.drop and len(buffer) == buffer.maxlen and not self.closed:
+                            self.cond.wait()  # serving every frame, wait for room
+                        buffer.append((time.time(), n, im))  # drops the oldest frame when full
+                        self.read[i] += 1
+                        self.cond.notify_all()
                 else:
                     print('WARNING: Video stream unresponsive, please check your IP camera connection.')
-                    self.imgs[i] *= 0
                     cap.open(stream)  # re-open stream if signal was lost
             time.sleep(1 / self.fps[i])  # wait time
+        with self.cond:
+            self.cond.notify_all()  # wake the scheduler to notice this source ended
+
+    def schedule(self):
+        # Batch frames from the ring buffers in daemon thread, None marks the end of all streams
+        while True:
+            with self.cond:
+                ready = lambda: [i for i, b in enumerate(self.buffers) if b]
+                alive = lambda: sum(t.is_alive() for t in self.threads)
+                while not ready() and alive() and not self.closed:
+                    self.cond.wait(0.1)
+                if self.closed or not ready():  # closed, or all streams ended and served
+                    break
+
+                # Wait for a full batch from the sources still live, up to deadline
+                t = time.time() + self.deadline
+                while len(ready()) < min(self.batch_size, alive()) and time.time() < t and not self.closed:
+                    self.cond.wait(t - time.time())
+
+                # Take the sources whose pending frame is oldest, one frame each
+                index = sorted(ready(), key=lambda i: self.buffers[i][0][0])[:self.batch_size]
+                batch = []
+                for i in index:
+                    x = self.buffers[i].pop() if self.drop else self.buffers[i].popleft()
+                    if self.drop:
+                        self.buffers[i].clear()  # older frames are dropped
+                    self.served[i] += 1
+                    batch.append(x)
+                self.cond.notify_all()  # room for readers in order mode
+
+            # Letterbox and stack
+            img0 = [x[2] for x in batch]
+            auto = self.rect and self.auto
+            img = self.pool.map(lambda x: letterbox(x, self.img_size, stride=self.stride, auto=auto)[0], img0)
+            img = np.stack(img, 0)
+
+            # Convert
+            img = img[..., ::-1].transpose((0, 3, 1, 2))  # BGR to RGB, BHWC to BCHW
+            img = np.ascontiguousarray(img)
+
+            self.queue.put((index, img, img0, [x[0] for x in batch], [x[1] for x in batch]))
+        self.queue.put(None)
 
     def __iter__(self):
         self.count = -1
@@ -346,22 +540,36 @@ class LoadStreams:
 
     def __next__(self):
         self.count += 1
-        if not all(x.is_alive() for x in self.threads) or cv2.waitKey(1) == ord('q'):  # q to quit
-            cv2.destroyAllWindows()
+        batch = None if self.closed else self.queue.get()
+        if batch is None:
+            self.close()
             raise StopIteration
 
-        # Letterbox
-        img0 = self.imgs.copy()
-        img = [letterbox(x, self.img_size, stride=self.stride, auto=self.rect and self.auto)[0] for x in img0]
-
-        # Stack
-        img = np.stack(img, 0)
-
-        # Convert
-        img = img[..., ::-1].transpose((0, 3, 1, 2))  # BGR to RGB, BHWC to BCHW
-        img = np.ascontiguousarray(img)
-
-        return self.sources, img, img0, None
+        # Batch of len(self.index) <= batch_size sources, with each frame's capture time and frame number
+        self.index, img, img0, self.stamps, self.frame = batch
+        return [self.sources[i] for i in self.index], img, img0, None
+
+    def done(self, i, stamp):
+        # Record the end-to-end latency of a frame of source i captured at stamp, once its results are out
+        self.latency[i].append(time.time() - stamp)
+
+    def stats(self):
+        # Returns per source stats: frames read and served, frames dropped and end-to-end latency (s) mean and 95%
+        stats = []
+        for i, s in enumerate(self.sources):
+            t = np.array(self.latency[i] or [np.nan])
+            stats.append({'source': s, 'read': self.read[i], 'served': self.served[i],
+                          'dropped': self.read[i] - self.served[i] - len(self.buffers[i]),
+                          'latency': np.mean(t), 'latency95': np.percentile(t, 95)})
+        return stats
+
+    def close(self):
+        # Stop readers and scheduler
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        while not self.queue.empty():  # unblock scheduler
+            self.queue.get_nowait()
 
     def __len__(self):
         return len(self.sources)  # 1E12 frames = 32 streams at 30 FPS for 30 years
@@ -373,9 +581,229 @@ def img2label_paths(img_paths):
     return [sb.join(x.rsplit(sa, 1)).rsplit('.', 1)[0] + '.txt' for x in img_paths]
 
 
+class SharedImageCache:
+    # Images packed into one memory-mapped arena file with an offset/shape index, for --cache ram
+    # Every process on a node that opens the same file (DataLoader workers, DDP ranks) maps it zero-copy, so images are
+    # decoded once per node. The arena lives in /dev/shm when there is room, else in the temp dir (page cache).
+    # The process that built an arena deletes it on exit. If it is killed hard, the complete arena stays and is reused
+    # by the next run on the same images, while partial arenas in /dev/shm are deleted by the next run's path()
+    version = 0.1  # arena layout version
+
+    def __init__(self, file):
+        self.file = Path(file)  # arena file, index is saved next to it
+        self.index_file = self.file.with_suffix('.index.npz')
+        self.data = None  # memory-mapped arena, opened on first use in each process
+        self.offsets, self.shapes, self.hw0 = None, None, None
+        self.owner = None  # pid of the process that built the arena, and deletes it on exit
+
+    @staticmethod
+    def path(img_files, img_size, augment, nbytes=0):
+        # Returns arena path for these images at this size. An existing arena is used wherever it is, as the room it
+        # takes is no longer free, else a new one goes to /dev/shm if it has nbytes free, else to the temp dir
+        key = hashlib.md5(f'{get_hash(img_files)}{img_size}{augment}{SharedImageCache.version}'.encode()).hexdigest()
+        shm, tmp = Path('/dev/shm'), Path(tempfile.gettempdir())
+        roots = [shm, tmp] if shm.is_dir() and os.access(shm, os.W_OK) else [tmp]
+        if shm in roots:
+            SharedImageCache.clean(shm)
+        for root in roots:
+            cache = SharedImageCache(root / f'yolov5_{key}.cache')
+            if cache.exists():
+                return cache.file
+        root = roots[0] if shutil.disk_usage(roots[0]).free > 1.1 * nbytes else tmp
+        return root / f'yolov5_{key}.cache'
+
+    @staticmethod
+    def clean(root, age=60):
+        # Delete partial arenas left in root by builders that were killed: temporary files of processes that no longer
+        # run, and arenas without an index that are older than age seconds (the index follows the arena at once)
+        for f in [*root.glob('yolov5_*.*.tmp'), *root.glob('yolov5_*.*.npz')]:  # {stem}.{pid}.tmp and .npz
+            pid = f.suffixes[-2][1:]
+            if not pid.isnumeric():  # an arena index
+                continue
+            try:
+                os.kill(int(pid), 0)  # posix only, as /dev/shm
+            except ProcessLookupError:  # builder is gone
+                f.unlink(missing_ok=True)
+            except PermissionError:  # builder runs as another user
+                pass
+        for f in root.glob('yolov5_*.cache'):
+            try:
+                if not f.with_suffix('.index.npz').exists() and time.time() - f.stat().st_mtime > age:
+                    f.unlink()
+            except FileNotFoundError:  # deleted by another process meanwhile
+                pass
+
+    def exists(self):
+        # The index is written last, so an arena is complete once its index exists
+        return self.index_file.exists() and self.file.exists()
+
+    def load(self):
+        # Attach to a complete arena
+        with np.load(self.index_file) as x:
+            self.offsets, self.shapes, self.hw0 = x['offsets'], x['shapes'], x['hw0']
+        self.data = np.memmap(self.file, dtype=np.uint8, mode='r')
+        return self
+
+    def build(self, images):
+        # Write images from iterable of (im, hw_original, hw_resized) into a new arena, and attach to it once done
+        # Generator, yields bytes written so far after each image
+        tmp = self.file.with_name(f'{self.file.stem}.{os.getpid()}.tmp')  # concurrent builders don't collide
+        offsets, shapes, hw0 = [0], [], []
+        with open(tmp, 'wb') as f:
+            for im, hw_original, _ in images:
+                im = np.ascontiguousarray(im)
+                f.write(im.data)
+                offsets.append(offsets[-1] + im.nbytes)
+                shapes.append(im.shape)
+                hw0.append(hw_original)
+                yield offsets[-1]
+        tmp_index = tmp.with_suffix('.npz')
+        np.savez(tmp_index, offsets=np.array(offsets, dtype=np.int64), shapes=np.array(shapes, dtype=np.int32),
+                 hw0=np.array(hw0, dtype=np.int32))
+        os.replace(tmp, self.file)
+        os.replace(tmp_index, self.index_file)  # last, marks the arena complete
+        self.owner = os.getpid()
+        atexit.register(self.unlink)
+        self.load()
+
+    def unlink(self):
+        # Delete arena files, only from the process that built them. Mappings in other processes stay valid
+        if self.owner == os.getpid():
+            for f in self.file, self.index_file:
+                f.unlink(missing_ok=True)
+
+    @property
+    def hw(self):
+        return [tuple(x) for x in self.shapes[:, :2].tolist()]  # resized hw of each image
+
+    @property
+    def nbytes(self):
+        return int(self.offsets[-1])
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, i):
+        if self.data is None:
+            self.load()
+        return self.data[self.offsets[i]:self.offsets[i + 1]].reshape(self.shapes[i])  # read-only view, no copy
+
+    def __getstate__(self):
+        # Pickle the path, not the mapped images, so spawned workers map the arena instead of receiving a copy
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+
+class PackedImageCache:
+    # Resized images packed into a few large shard files with an index, for --cache disk
+    # Reading an image is a slice of a memory-mapped shard instead of an open() and np.load() of its own .npy file.
+    # When images are added to the dataset, only those are decoded, into a new shard
+    version = 0.1  # cache layout version
+    shard_size = 4E9  # bytes per shard file, a new one is started after this
+
+    def __init__(self, path, img_files, img_size, augment):
+        self.path = Path(path) / f"{img_size}{'_augment' if augment else ''}"  # cache directory per image size
+        self.index_file = self.path / 'index.cache'
+        self.img_files = img_files
+        self.params = img_size, augment  # resized images depend on these
+        self.entries = {}  # img_file: (shard, offset, shape, hw_original, file size)
+        self.data = {}  # memory-mapped shards, opened on first use in each process
+
+    def load(self):
+        # Return index on disk, {} if there is none of this layout and image size
+        try:
+            x = np.load(self.index_file, allow_pickle=True).item()  # load dict
+            assert x['version'] == self.version and x['params'] == self.params  # same layout and image sizes
+            return x
+        except:
+            return {}
+
+    def check(self):
+        # Load index, keeping images whose files are unchanged. Returns indices of images that need caching
+        x = self.load()
+        if not x:
+            return list(range(len(self.img_files)))
+        if x['hash'] == get_hash(self.img_files):  # same files
+            self.entries = x['entries']
+            return []
+
+        # Keep images with the same file size, and start over if most of the shards would be dead space
+        self.entries = {f: e for f, e in x['entries'].items() if os.path.exists(f) and os.path.getsize(f) == e[4]}
+        used = sum(np.prod(e[2]) for e in self.entries.values())
+        if used < 0.5 * sum(f.stat().st_size for f in self.path.glob('shard*.bin')):
+            self.entries = {}
+        missing = [i for i, f in enumerate(self.img_files) if f not in self.entries]
+        if not missing:
+            self.save()  # only removed images, index them under the new hash
+        return missing
+
+    def update(self, images, indices):
+        # Write images from iterable of (im, hw_original, hw_resized) for img_files indices into new shards
+        # Generator, yields bytes written so far after each image
+        self.path.mkdir(parents=True, exist_ok=True)
+        files = {int(f.stem[5:]): f for f in self.path.glob('shard*.bin')}
+        # Shards of the index on disk may still be mapped by other datasets, keep them until the next update
+        used = {e[0] for x in (self.entries, self.load().get('entries', {})) for e in x.values()}
+        for k, f in files.items():
+            if k not in used:
+                f.unlink()  # no longer used
+        shard, offset, f, nbytes = max(files, default=-1), self.shard_size, None, 0  # never overwrite a shard
+        try:
+            for i, (im, hw_original, _) in zip(indices, images):
+                if offset >= self.shard_size:  # start a new shard
+                    if f:
+                        f.close()
+                    shard, offset = shard + 1, 0
+                    f = open(self.path / f'shard{shard}.bin', 'wb')
+                im = np.ascontiguousarray(im)
+                f.write(im.data)
+                size = os.path.getsize(self.img_files[i])
+                self.entries[self.img_files[i]] = shard, offset, im.shape, hw_original, size
+                offset += im.nbytes
+                nbytes += im.nbytes
+                yield nbytes
+        finally:
+            if f:
+                f.close()
+        self.save()
+
+    def save(self):
+        # Save index for next time
+        x = {'entries': self.entries, 'hash': get_hash(self.img_files), 'params': self.params, 'version': self.version}
+        try:
+            np.save(self.index_file, x)
+            self.index_file.with_suffix('.cache.npy').rename(self.index_file)  # remove .npy suffix
+        except Exception as e:
+            logging.info(f'WARNING: Cache directory {self.path} is not writeable: {e}')  # path not writeable
+
+    @property
+    def hw0(self):
+        return [tuple(self.entries[f][3]) for f in self.img_files]  # original hw of each image
+
+    @property
+    def hw(self):
+        return [tuple(self.entries[f][2][:2]) for f in self.img_files]  # resized hw of each image
+
+    def __len__(self):
+        return len(self.img_files)
+
+    def __getitem__(self, i):
+        shard, offset, shape = self.entries[self.img_files[i]][:3]
+        if shard not in self.data:
+            self.data[shard] = np.memmap(self.path / f'shard{shard}.bin', dtype=np.uint8, mode='r')
+        return self.data[shard][offset:offset + np.prod(shape)].reshape(shape)  # read-only view, no copy
+
+    def __getstate__(self):
+        # Pickle the paths, not the mapped shards, so workers map them themselves
+        state = self.__dict__.copy()
+        state['data'] = {}
+        return state
+
+
 class LoadImagesAndLabels(Dataset):
     # YOLOv5 train_loader/val_loader, loads images and labels for training and validation
-    cache_version = 0.6  # dataset labels *.cache version
+    cache_version = 0.7  # dataset labels *.cache version
 
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
                  cache_images=False, single_cls=False, stride=32, pad=0.0, prefix=''):
@@ -417,9 +845,12 @@ class LoadImagesAndLabels(Dataset):
         try:
             cache, exists = np.load(cache_path, allow_pickle=True).item(), True  # load dict
             assert cache['version'] == self.cache_version  # same version
-            assert cache['hash'] == get_hash(self.label_files + self.img_files)  # same hash
         except:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # cache
+            cache, exists = None, False
+        if not exists:
+            cache = self.cache_labels(cache_path, prefix)  # cache
+        elif cache['hash'] != get_hash(self.label_files + self.img_files):  # files changed
+            cache, exists = self.cache_labels(cache_path, prefix, cache), False  # update cache
 
         # Display cache
         nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupted, total
@@ -431,7 +862,7 @@ class LoadImagesAndLabels(Dataset):
         assert nf > 0 or not augment, f'{prefix}No labels in {cache_path}. Can not train without labels. See {HELP_URL}'
 
         # Read cache
-        [cache.pop(k) for k in ('hash', 'version', 'msgs')]  # remove items
+        [cache.pop(k) for k in ('hash', 'version', 'msgs', 'stats')]  # remove items
         labels, shapes, self.segments = zip(*cache.values())
         self.labels = list(labels)
         self.shapes = np.array(shapes, dtype=np.float64)
@@ -483,36 +914,63 @@ class LoadImagesAndLabels(Dataset):
             self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(np.int) * stride
 
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
-        self.imgs, self.img_npy = [None] * n, [None] * n
-        if cache_images:
-            if cache_images == 'disk':
-                self.im_cache_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_npy')
-                self.img_npy = [self.im_cache_dir / Path(f).with_suffix('.npy').name for f in self.img_files]
-                self.im_cache_dir.mkdir(parents=True, exist_ok=True)
-            gb = 0  # Gigabytes of cached images
-            self.img_hw0, self.img_hw = [None] * n, [None] * n
-            results = ThreadPool(NUM_THREADS).imap(lambda x: load_image(*x), zip(repeat(self), range(n)))
-            pbar = tqdm(enumerate(results), total=n)
-            for i, x in pbar:
-                if cache_images == 'disk':
-                    if not self.img_npy[i].exists():
-                        np.save(self.img_npy[i].as_posix(), x[0])
-                    gb += self.img_npy[i].stat().st_size
-                else:
-                    self.imgs[i], self.img_hw0[i], self.img_hw[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
-                    gb += self.imgs[i].nbytes
-                pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB {cache_images})'
-            pbar.close()
-
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
+        self.imgs = [None] * n
+        if cache_images and cache_images != 'disk':  # 'ram'
+            # One shared arena per node, built by the first process and mapped by all others (see SharedImageCache)
+            r = img_size / self.shapes.max(1)  # resize ratios
+            nbytes = (np.floor(self.shapes * r[:, None]).prod(1) * 3).sum()  # estimated size of resized images
+            cache = SharedImageCache(SharedImageCache.path(self.img_files, img_size, augment, nbytes))
+            if cache.exists():
+                cache.load()
+                logging.info(f'{prefix}Using cached images ({cache.nbytes / 1E9:.1f}GB ram) from {cache.file}')
+            else:
+                results = ThreadPool(NUM_THREADS).imap(lambda x: load_image(*x), zip(repeat(self), range(n)))
+                pbar = tqdm(cache.build(results), total=n)
+                for gb in pbar:
+                    pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB {cache_images})'
+                pbar.close()
+            self.imgs, self.img_hw0, self.img_hw = cache, [tuple(x) for x in cache.hw0.tolist()], cache.hw
+        elif cache_images == 'disk':
+            # Packed into shards next to the images, where later runs only add new or changed images
+            cache = PackedImageCache(Path(self.img_files[0]).parent.as_posix() + '_cache', self.img_files, img_size,
+                                     augment)
+            missing = cache.check()
+            if missing:
+                results = ThreadPool(NUM_THREADS).imap(lambda x: load_image(*x), zip(repeat(self), missing))
+                pbar = tqdm(cache.update(results, missing), total=len(missing))
+                for gb in pbar:
+                    pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB {cache_images})'
+                pbar.close()
+            self.imgs, self.img_hw0, self.img_hw = cache, cache.hw0, cache.hw
+
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', cache=None):
         # Cache dataset labels, check images and read shapes
-        x = {}  # dict
+        # Image-label pairs whose files have the same size and mtime as in a previous cache are taken from it as is
+        x, stats = {}, {}  # dict, {im_file: ((im_file stat, lb_file stat), (nm, nf, ne, nc), msg)}
         nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number missing, found, empty, corrupt, messages
         desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
+        old = cache.get('stats', {}) if cache else {}
+        new = []  # image-label pairs to verify
+        for im_file, lb_file in zip(self.img_files, self.label_files):
+            stat = get_stat(im_file), get_stat(lb_file)
+            if im_file in old and old[im_file][0] == stat:  # unchanged
+                stats[im_file] = old[im_file]
+                if im_file in cache:
+                    x[im_file] = cache[im_file]
+            else:
+                new.append((im_file, lb_file))
+        for _, (nm_f, nf_f, ne_f, nc_f), msg in stats.values():
+            nm += nm_f
+            nf += nf_f
+            ne += ne_f
+            nc += nc_f
+            if msg:
+                msgs.append(msg)
+        if stats:
+            desc += f' {len(stats)} cached,'
         with Pool(NUM_THREADS) as pool:
-            pbar = tqdm(pool.imap(verify_image_label, zip(self.img_files, self.label_files, repeat(prefix))),
-                        desc=desc, total=len(self.img_files))
-            for im_file, l, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
+            pbar = tqdm(pool.imap(verify_image_label, ((f, lb, prefix) for f, lb in new)), desc=desc, total=len(new))
+            for (f, lb_file), (im_file, l, shape, segments, nm_f, nf_f, ne_f, nc_f, msg) in zip(new, pbar):
                 nm += nm_f
                 nf += nf_f
                 ne += ne_f
@@ -521,8 +979,11 @@ class LoadImagesAndLabels(Dataset):
                     x[im_file] = [l, shape, segments]
                 if msg:
                     msgs.append(msg)
+                stats[f] = (get_stat(f), get_stat(lb_file)), (nm_f, nf_f, ne_f, nc_f), msg  # after any JPEG re-save
                 pbar.desc = f"{desc}{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
 
+        x = {f: x[f] for f in self.img_files if f in x}  # in file order
+        x['stats'] = stats
         pbar.close()
         if msgs:
             logging.info('\n'.join(msgs))
@@ -659,14 +1120,10 @@ class LoadImagesAndLabels(Dataset):
 def load_image(self, i):
     # loads 1 image from dataset index 'i', returns im, original hw, resized hw
     im = self.imgs[i]
-    if im is None:  # not cached in ram
-        npy = self.img_npy[i]
-        if npy and npy.exists():  # load npy
-            im = np.load(npy)
-        else:  # read image
-            path = self.img_files[i]
-            im = cv2.imread(path)  # BGR
-            assert im is not None, 'Image Not Found ' + path
+    if im is None:  # not cached
+        path = self.img_files[i]
+        im = cv2.imread(path)  # BGR
+        assert im is not None, 'Image Not Found ' + path
         h0, w0 = im.shape[:2]  # orig hw
         r = self.img_size / max(h0, w0)  # ratio
         if r != 1:  # if sizes are not equal
@@ -677,41 +1134,35 @@ def load_image(self, i):
         return self.imgs[i], self.img_hw0[i], self.img_hw[i]  # im, hw_original, hw_resized
 
 
-def load_mosaic(self, index):
+def load_mosaic(self, index, fused=True):
     # YOLOv5 4-mosaic loader. Loads 1 image + 3 random images into a 4-image mosaic
-    labels4, segments4 = [], []
+    labels4, segments4, tiles = [], [], []
     s = self.img_size
     yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
     indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
     random.shuffle(indices)
-    for i, index in enumerate(indices):
-        # Load image
-        img, _, (h, w) = load_image(self, index)
 
-        # place img in img4
-        if i == 0:  # top left
-            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
-            x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
-            x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
-        elif i == 1:  # top right
-            x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, s * 2), yc
-            x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
-        elif i == 2:  # bottom left
-            x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(s * 2, yc + h)
-            x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
-        elif i == 3:  # bottom right
-            x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
-            x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
-
-        img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
-        padw = x1a - x1b
-        padh = y1a - y1b
+    # Load images
+    imgs, _, hw = zip(*(load_image(self, index) for index in indices))
+    h, w = np.array(hw).T
+
+    # Place images top left, top right, bottom left, bottom right of the mosaic center
+    left, top = np.array([1, 0, 1, 0], dtype=bool), np.array([1, 1, 0, 0], dtype=bool)
+    x1a, x2a = np.where(left, np.maximum(xc - w, 0), xc), np.where(left, xc, np.minimum(xc + w, s * 2))  # large image
+    y1a, y2a = np.where(top, np.maximum(yc - h, 0), yc), np.where(top, yc, np.minimum(yc + h, s * 2))
+    x1b, x2b = np.where(left, w - (x2a - x1a), 0), np.where(left, w, np.minimum(w, x2a - x1a))  # small image
+    y1b, y2b = np.where(top, h - (y2a - y1a), 0), np.where(top, h, np.minimum(y2a - y1a, h))
+    padw, padh = x1a - x1b, y1a - y1b
+    x1b, y1b, x2b, y2b, padw, padh, w, h = (x.tolist() for x in (x1b, y1b, x2b, y2b, padw, padh, w, h))  # to int
+
+    for i, index in enumerate(indices):
+        tiles.append((imgs[i], (x1b[i], y1b[i], x2b[i], y2b[i]), (padw[i], padh[i])))
 
         # Labels
         labels, segments = self.labels[index].copy(), self.segments[index].copy()
         if labels.size:
-            labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
-            segments = [xyn2xy(x, w, h, padw, padh) for x in segments]
+            labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w[i], h[i], padw[i], padh[i])  # normalized xywh to pixel xyxy
+            segments = [xyn2xy(x, w[i], h[i], padw[i], padh[i]) for x in segments]
         labels4.append(labels)
         segments4.extend(segments)
 
@@ -722,21 +1173,12 @@ def load_mosaic(self, index):
     # img4, labels4 = replicate(img4, labels4)  # replicate
 
     # Augment
-    img4, labels4, segments4 = copy_paste(img4, labels4, segments4, p=self.hyp['copy_paste'])
-    img4, labels4 = random_perspective(img4, labels4, segments4,
-                                       degrees=self.hyp['degrees'],
-                                       translate=self.hyp['translate'],
-                                       scale=self.hyp['scale'],
-                                       shear=self.hyp['shear'],
-                                       perspective=self.hyp['perspective'],
-                                       border=self.mosaic_border)  # border to remove
+    return augment_mosaic(self, tiles, labels4, segments4, fused)
 
-    return img4, labels4
 
-
-def load_mosaic9(self, index):
+def load_mosaic9(self, index, fused=True):
     # YOLOv5 9-mosaic loader. Loads 1 image + 8 random images into a 9-image mosaic
-    labels9, segments9 = [], []
+    labels9, segments9, tiles = [], [], []
     s = self.img_size
     indices = [index] + random.choices(self.indices, k=8)  # 8 additional image indices
     random.shuffle(indices)
@@ -746,7 +1188,6 @@ def load_mosaic9(self, index):
 
         # place img in img9
         if i == 0:  # center
-            img9 = np.full((s * 3, s * 3, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
             h0, w0 = h, w
             c = s, s, s + w, s + h  # xmin, ymin, xmax, ymax (base) coordinates
         elif i == 1:  # top
@@ -778,12 +1219,15 @@ def load_mosaic9(self, index):
         segments9.extend(segments)
 
         # Image
-        img9[y1:y2, x1:x2] = img[y1 - pady:, x1 - padx:]  # img9[ymin:ymax, xmin:xmax]
+        tiles.append((img, (x1 - padx, y1 - pady, x2 - padx, y2 - pady), (padx, pady)))  # img9[ymin:ymax, xmin:xmax]
         hp, wp = h, w  # height, width previous
 
     # Offset
     yc, xc = [int(random.uniform(0, s)) for _ in self.mosaic_border]  # mosaic center x, y
-    img9 = img9[yc:yc + 2 * s, xc:xc + 2 * s]
+    for i, (img, (x1, y1, x2, y2), (padx, pady)) in enumerate(tiles):  # crop img9[yc:yc + 2 * s, xc:xc + 2 * s]
+        x1, y1 = max(x1, xc - padx), max(y1, yc - pady)
+        x2, y2 = min(x2, xc + 2 * s - padx), min(y2, yc + 2 * s - pady)
+        tiles[i] = img, (x1, y1, x2, y2), (padx - xc, pady - yc)
 
     # Concat/clip labels
     labels9 = np.concatenate(labels9, 0)
@@ -797,15 +1241,49 @@ def load_mosaic9(self, index):
     # img9, labels9 = replicate(img9, labels9)  # replicate
 
     # Augment
-    img9, labels9 = random_perspective(img9, labels9, segments9,
-                                       degrees=self.hyp['degrees'],
-                                       translate=self.hyp['translate'],
-                                       scale=self.hyp['scale'],
-                                       shear=self.hyp['shear'],
-                                       perspective=self.hyp['perspective'],
-                                       border=self.mosaic_border)  # border to remove
-
-    return img9, labels9
+    return augment_mosaic(self, tiles, labels9, segments9, fused)
+
+
+def augment_mosaic(self, tiles, labels, segments, fused=True):
+    # Copy-paste and random_perspective() augment a mosaic given as tiles. Tiles are warped straight into the output if
+    # fused, unless copy-paste needs the assembled mosaic
+    s = self.img_size
+    hyp = self.hyp
+    if not fused or (hyp['copy_paste'] and segments):
+        img = mosaic_canvas(tiles, (s * 2, s * 2))
+        img, labels, segments = copy_paste(img, labels, segments, p=hyp['copy_paste'])
+        return random_perspective(img, labels, segments, degrees=hyp['degrees'], translate=hyp['translate'],
+                                  scale=hyp['scale'], shear=hyp['shear'], perspective=hyp['perspective'],
+                                  border=self.mosaic_border)  # border to remove
+    return random_perspective_mosaic(tiles, (s * 2, s * 2), labels, segments, degrees=hyp['degrees'],
+                                     translate=hyp['translate'], scale=hyp['scale'], shear=hyp['shear'],
+                                     perspective=hyp['perspective'], border=self.mosaic_border)  # border to remove
+
+
+def profile_mosaic(path='../datasets/coco128/images/train2017', img_size=640, hyp=ROOT / 'data/hyps/hyp.scratch.yaml',
+                   n=200):
+    """ Profile mosaic loading speed of a single DataLoader worker, fused vs. assembled mosaic
+    Usage: from utils.datasets import *; profile_mosaic()
+    Arguments
+        path:           Path to images directory, or *.txt file of image paths
+        img_size:       Training image size
+        hyp:            Hyperparameters *.yaml
+        n:              Number of samples to time for each loader
+    """
+    with open(hyp, errors='ignore') as f:
+        hyp = yaml.safe_load(f)
+    dataset = LoadImagesAndLabels(path, img_size, augment=True, hyp=hyp, cache_images='ram')  # time decoding out
+    results = {}
+    for loader in load_mosaic, load_mosaic9:
+        for fused in False, True:
+            random.seed(0)
+            loader(dataset, 0, fused)  # warmup
+            t = time.time()
+            for i in range(n):
+                loader(dataset, i % dataset.n, fused)
+            results[(loader.__name__, fused)] = x = n / (time.time() - t)
+            print(f"{loader.__name__:>13}{' (fused)' if fused else '':>9}: {x:.1f} samples/s per worker")
+    return results
 
 
 def create_folder(path='./new'):
@@ -1,13 +1,55 @@
-"""Perform test request"""
+"""Perform test request, or generate concurrent load with --requests and --concurrency"""
+import argparse
 import pprint
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
+import numpy as np
 import requests
 
 DETECTION_URL = "http://localhost:5000/v1/object-detection/yolov5s"
+STATS_URL = "http://localhost:5000/v1/stats"
 TEST_IMAGE = "zidane.jpg"
 
-image_data = open(TEST_IMAGE, "rb").read()
 
-response = requests.post(DETECTION_URL, files={"image": image_data}).json()
+def load(url, images, n=200, concurrency=16):
+    # POST n requests cycling over images from concurrency threads, returns client side latencies (s) and wall time
+    def worker(i):
+        with requests.Session() as s:  # one keep-alive connection per thread
+            dt = []
+            for j in range(i, n, concurrency):
+                t = time.perf_counter()
+                s.post(url, files={"image": images[j % len(images)]}).raise_for_status()
+                dt.append(time.perf_counter() - t)
+            return dt
 
-pprint.pprint(response)
+    t = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        dt = np.concatenate([np.array(x) for x in pool.map(worker, range(concurrency))])
+    return dt, time.perf_counter() - t
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="YOLOv5 REST API test request and load generator")
+    parser.add_argument("--url", default=DETECTION_URL, help="detection endpoint")
+    parser.add_argument("--stats-url", default=STATS_URL, help="server stats endpoint")
+    parser.add_argument("--source", default=TEST_IMAGE, help="image file or directory of images")
+    parser.add_argument("--requests", type=int, default=0, help="total requests to send, 0 for a single request")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    opt = parser.parse_args()
+
+    p = Path(opt.source)
+    files = sorted(f for f in p.iterdir() if f.suffix.lower() in (".jpg", ".jpeg", ".png", ".bmp")) if p.is_dir() \
+        else [p]
+    image_data = [f.read_bytes() for f in files]
+
+    if not opt.requests:
+        response = requests.post(opt.url, files={"image": image_data[0]}).json()
+        pprint.pprint(response)
+    else:
+        dt, t = load(opt.url, image_data, opt.requests, opt.concurrency)
+        p50, p99 = np.percentile(dt, (50, 99)) * 1E3
+        print(f"{len(dt)} requests from {opt.concurrency} clients in {t:.2f}s: {len(dt) / t:.1f} req/s, "
+              f"latency p50 {p50:.1f}ms p99 {p99:.1f}ms")
+        pprint.pprint(requests.get(opt.stats_url).json())
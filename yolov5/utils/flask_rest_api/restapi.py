@@ -1,37 +1,276 @@
 """
-Run a rest API exposing the yolov5s object detection model
+Run a REST API exposing a YOLOv5 model, batching concurrent requests together
+
+Usage:
+    $ python utils/flask_rest_api/restapi.py --weights runs/train/exp/weights/best.pt --port 5000
+    $ curl -X POST -F image=@data/images/zidane.jpg 'http://localhost:5000/v1/object-detection/yolov5s'
+    $ curl 'http://localhost:5000/v1/stats'
 """
 import argparse
-import io
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
+import cv2
+import numpy as np
 import torch
-from PIL import Image
-from flask import Flask, request
 
-app = Flask(__name__)
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[2]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from models.experimental import attempt_load
+from utils.augmentations import letterbox
+from utils.general import check_img_size, non_max_suppression, print_args, scale_coords
+from utils.torch_utils import select_device
 
 DETECTION_URL = "/v1/object-detection/yolov5s"
+STATS_URL = "/v1/stats"
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 501: 'Not Implemented', 503: 'Service Unavailable'}
 
 
-@app.route(DETECTION_URL, methods=["POST"])
-def predict():
-    if not request.method == "POST":
-        return
+class Stats:
+    # Latency and throughput counters over the last n served requests, rejected requests are only counted as errors
+    def __init__(self, n=10000):
+        self.t0 = time.perf_counter()
+        self.done = deque(maxlen=n)  # (finish time, latency) pairs
+        self.requests = self.batches = self.images = self.errors = 0  # images is the number of batched images
 
-    if request.files.get("image"):
-        image_file = request.files["image"]
-        image_bytes = image_file.read()
+    def update(self, t, ok=True):
+        if ok:
+            now = time.perf_counter()
+            self.done.append((now, now - t))
+        self.requests += 1
+        self.errors += not ok
 
-        img = Image.open(io.BytesIO(image_bytes))
+    def get(self):
+        s = {'requests': self.requests, 'errors': self.errors, 'batches': self.batches,
+             'mean_batch': self.images / max(self.batches, 1), 'uptime': time.perf_counter() - self.t0}
+        if self.done:
+            t, dt = np.array(self.done).T
+            p50, p99 = np.percentile(dt, (50, 99)) * 1E3
+            span = t[-1] - t[0] + dt[0]  # window from first request start to last request end
+            s.update(p50_ms=p50, p99_ms=p99, throughput=len(t) / span if span > 0 else 0.0)
+        return s
 
-        results = model(img, size=640)  # reduce size=320 for faster inference
-        return results.pandas().xyxy[0].to_json(orient="records")
 
+class MicroBatcher:
+    # Collect concurrent requests into batches of at most max_batch images, waiting at most max_wait seconds.
+    # At most max_queue decoded images wait for a batch, further requests are rejected until the queue drains
+    def __init__(self, model, imgsz=640, max_batch=16, max_wait=0.01, conf_thres=0.25, iou_thres=0.45, max_det=1000,
+                 half=False, workers=4, max_queue=256):
+        self.model, self.imgsz, self.half = model, imgsz, half
+        self.max_batch, self.max_wait, self.max_queue = max_batch, max_wait, max_queue
+        self.nms = dict(conf_thres=conf_thres, iou_thres=iou_thres, max_det=max_det)
+        self.device = next(model.parameters()).device
+        self.names = model.module.names if hasattr(model, 'module') else model.names
+        self.queue = None  # created on the serving loop
+        self.decoder = ThreadPoolExecutor(workers, thread_name_prefix='decode')  # cv2 releases the GIL
+        self.runner = ThreadPoolExecutor(1, thread_name_prefix='infer')  # keeps the event loop free while inferring
+        self.stats = Stats()
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Flask API exposing YOLOv5 model")
+    def decode(self, data):
+        # Image bytes to letterboxed CHW uint8 array and original shape, None if undecodable
+        im0 = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)  # BGR
+        if im0 is None:
+            return None
+        im = letterbox(im0, self.imgsz, auto=False)[0]  # fixed shape so that any requests can be stacked
+        return np.ascontiguousarray(im.transpose((2, 0, 1))[::-1]), im0.shape  # HWC BGR to CHW RGB
+
+    @torch.no_grad()
+    def infer(self, batch):
+        # Inference on a list of (im, shape) pairs, returns one JSON string per image
+        im = torch.from_numpy(np.stack([b[0] for b in batch])).to(self.device)
+        im = im.half() if self.half else im.float()  # uint8 to fp16/32
+        im /= 255  # 0 - 255 to 0.0 - 1.0
+        pred = non_max_suppression(self.model(im)[0], **self.nms)
+        out = []
+        for det, (_, shape) in zip(pred, batch):
+            det[:, :4] = scale_coords(im.shape[2:], det[:, :4], shape)
+            out.append(json.dumps([{'xmin': x1, 'ymin': y1, 'xmax': x2, 'ymax': y2, 'confidence': conf,
+                                    'class': int(c), 'name': self.names[int(c)]}
+                                   for x1, y1, x2, y2, conf, c in det.float().tolist()]))
+        return out
+
+    def warmup(self):
+        s = (3, self.imgsz, self.imgsz)
+        self.infer([(np.zeros(s, dtype=np.uint8), s[1:])] * self.max_batch)
+
+    async def __call__(self, data):
+        # Detect objects in image bytes, returns (status, JSON string)
+        t = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        overloaded = 503, json.dumps({'error': 'server overloaded, retry later'})
+        if self.queue.full():  # reject before decoding
+            self.stats.update(t, ok=False)
+            return overloaded
+        x = await loop.run_in_executor(self.decoder, self.decode, data)
+        if x is None:
+            self.stats.update(t, ok=False)
+            return 400, json.dumps({'error': 'could not decode image'})
+        future = loop.create_future()
+        try:
+            self.queue.put_nowait((*x, future))
+        except asyncio.QueueFull:  # filled while decoding
+            self.stats.update(t, ok=False)
+            return overloaded
+        try:
+            status, out = 200, await future
+        except Exception as e:
+            status, out = 500, json.dumps({'error': str(e)})
+        self.stats.update(t, ok=status == 200)
+        return status, out
+
+    async def run(self):
+        # Batching loop, pass the next batch to the inference thread as soon as the previous one is done
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.max_queue)  # bounded, for backpressure
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if self.queue.empty() and timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get_nowait() if not self.queue.empty() else
+                                 await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.stats.batches += 1
+            self.stats.images += len(batch)
+            try:
+                results = await loop.run_in_executor(self.runner, self.infer, [b[:2] for b in batch])
+                for (*_, f), r in zip(batch, results):
+                    f.done() or f.set_result(r)
+            except Exception as e:
+                for *_, f in batch:
+                    f.done() or f.set_exception(e)
+
+
+def form_image(headers, body):
+    # Image bytes from a multipart/form-data 'image' field or a raw request body
+    ctype = headers.get('content-type', '')
+    if not ctype.startswith('multipart/form-data'):
+        return body
+    boundary = ctype.partition('boundary=')[2].split(';')[0].strip('"').encode()
+    for part in body.split(b'--' + boundary)[1:-1]:
+        head, _, data = part.partition(b'\r\n\r\n')
+        if b'name="image"' in head:
+            return data[:-2]  # strip CRLF before the next boundary
+    return b''
+
+
+def server(batcher, max_body=16 << 20):
+    # HTTP/1.1 connection handler with keep-alive, routes POST DETECTION_URL and GET STATS_URL
+    # Bodies must have a Content-Length of at most max_body bytes, chunked requests are answered 501
+    async def route(method, path, headers, body):
+        if path == DETECTION_URL:
+            if method != 'POST':
+                return 405, '{}'
+            data = form_image(headers, body)
+            return await batcher(data) if data else (400, json.dumps({'error': 'no image'}))
+        if path == STATS_URL:
+            return 200, json.dumps(batcher.stats.get())
+        return 404, '{}'
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                try:
+                    line, *lines = head.decode('latin-1').rstrip().split('\r\n')
+                    method, path = line.split()[:2]
+                    headers = {k.strip().lower(): v.strip() for k, _, v in (h.partition(':') for h in lines)}
+                    n = int(headers.get('content-length', 0))
+                    if n < 0:
+                        raise ValueError(f'invalid content-length {n}')
+                except ValueError as e:  # malformed request, answer and close as its end is unknown
+                    status, out, close = 400, json.dumps({'error': f'malformed request: {e}'}), True
+                else:  # requests whose body is not read are answered and closed too
+                    if 'transfer-encoding' in headers:
+                        status, out, close = 501, json.dumps({'error': 'Transfer-Encoding is not supported'}), True
+                    elif n > max_body:
+                        status, out, close = 413, json.dumps({'error': f'body over {max_body} bytes'}), True
+                    else:
+                        close = False
+                if not close:
+                    body = await reader.readexactly(n)
+                    try:
+                        status, out = await route(method, path.split('?')[0], headers, body)
+                    except Exception as e:
+                        status, out = 500, json.dumps({'error': str(e)})
+                    close = headers.get('connection', '').lower() == 'close'
+                out = out.encode()
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(out)}\r\nConnection: {'close' if close else 'keep-alive'}"
+                             f"\r\n\r\n".encode() + out)
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(batcher, host='0.0.0.0', port=5000, max_body=16 << 20):
+    batching = asyncio.create_task(batcher.run())
+    async with await asyncio.start_server(server(batcher, max_body), host, port) as s:
+        print(f'Serving on http://{host}:{port}{DETECTION_URL}, stats at {STATS_URL}')
+        try:
+            await s.serve_forever()
+        finally:
+            batching.cancel()
+            print(json.dumps(batcher.stats.get()))
+
+
+def main(opt):
+    device = select_device(opt.device)
+    half = opt.half and device.type != 'cpu'  # half precision only supported on CUDA
+    model = attempt_load(opt.weights, map_location=device)
+    model.half() if half else model.float()
+    imgsz = check_img_size(opt.imgsz, s=int(model.stride.max()))  # check image size
+    batcher = MicroBatcher(model, imgsz, opt.max_batch, opt.max_wait / 1E3, opt.conf_thres, opt.iou_thres,
+                           opt.max_det, half, opt.workers, opt.max_queue)
+    batcher.warmup()
+    try:
+        asyncio.run(serve(batcher, opt.host, opt.port, opt.max_body << 20))
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser(description="REST API exposing a YOLOv5 model with dynamic micro-batching")
+    parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s.pt', help='model.pt path')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='NMS IoU threshold')
+    parser.add_argument('--max-det', type=int, default=1000, help='maximum detections per image')
+    parser.add_argument('--max-batch', type=int, default=16, help='maximum images per inference batch')
+    parser.add_argument('--max-wait', type=float, default=10, help='maximum ms to wait for a batch to fill')
+    parser.add_argument('--workers', type=int, default=4, help='image decoding threads')
+    parser.add_argument('--max-queue', type=int, default=256, help='maximum queued images, 503 beyond')
+    parser.add_argument('--max-body', type=int, default=16, help='maximum request body size (MB), 413 beyond')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    parser.add_argument('--host', default='0.0.0.0', help='host address')
     parser.add_argument("--port", default=5000, type=int, help="port number")
-    args = parser.parse_args()
+    opt = parser.parse_args()
+    print_args(FILE.stem, opt)
+    return opt
 
-    model = torch.hub.load("ultralytics/yolov5", "yolov5s", force_reload=True)  # force_reload to recache
-    app.run(host="0.0.0.0", port=args.port)  # debug=True causes Restarting with stat
+
+if __name__ == "__main__":
+    main(parse_opt())
@@ -608,13 +608,13 @@ def clip_coords(boxes, shape):
 
 def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
                         labels=(), max_det=300):
-    """Runs Non-Maximum Suppression (NMS) on inference results
+    """Runs Non-Maximum Suppression (NMS) on inference results, for all images of the batch at once
 
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
     """
 
-    nc = prediction.shape[2] - 5  # number of classes
+    bs, nc = prediction.shape[0], prediction.shape[2] - 5  # batch size, number of classes
     xc = prediction[..., 4] > conf_thres  # candidates
 
     # Checks
@@ -623,81 +623,146 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
 
     # Settings
     min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
+    max_call = 1024  # maximum number of boxes of several images into one torchvision.ops.nms() call (cost ~n^2)
     time_limit = 10.0  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
     merge = False  # use merge-NMS
 
     t = time.time()
-    output = [torch.zeros((0, 6), device=prediction.device)] * prediction.shape[0]
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        x = x[xc[xi]]  # confidence
-
-        # Cat apriori labels if autolabelling
-        if labels and len(labels[xi]):
-            l = labels[xi]
-            v = torch.zeros((len(l), nc + 5), device=x.device)
-            v[:, :4] = l[:, 1:5]  # box
-            v[:, 4] = 1.0  # conf
-            v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
-            x = torch.cat((x, v), 0)
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Compute conf
-        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
-
-        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-        box = xywh2xyxy(x[:, :4])
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        if multi_label:
-            i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
-            x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
-        else:  # best class only
-            conf, j = x[:, 5:].max(1, keepdim=True)
-            x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
-
-        # Filter by class
-        if classes is not None:
-            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
-
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
-
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
-            continue
-        elif n > max_nms:  # excess boxes
-            x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
-
-        # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
-
-        output[xi] = x[i]
+    output = [torch.zeros((0, 6), device=prediction.device)] * bs
+
+    # Candidates of all images, image index b
+    # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
+    b, k = xc.nonzero(as_tuple=True)
+    x = prediction[b, k]  # confidence
+
+    # Cat apriori labels if autolabelling
+    if labels and sum(len(l) for l in labels):
+        l = torch.cat(labels, 0)
+        v = torch.zeros((len(l), nc + 5), device=x.device)
+        v[:, :4] = l[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
+        x = torch.cat((x, v), 0)
+        b = torch.cat((b, torch.cat([torch.full((len(li),), i, device=x.device) for i, li in enumerate(labels)])), 0)
+        i = b.argsort(stable=True)  # by image
+        x, b = x[i], b[i]
+
+    # If none remain return
+    if not x.shape[0]:
+        return output
+
+    # Compute conf
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, b = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), b[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, b = torch.cat((box, conf, j.float()), 1)[i], b[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, b = x[i], b[i]
+
+    # Apply finite constraint
+    # if not torch.isfinite(x).all():
+    #     x = x[torch.isfinite(x).all(1)]
+
+    # Check shape
+    if not x.shape[0]:  # no boxes
+        return output
+    n = torch.bincount(b, minlength=bs)  # number of boxes per image
+    if n.max() > max_nms:  # excess boxes
+        i = x[:, 4].argsort(descending=True)  # sort by confidence
+        i = i[b[i].argsort(stable=True)]  # by image, then confidence
+        i = i[torch.arange(len(i), device=x.device) - (n.cumsum(0) - n)[b[i]] < max_nms]
+        x, b = x[i], b[i]
+        n = n.clamp(max=max_nms)
+
+    # Batched NMS, boxes offset by class and image (in float64 to keep them exact), images grouped into calls of up to
+    # max_call boxes where possible. x is in image order, so each call takes a slice of it
+    c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+    boxes = boxes.double() + b[:, None] * float(max_wh * (nc + 2))  # boxes (offset by image)
+    calls, s, last = [], 0, 0  # end of each call, start of this call, end of last image
+    for e in n.cumsum(0).tolist():
+        if e - s > max_call and last > s:  # image would overflow the call, end it at the last image
+            calls.append(last)
+            s = last
+        last = e
+    calls.append(last)
+    i, s = [], 0
+    for e in calls:
+        i.append(torchvision.ops.nms(boxes[s:e], scores[s:e].double(), iou_thres) + s)  # NMS
+        s = e
         if (time.time() - t) > time_limit:
             print(f'WARNING: NMS time limit {time_limit}s exceeded')
-            break  # time limit exceeded
-
-    return output
+            break  # time limit exceeded, no detections for the remaining images
+    i = torch.cat(i)
+    i = i[b[i].argsort(stable=True)]  # by image, then confidence
+    if n.max() > max_det:  # limit detections
+        n = torch.bincount(b[i], minlength=bs)
+        i = i[torch.arange(len(i), device=x.device) - (n.cumsum(0) - n)[b[i]] < max_det]
+    if merge and (1 < x.shape[0] < 3E3):  # Merge NMS (boxes merged using weighted mean)
+        # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
+        iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
+        weights = iou * scores[None]  # box weights
+        x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
+        if redundant:
+            i = i[iou.sum(1) > 1]  # require redundancy
+
+    return list(x[i].split(torch.bincount(b[i], minlength=bs).tolist()))
+
+
+def profile_nms(batch_sizes=(1, 8, 16, 32), nc=80, img_size=640, n=10, device=''):
+    """ Profile non_max_suppression() on synthetic YOLOv5 outputs, per image calls vs one batched call. 'equal' only
+    compares these two calls, see test_nms.py for parity with the original per-image implementation
+    Usage: from utils.general import *; profile_nms()
+    Arguments
+        batch_sizes:    Batch sizes to profile
+        nc:             Number of classes
+        img_size:       Image size
+        n:              Number of timed runs per batch size and settings
+        device:         Device, i.e. 'cpu' or 'cuda:0'
+    """
+    from utils.torch_utils import select_device, time_sync
+    device = select_device(device)
+    na = sum(3 * (img_size // s) ** 2 for s in (8, 16, 32))  # number of anchors
+    gen = torch.Generator().manual_seed(0)
+    results = []
+    print(f"{'batch':>6}{'settings':>10}{'boxes/img':>11}{'per image (ms/img)':>20}{'batched':>10}{'equal':>7}")
+    for bs in batch_sizes:
+        p = torch.rand(bs, na, nc + 5, generator=gen)
+        p[..., :2] *= img_size  # xy
+        p[..., 2:4] = p[..., 2:4] * img_size / 4 + 4  # wh
+        p[..., 4] **= 60  # few confident objects
+        p[..., 5:] **= 200  # and classes
+        p = p.to(device)
+        for name, kwargs in ('val', dict(conf_thres=0.001, iou_thres=0.6, multi_label=True)), \
+                            ('detect', dict(conf_thres=0.25, iou_thres=0.45)):
+            tp, tb = [], []
+            for _ in range(n + 1):  # first is warmup
+                t = time_sync()
+                y1 = [non_max_suppression(p[i:i + 1], **kwargs)[0] for i in range(bs)]
+                tp.append(time_sync() - t)
+                t = time_sync()
+                y2 = non_max_suppression(p, **kwargs)
+                tb.append(time_sync() - t)
+            equal = all(torch.equal(a, b) for a, b in zip(y1, y2))
+            tp, tb = np.mean(tp[1:]) * 1E3 / bs, np.mean(tb[1:]) * 1E3 / bs
+            results.append((bs, name, tp, tb, equal))
+            print(f'{bs:>6}{name:>10}{sum(len(y) for y in y2) / bs:>11.0f}{tp:>20.2f}{tb:>10.2f}{str(equal):>7}')
+    return results
 
 
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
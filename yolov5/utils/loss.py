@@ -114,6 +114,14 @@ class ComputeLoss:
         for k in 'na', 'nc', 'nl', 'anchors':
             setattr(self, k, getattr(det, k))
 
+        # build_targets() constants and buffers
+        self.ai = torch.arange(self.na, device=device).float()  # anchor indices
+        self.off = torch.tensor([[0, 0],
+                                 [1, 0], [0, 1], [-1, 0], [0, -1],  # j,k,l,m
+                                 ], device=device).float() * 0.5  # offsets
+        self.gains = {}  # (nl, 7) gains to grid space, per prediction grid shapes
+        self.buffer = torch.zeros(self.nl, self.na, 0, 7, device=device)  # targets of all layers and anchors
+
     def __call__(self, p, targets):  # predictions, targets, model
         device = targets.device
         lcls, lbox, lobj = torch.zeros(1, device=device), torch.zeros(1, device=device), torch.zeros(1, device=device)
@@ -145,7 +153,7 @@ class ComputeLoss:
                 # Classification
                 if self.nc > 1:  # cls loss (only if multiple classes)
                     t = torch.full_like(ps[:, 5:], self.cn, device=device)  # targets
-                    t[range(n), tcls[i]] = self.cp
+                    t[torch.arange(n, device=device), tcls[i]] = self.cp
                     lcls += self.BCEcls(ps[:, 5:], t)  # BCE
 
                 # Append targets to text file
@@ -168,6 +176,54 @@ class ComputeLoss:
 
     def build_targets(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
+        # All layers at once, same results in the same order as build_targets_layers()
+        nl, na, nt = self.nl, self.na, targets.shape[0]  # number of layers, anchors, targets
+        shape = tuple(x.shape[2:4] for x in p)  # grid sizes
+        gain = self.gains.get(shape)
+        if gain is None:  # normalized to gridspace gain
+            gain = self.gains[shape] = torch.ones(nl, 7, device=targets.device)
+            gain[:, 2:6] = torch.tensor([[nx, ny, nx, ny] for ny, nx in shape], device=targets.device)  # xyxy gain
+
+        # Targets of all layers and anchors, with anchor indices appended, in grid space
+        if self.buffer.shape[2] < nt:
+            self.buffer = torch.empty(nl, na, 2 * nt, 7, device=targets.device)
+        t = self.buffer[:, :, :nt]
+        t[..., :6] = targets
+        t[..., 6] = self.ai[:, None]
+        t *= gain[:, None, None]
+
+        # Matches
+        g = 0.5  # bias
+        r = t[..., 4:6] / self.anchors[:, :, None]  # wh ratio
+        j = torch.max(r, 1. / r).max(3)[0] < self.hyp['anchor_t']  # compare
+
+        # Offsets
+        gxy = t[..., 2:4]  # grid xy
+        gxi = gain[:, None, None, 2:4] - gxy  # inverse
+        jk = (gxy % 1. < g) & (gxy > 1.)
+        lm = (gxi % 1. < g) & (gxi > 1.)
+        j = torch.stack((j, j & jk[..., 0], j & jk[..., 1], j & lm[..., 0], j & lm[..., 1]), 1)  # layer, offset, ...
+        l, o, a, i = j.nonzero().T  # layer, offset, anchor, target of each match
+        t = t[l, a, i]
+
+        # Define
+        b, c = t[:, :2].long().T  # image, class
+        gxy = t[:, 2:4]  # grid xy
+        gwh = t[:, 4:6]  # grid wh
+        gij = torch.min((gxy - self.off[o]).long().clamp_(0), gain[l, 2:4].long() - 1)  # grid xy indices, clamped
+        gi, gj = gij.T
+
+        # Split by layer
+        n = torch.bincount(l, minlength=nl).tolist()  # number of targets per layer
+        indices = list(zip(*(x.split(n) for x in (b, a, gj, gi))))  # image, anchor, grid indices
+        tbox = torch.cat((gxy - gij, gwh), 1).split(n)  # box
+        anch = self.anchors[l, a].split(n)  # anchors
+        tcls = c.split(n)  # class
+        return tcls, tbox, indices, anch
+
+    def build_targets_layers(self, p, targets):
+        # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
+        # One layer at a time, reference for build_targets()
         na, nt = self.na, targets.shape[0]  # number of anchors, targets
         tcls, tbox, indices, anch = [], [], [], []
         gain = torch.ones(7, device=targets.device)  # normalized to gridspace gain
@@ -214,9 +270,61 @@ class ComputeLoss:
 
             # Append
             a = t[:, 6].long()  # anchor indices
-            indices.append((b, a, gj.clamp_(0, gain[3] - 1), gi.clamp_(0, gain[2] - 1)))  # image, anchor, grid indices
+            gj, gi = gj.clamp_(0, gain[3].long() - 1), gi.clamp_(0, gain[2].long() - 1)
+            indices.append((b, a, gj, gi))  # image, anchor, grid indices
             tbox.append(torch.cat((gxy - gij, gwh), 1))  # box
             anch.append(anchors[a])  # anchors
             tcls.append(c)  # class
 
         return tcls, tbox, indices, anch
+
+
+def profile_build_targets(batch_sizes=(16, 32, 64, 128), cfg='yolov5s.yaml', img_size=640, labels=8, n=20, device=''):
+    """ Profile ComputeLoss.build_targets() on synthetic labels, all layers at once vs one layer at a time. Parity of
+    the two is tested in test_loss.py
+    Usage: from utils.loss import *; profile_build_targets()
+    Arguments
+        batch_sizes:    Batch sizes to profile
+        cfg:            Model yaml, for its anchors and strides
+        img_size:       Image size
+        labels:         Mean number of labels per image
+        n:              Number of timed steps per batch size
+        device:         Device, i.e. 'cpu' or 'cuda:0'
+    """
+    import numpy as np
+    import yaml
+
+    from models.yolo import Model
+    from utils.general import ROOT, check_yaml
+    from utils.torch_utils import select_device, time_sync
+
+    device = select_device(device)
+    model = Model(check_yaml(cfg)).to(device)
+    with open(ROOT / 'data/hyps/hyp.scratch.yaml', errors='ignore') as f:
+        model.hyp = yaml.safe_load(f)
+    det = model.model[-1]
+    loss = ComputeLoss(model)
+    gen = torch.Generator().manual_seed(0)
+    results = []
+    print(f"{'batch':>6}{'matches':>9}{'per layer (ms)':>16}{'batched':>10}")
+    for bs in batch_sizes:
+        p = [torch.zeros(1, 1, 1, 1, 1, device=device).expand(bs, det.na, img_size // int(s), img_size // int(s),
+                                                              det.no) for s in det.stride]  # shapes only
+        tl, tb, matches = [], [], 0
+        for _ in range(n + 1):  # first is warmup, new labels every step
+            nt = int(torch.randint(0, 2 * labels * bs + 1, (1,), generator=gen))
+            targets = torch.cat((torch.randint(0, bs, (nt, 1), generator=gen).sort(0)[0].float(),  # image
+                                 torch.randint(0, det.nc, (nt, 1), generator=gen).float(),  # class
+                                 torch.rand(nt, 2, generator=gen),  # xy
+                                 torch.rand(nt, 2, generator=gen) ** 2 * 0.8 + 0.005), 1).to(device)  # wh
+            t = time_sync()
+            loss.build_targets_layers(p, targets)
+            tl.append(time_sync() - t)
+            t = time_sync()
+            tcls = loss.build_targets(p, targets)[0]
+            tb.append(time_sync() - t)
+            matches += sum(len(x) for x in tcls)
+        tl, tb = np.mean(tl[1:]) * 1E3, np.mean(tb[1:]) * 1E3
+        results.append((bs, tl, tb))
+        print(f'{bs:>6}{matches / (n + 1):>9.0f}{tl:>16.2f}{tb:>10.2f}')
+    return results
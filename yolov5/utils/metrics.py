@@ -34,40 +34,56 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
 
     # Sort by objectness
     i = np.argsort(-conf)
-    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
+    conf, pred_cls = conf[i], pred_cls[i]
 
     # Find unique classes
-    unique_classes = np.unique(target_cls)
-    nc = unique_classes.shape[0]  # number of classes, number of detections
-
-    # Create Precision-Recall curve and compute AP for each class
+    unique_classes, n_l = np.unique(target_cls, return_counts=True)  # classes, number of labels per class
+    nc, niou = unique_classes.shape[0], tp.shape[1]  # number of classes, IoU thresholds
+
+    # Group predictions by class, by objectness within each class, dropping those of classes without labels
+    ci = np.searchsorted(unique_classes, pred_cls)  # class index
+    ci[ci == nc] = 0
+    j = np.nonzero(unique_classes[ci] == pred_cls)[0]
+    j = j[np.argsort(ci[j].astype(np.int16 if nc < 2 ** 15 else np.int64), kind='stable')]  # int16 radix sorts
+    tp, conf, ci = np.ascontiguousarray(tp.T)[:, i[j]], conf[j], ci[j]  # tp as (IoU threshold, prediction)
+    n_p = np.bincount(ci, minlength=nc)  # number of predictions per class
+    start = np.cumsum(n_p) - n_p  # first prediction of each class
+
+    # Accumulate FPs and TPs of all classes, with each curve contiguous
+    tpc = tp.cumsum(1, dtype=np.int32 if len(ci) < 2 ** 31 else np.int64)
+    tpc -= np.repeat(np.concatenate((np.zeros((niou, 1), dtype=tpc.dtype), tpc), 1)[:, start], n_p, 1)
+    n = np.arange(1, len(ci) + 1) - start[ci]  # number of predictions so far in each class, tpc + fpc
+
+    # Recall and precision curves, of all classes and IoU thresholds
+    recall = tpc / (n_l + 1e-16)[ci]  # recall curve
+    precision = tpc / n  # precision curve
+
+    # Recall and precision at 1000 confidences, negative x, xp because xp decreases
     px, py = np.linspace(0, 1, 1000), []  # for plotting
-    ap, p, r = np.zeros((nc, tp.shape[1])), np.zeros((nc, 1000)), np.zeros((nc, 1000))
-    for ci, c in enumerate(unique_classes):
-        i = pred_cls == c
-        n_l = (target_cls == c).sum()  # number of labels
-        n_p = i.sum()  # number of predictions
-
-        if n_p == 0 or n_l == 0:
-            continue
-        else:
-            # Accumulate FPs and TPs
-            fpc = (1 - tp[i]).cumsum(0)
-            tpc = tp[i].cumsum(0)
-
-            # Recall
-            recall = tpc / (n_l + 1e-16)  # recall curve
-            r[ci] = np.interp(-px, -conf[i], recall[:, 0], left=0)  # negative x, xp because xp decreases
-
-            # Precision
-            precision = tpc / (tpc + fpc)  # precision curve
-            p[ci] = np.interp(-px, -conf[i], precision[:, 0], left=1)  # p at pr_score
-
-            # AP from recall-precision curve
-            for j in range(tp.shape[1]):
-                ap[ci, j], mpre, mrec = compute_ap(recall[:, j], precision[:, j])
+    if tp.size < 1E6:  # per class, grouped interpolation only pays off for large sets (identical results)
+        ap, p, r = np.zeros((nc, niou)), np.zeros((nc, 1000)), np.zeros((nc, 1000))
+        for c in np.nonzero(n_p)[0]:
+            k = slice(start[c], start[c] + n_p[c])  # predictions of class c
+            r[c] = np.interp(-px, -conf[k], recall[0, k], left=0)
+            p[c] = np.interp(-px, -conf[k], precision[0, k], left=1)
+            for j in range(niou):
+                ap[c, j], mpre, mrec = compute_ap(recall[j, k], precision[j, k])
                 if plot and j == 0:
                     py.append(np.interp(px, mrec, mpre))  # precision at mAP@0.5
+    else:
+        gx = np.repeat(np.arange(nc), len(px))  # class of each point
+        r = interp(np.tile(-px, nc), gx, -conf, recall[0], ci, left=0).reshape(nc, -1)
+        p = interp(np.tile(-px, nc), gx, -conf, precision[0], ci, left=1).reshape(nc, -1)
+        r[n_p == 0], p[n_p == 0] = 0, 0
+
+        # AP from recall-precision curves, one per IoU threshold and class
+        g = (np.arange(niou)[:, None] * nc + ci).ravel()  # curve of each point
+        ap, mpre, mrec, g = compute_ap_groups(recall.ravel(), precision.ravel(), g, niou * nc)
+        ap = np.ascontiguousarray(ap.reshape(niou, nc).T)
+        ap[n_p == 0] = 0
+        if plot:
+            py = interp(np.tile(px, nc), gx, mrec, mpre, g)  # precision at mAP@0.5
+            py = list(py.reshape(nc, -1)[n_p > 0])
 
     # Compute F1 (harmonic mean of precision and recall)
     f1 = 2 * p * r / (p + r + 1e-16)
@@ -83,6 +99,91 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
     return p[:, i], r[:, i], ap, f1[:, i], unique_classes.astype('int32')
 
 
+def interp(x, gx, xp, fp, gp, left=None, right=None):
+    """ np.interp() for many groups at once, i.e. np.interp(x[gx == g], xp[gp == g], fp[gp == g]) for each group g
+    # Arguments
+        x:      Points to evaluate (nparray), of groups gx
+        xp:     Data point x coordinates (nparray), increasing within each group, of groups gp (sorted)
+        fp:     Data point y coordinates (nparray)
+        left:   Value for x < xp[0] of its group, default fp[0]
+        right:  Value for x > xp[-1] of its group, default fp[-1]
+    # Returns
+        Interpolated values (nparray), exactly as np.interp() per group
+    """
+    if not len(xp):
+        return np.full(len(x), np.nan)
+    x, xp, fp = (np.asarray(a, dtype=np.float64) for a in (x, xp, fp))
+    ng = max(gx.max(initial=-1), gp.max(initial=-1)) + 1
+    n = np.bincount(gp, minlength=ng)
+    end = np.cumsum(n)[gx]
+    first, last = np.minimum(end - n[gx], len(xp) - 1), end - 1  # first and last data point of each x's group
+    j = searchsorted_groups(xp, end - n[gx], end, x) - 1  # last data point <= x, as np.interp()
+    y = np.empty(len(x))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        jn = np.minimum(j + 1, len(xp) - 1)
+        slope = (fp[jn] - fp[j]) / (xp[jn] - xp[j])
+        y[:] = slope * (x - xp[j]) + fp[j]
+        nan = np.isnan(y)  # if we get nan in one direction, try the other
+        y[nan] = slope[nan] * (x[nan] - xp[jn[nan]]) + fp[jn[nan]]
+        nan &= np.isnan(y) & (fp[j] == fp[jn])
+        y[nan] = fp[j[nan]]
+    i = (j == last) | (xp[j] == x)  # at last data point or exactly at data point
+    y[i] = fp[j[i]]
+    i = j < first  # left
+    y[i] = fp[first[i]] if left is None else left
+    i = x > xp[last]  # right
+    y[i] = fp[last[i]] if right is None else right
+    y[n[gx] == 0] = np.nan  # no data points
+    return y
+
+
+def searchsorted_groups(a, first, last, v):
+    # np.searchsorted(a[first:last], v, side='right') + first for each v and its own range, by a binary search of all
+    # v at once
+    lo, hi = first.copy(), last.copy()
+    while True:
+        i = lo < hi
+        if not i.any():
+            return lo
+        mid = (lo + hi) // 2
+        le = a[np.minimum(mid, len(a) - 1)] <= v
+        lo, hi = np.where(i & le, mid + 1, lo), np.where(i & ~le, mid, hi)
+
+
+def compute_ap_groups(recall, precision, g, ng):
+    """ Compute the average precision of many recall and precision curves at once, as compute_ap() does for each
+    # Arguments
+        recall:     The recall curves (nparray), concatenated
+        precision:  The precision curves (nparray), concatenated
+        g:          Curve of each point (nparray), sorted
+        ng:         Number of curves
+    # Returns
+        Average precision of each curve, precision curves, recall curves and their curve index
+    """
+
+    # Append sentinel values to beginning and end
+    n = np.bincount(g, minlength=ng) + 2
+    end = np.cumsum(n)
+    i = np.arange(1, len(g) + 1) + 2 * g  # position of each point after the sentinels
+    mrec = np.empty(end[-1])
+    mrec[i], mrec[end - n], mrec[end - 1] = recall, 0.0, 1.0
+
+    # Compute the precision envelope, the max from each point to the end of its curve. Precisions are ranked, and each
+    # curve's ranks offset above those of the curves after it, so the running max stays within each curve and is exact
+    mpre = np.empty(end[-1])
+    mpre[i], mpre[end - n], mpre[end - 1] = precision, 1.0, 0.0
+    gm = np.repeat(np.arange(ng), n)
+    u, r = np.unique(mpre, return_inverse=True)
+    r = np.maximum.accumulate((r + (ng - 1 - gm) * len(u))[::-1])[::-1]
+    mpre = u[r % len(u)]
+
+    # Integrate area under curve
+    x = np.linspace(0, 1, 101)  # 101-point interp (COCO)
+    y = interp(np.tile(x, ng), np.repeat(np.arange(ng), len(x)), mrec, mpre, gm).reshape(ng, -1)
+    ap = (np.diff(x) * (y[:, 1:] + y[:, :-1]) / 2.0).sum(1)  # integrate, as np.trapz()
+    return ap, mpre, mrec, gm
+
+
 def compute_ap(recall, precision):
     """ Compute the average precision, given the recall and precision curves
     # Arguments
@@ -111,6 +212,43 @@ def compute_ap(recall, precision):
     return ap, mpre, mrec
 
 
+class DetectionStats:
+    # Validation statistics (correct, conf, pcls) per prediction and (tcls) per target, appended a batch at a time to
+    # preallocated arrays that double in size when full
+    def __init__(self, niou=10, n=4096):
+        self.correct = np.zeros((n, niou), dtype=bool)
+        self.conf = np.zeros(n, dtype=np.float32)
+        self.pcls = np.zeros(n, dtype=np.float32)
+        self.tcls = np.zeros(n, dtype=np.float32)
+        self.np, self.nt = 0, 0  # number of predictions, targets
+
+    def update(self, correct, conf, pcls, tcls):
+        # Append predictions correct (Array[N, 10]), conf (Array[N]), pcls (Array[N]) and targets tcls (Array[M])
+        correct, conf, pcls, tcls = (x.cpu().numpy() if isinstance(x, torch.Tensor) else x for x in
+                                     (correct, conf, pcls, tcls))
+        self.correct = self.append(self.correct, self.np, correct)
+        self.conf = self.append(self.conf, self.np, conf)
+        self.pcls = self.append(self.pcls, self.np, pcls)
+        self.tcls = self.append(self.tcls, self.nt, tcls)
+        self.np += len(conf)
+        self.nt += len(tcls)
+
+    @staticmethod
+    def append(a, i, x):
+        # Write x to a[i:], doubling a if full
+        if i + len(x) > len(a):
+            a = np.concatenate((a[:i], np.zeros((max(len(a), i + len(x)) * 2 - i, *a.shape[1:]), dtype=a.dtype)))
+        a[i:i + len(x)] = x
+        return a
+
+    def __len__(self):
+        return self.np + self.nt
+
+    def get(self):
+        # Return (correct, conf, pcls, tcls) for ap_per_class()
+        return self.correct[:self.np], self.conf[:self.np], self.pcls[:self.np], self.tcls[:self.nt]
+
+
 class ConfusionMatrix:
     # Updated version of https://github.com/kaanakan/object_detection_confusion_matrix
     def __init__(self, nc, conf=0.25, iou_thres=0.45):
@@ -10,6 +10,7 @@ import argparse
 import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from threading import Thread
 
@@ -23,12 +24,12 @@ if str(ROOT) not in sys.path:
     sys.path.append(str(ROOT))  # add ROOT to PATH
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
-from models.experimental import attempt_load
+from models.experimental import attempt_load, optimize_for_inference
 from utils.datasets import create_dataloader
 from utils.general import coco80_to_coco91_class, check_dataset, check_img_size, check_requirements, \
     check_suffix, check_yaml, box_iou, non_max_suppression, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, \
     increment_path, colorstr, print_args
-from utils.metrics import ap_per_class, ConfusionMatrix
+from utils.metrics import ap_per_class, ConfusionMatrix, DetectionStats
 from utils.plots import output_to_target, plot_images, plot_val_study
 from utils.torch_utils import select_device, time_sync
 from utils.callbacks import Callbacks
@@ -56,18 +57,34 @@ def save_one_json(predn, jdict, path, class_map):
                       'score': round(p[4], 5)})
 
 
-def process_batch(detections, labels, iouv):
+def scale_images(coords, i, shapes):
+    # Rescale coords (xyxy) of images i from img_size to their native shapes, as scale_coords() does per image
+    gain = torch.tensor([x[1][0][0] for x in shapes], device=coords.device)[i, None]
+    pad = torch.tensor([x[1][1] for x in shapes], device=coords.device)[i]  # wh padding
+    shape = torch.tensor([x[0][::-1] for x in shapes], device=coords.device, dtype=torch.float32)[i]  # wh
+    coords[:, [0, 2]] -= pad[:, :1]  # x padding
+    coords[:, [1, 3]] -= pad[:, 1:]  # y padding
+    coords[:, :4] /= gain
+    coords[:, :4] = torch.min(coords[:, :4].clamp(min=0), shape.repeat(1, 2))  # clip to image shape
+    return coords
+
+
+def process_batch(detections, labels, iouv, images=None):
     """
     Return correct predictions matrix. Both sets of boxes are in (x1, y1, x2, y2) format.
     Arguments:
         detections (Array[N, 6]), x1, y1, x2, y2, conf, class
         labels (Array[M, 5]), class, x1, y1, x2, y2
+        images (Array[N], Array[M]), optional image index of detections and labels, to match a batch of images at once
     Returns:
         correct (Array[N, 10]), for 10 IoU levels
     """
     correct = torch.zeros(detections.shape[0], iouv.shape[0], dtype=torch.bool, device=iouv.device)
     iou = box_iou(labels[:, 1:], detections[:, :4])
-    x = torch.where((iou >= iouv[0]) & (labels[:, 0:1] == detections[:, 5]))  # IoU above threshold and classes match
+    match = (iou >= iouv[0]) & (labels[:, 0:1] == detections[:, 5])  # IoU above threshold and classes match
+    if images is not None:
+        match &= images[1][:, None] == images[0]  # and images match
+    x = torch.where(match)
     if x[0].shape[0]:
         matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, detection, iou]
         if x[0].shape[0] > 1:
@@ -87,7 +104,7 @@ def run(data,
         imgsz=640,  # inference size (pixels)
         conf_thres=0.001,  # confidence threshold
         iou_thres=0.6,  # NMS IoU threshold
-        task='val',  # train, val, test, speed or study
+        task='val',  # train, val, test, speed, study or int8
         device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
         single_cls=False,  # treat as single-class dataset
         augment=False,  # augmented inference
@@ -100,6 +117,7 @@ def run(data,
         name='exp',  # save to project/name
         exist_ok=False,  # existing project/name ok, do not increment
         half=True,  # use FP16 half-precision inference
+        optimize=False,  # compile model with optimize_for_inference()
         model=None,
         dataloader=None,
         save_dir=Path(''),
@@ -135,6 +153,8 @@ def run(data,
     # Half
     half &= device.type != 'cpu'  # half precision only supported on CUDA
     model.half() if half else model.float()
+    if optimize and not training:
+        model = optimize_for_inference(model, imgsz, batch_size)  # square batches of one compiled shape, not rect
 
     # Configure
     model.eval()
@@ -149,7 +169,7 @@ def run(data,
             model(torch.zeros(1, 3, imgsz, imgsz).to(device).type_as(next(model.parameters())))  # run once
         pad = 0.0 if task == 'speed' else 0.5
         task = task if task in ('train', 'val', 'test') else 'val'  # path to train/val/test images
-        dataloader = create_dataloader(data[task], imgsz, batch_size, gs, single_cls, pad=pad, rect=True,
+        dataloader = create_dataloader(data[task], imgsz, batch_size, gs, single_cls, pad=pad, rect=not optimize,
                                        prefix=colorstr(f'{task}: '))[0]
 
     seen = 0
@@ -159,24 +179,12 @@ def run(data,
     s = ('%20s' + '%11s' * 6) % ('Class', 'Images', 'Labels', 'P', 'R', 'mAP@.5', 'mAP@.5:.95')
     dt, p, r, f1, mp, mr, map50, map = [0.0, 0.0, 0.0], 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
     loss = torch.zeros(3, device=device)
-    jdict, stats, ap, ap_class = [], [], [], []
-    for batch_i, (img, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s)):
-        t1 = time_sync()
-        img = img.to(device, non_blocking=True)
-        img = img.half() if half else img.float()  # uint8 to fp16/32
-        img /= 255.0  # 0 - 255 to 0.0 - 1.0
-        targets = targets.to(device)
-        nb, _, height, width = img.shape  # batch size, channels, height, width
-        t2 = time_sync()
-        dt[0] += t2 - t1
+    jdict, stats, ap, ap_class = [], DetectionStats(niou), [], []
 
-        # Run model
-        out, train_out = model(img, augment=augment)  # inference and training outputs
-        dt[1] += time_sync() - t2
-
-        # Compute loss
-        if compute_loss:
-            loss += compute_loss([x.float() for x in train_out], targets)[1]  # box, obj, cls
+    def process(batch_i, img, targets, paths, shapes, out):
+        # NMS, statistics, save/log and plots of a batch
+        nonlocal seen
+        nb, _, height, width = img.shape  # batch size, channels, height, width
 
         # Run NMS
         targets[:, 2:] *= torch.Tensor([width, height, width, height]).to(device)  # to pixels
@@ -185,43 +193,35 @@ def run(data,
         out = non_max_suppression(out, conf_thres, iou_thres, labels=lb, multi_label=True, agnostic=single_cls)
         dt[2] += time_sync() - t3
 
-        # Statistics per image
-        for si, pred in enumerate(out):
-            labels = targets[targets[:, 0] == si, 1:]
-            nl = len(labels)
-            tcls = labels[:, 0].tolist() if nl else []  # target class
-            path, shape = Path(paths[si]), shapes[si][0]
-            seen += 1
-
-            if len(pred) == 0:
-                if nl:
-                    stats.append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
-                continue
-
-            # Predictions
-            if single_cls:
-                pred[:, 5] = 0
-            predn = pred.clone()
-            scale_coords(img[si].shape[1:], predn[:, :4], shape, shapes[si][1])  # native-space pred
-
-            # Evaluate
-            if nl:
-                tbox = xywh2xyxy(labels[:, 1:5])  # target boxes
-                scale_coords(img[si].shape[1:], tbox, shape, shapes[si][1])  # native-space labels
-                labelsn = torch.cat((labels[:, 0:1], tbox), 1)  # native-space labels
-                correct = process_batch(predn, labelsn, iouv)
-                if plots:
+        # Statistics per batch, targets are in image order
+        n = [len(x) for x in out]  # number of predictions per image
+        pred = torch.cat(out)
+        pi = torch.arange(nb, device=device).repeat_interleave(torch.tensor(n, device=device))  # image of predictions
+        ti = targets[:, 0].long()  # image of targets
+        if single_cls:
+            pred[:, 5] = 0
+        predn = scale_images(pred.clone(), pi, shapes)  # native-space pred
+        tbox = scale_images(xywh2xyxy(targets[:, 2:6]), ti, shapes)  # native-space target boxes
+        labelsn = torch.cat((targets[:, 1:2], tbox), 1)  # native-space labels
+        correct = process_batch(predn, labelsn, iouv, images=(pi, ti))
+        stats.update(correct, pred[:, 4], pred[:, 5], targets[:, 1])  # (correct, conf, pcls, tcls)
+        seen += nb
+
+        # Save/log per image
+        out, predns = pred.split(n), predn.split(n)
+        if plots or save_txt or save_json or callbacks.get_registered_actions('on_val_image_end'):
+            labelsns = labelsn.split(torch.bincount(ti, minlength=nb).tolist())
+            for si, (pred, predn, labelsn) in enumerate(zip(out, predns, labelsns)):
+                if len(pred) == 0:
+                    continue
+                path, shape = Path(paths[si]), shapes[si][0]
+                if plots and len(labelsn):
                     confusion_matrix.process_batch(predn, labelsn)
-            else:
-                correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool)
-            stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))  # (correct, conf, pcls, tcls)
-
-            # Save/log
-            if save_txt:
-                save_one_txt(predn, save_conf, shape, file=save_dir / 'labels' / (path.stem + '.txt'))
-            if save_json:
-                save_one_json(predn, jdict, path, class_map)  # append to COCO-JSON dictionary
-            callbacks.run('on_val_image_end', pred, predn, path, names, img[si])
+                if save_txt:
+                    save_one_txt(predn, save_conf, shape, file=save_dir / 'labels' / (path.stem + '.txt'))
+                if save_json:
+                    save_one_json(predn, jdict, path, class_map)  # append to COCO-JSON dictionary
+                callbacks.run('on_val_image_end', pred, predn, path, names, img[si])
 
         # Plot images
         if plots and batch_i < 3:
@@ -230,13 +230,39 @@ def run(data,
             f = save_dir / f'val_batch{batch_i}_pred.jpg'  # predictions
             Thread(target=plot_images, args=(img, output_to_target(out), paths, f, names), daemon=True).start()
 
+    post, pending = ThreadPoolExecutor(1), None  # post-processing, in order
+    for batch_i, (img, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s)):
+        t1 = time_sync()
+        img = img.to(device, non_blocking=True)
+        img = img.half() if half else img.float()  # uint8 to fp16/32
+        img /= 255.0  # 0 - 255 to 0.0 - 1.0
+        targets = targets.to(device)
+        t2 = time_sync()
+        dt[0] += t2 - t1
+
+        # Run model
+        out, train_out = model(img, augment=augment)  # inference and training outputs
+        dt[1] += time_sync() - t2
+
+        # Compute loss
+        if compute_loss:
+            loss += compute_loss([x.float() for x in train_out], targets)[1]  # box, obj, cls
+
+        # NMS and statistics on the post thread, overlapping the next batch's inference
+        if pending:
+            pending.result()
+        pending = post.submit(process, batch_i, img, targets, paths, shapes, out)
+    if pending:
+        pending.result()
+    post.shutdown()
+
     # Compute statistics
-    stats = [np.concatenate(x, 0) for x in zip(*stats)]  # to numpy
-    if len(stats) and stats[0].any():
-        p, r, ap, f1, ap_class = ap_per_class(*stats, plot=plots, save_dir=save_dir, names=names)
+    correct, conf, pcls, tcls = stats.get()  # to numpy
+    if correct.any():
+        p, r, ap, f1, ap_class = ap_per_class(correct, conf, pcls, tcls, plot=plots, save_dir=save_dir, names=names)
         ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
         mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
-        nt = np.bincount(stats[3].astype(np.int64), minlength=nc)  # number of targets per class
+        nt = np.bincount(tcls.astype(np.int64), minlength=nc)  # number of targets per class
     else:
         nt = torch.zeros(1)
 
@@ -305,7 +331,7 @@ def parse_opt():
     parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='inference size (pixels)')
     parser.add_argument('--conf-thres', type=float, default=0.001, help='confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.6, help='NMS IoU threshold')
-    parser.add_argument('--task', default='val', help='train, val, test, speed or study')
+    parser.add_argument('--task', default='val', help='train, val, test, speed, study or int8')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--single-cls', action='store_true', help='treat as single-class dataset')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
@@ -318,6 +344,7 @@ def parse_opt():
     parser.add_argument('--name', default='exp', help='save to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    parser.add_argument('--optimize', action='store_true', help='compile model to cached channels_last TorchScript')
     opt = parser.parse_args()
     opt.data = check_yaml(opt.data)  # check YAML
     opt.save_json |= opt.data.endswith('coco.yaml')
@@ -337,7 +364,7 @@ def main(opt):
         # python val.py --task speed --data coco.yaml --batch 1 --weights yolov5n.pt yolov5s.pt...
         for w in opt.weights if isinstance(opt.weights, list) else [opt.weights]:
             run(opt.data, weights=w, batch_size=opt.batch_size, imgsz=opt.imgsz, conf_thres=.25, iou_thres=.45,
-                device=opt.device, save_json=False, plots=False)
+                device=opt.device, save_json=False, plots=False, optimize=opt.optimize)
 
     elif opt.task == 'study':  # run over a range of settings and save/plot
         # python val.py --task study --data coco.yaml --iou 0.7 --weights yolov5n.pt yolov5s.pt...
@@ -354,6 +381,27 @@ def main(opt):
         os.system('zip -r study.zip study_*.txt')
         plot_val_study(x=x)  # plot
 
+    elif opt.task == 'int8':  # accuracy vs CPU latency of FP32 and static INT8 models
+        # python val.py --task int8 --data lego_data.yaml --batch 1 --weights best.pt
+        from export import export_torch_int8
+        for w in opt.weights if isinstance(opt.weights, list) else [opt.weights]:
+            f = f'int8_{Path(opt.data).stem}_{Path(w).stem}.txt'  # filename to save to
+            wq = str(w).replace('.pt', '-int8.pt')
+            if not Path(wq).exists():
+                wq = export_torch_int8(Path(w), opt.data, [opt.imgsz] * 2, opt.batch_size, ncalib=100)
+                if wq is None:
+                    print(f'WARNING: INT8 export of {w} failed, skipping')
+                    continue
+            y = []  # P, R, mAP@.5, mAP@.5:.95, pre-process, inference, NMS (ms)
+            for wi in w, wq:
+                r, _, t = run(opt.data, weights=wi, batch_size=opt.batch_size, imgsz=opt.imgsz,
+                              conf_thres=opt.conf_thres, iou_thres=opt.iou_thres, device='cpu', plots=False)
+                y.append(r[:4] + t)
+            print(('\n%20s' + '%11s' * 7) % ('Model', 'P', 'R', 'mAP@.5', 'mAP@.5:.95', 'pre', 'inference', 'NMS'))
+            for name, yi in zip(('FP32', 'INT8'), y):
+                print(('%20s' + '%11.3g' * 7) % (name, *yi))
+            np.savetxt(f, y, fmt='%10.4g')  # save
+
 
 if __name__ == "__main__":
     opt = parse_opt()